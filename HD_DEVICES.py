@@ -1,23 +1,114 @@
-from random import randint
-import random
 import time
-import Adafruit_BBIO.GPIO as GPIO
+import heapq
+import itertools
+import threading
+import numpy as np
+from hd_backend import HIGH, LOW, OUT, get_default_backend
+from hd_history import SampleHistory
+from hd_sim import get_default_simulator
+from ipc_log import get_logger
+
+
+log = get_logger("devices")
+
+#   Shortest and longest time between LED pin changes a BLINK accepts
+MIN_BLINK_RATE = 0.01
+MAX_BLINK_RATE = 3600.0
+
+#   Longest BLINK accepted, in seconds
+MAX_BLINK_TIMEOUT = 86400.0
+
+#   Highest POWER setting accepted, in volts
+MAX_POWER_VOLTS = 12.0
+
+
+class DeviceScheduler:
+    """ Runs timed device activities on a single background thread
+
+    Activities are held in a heap ordered by due time, so arming an
+    activity costs O(log n) on the caller's thread and never waits for
+    the activity itself to run.
+    """
+
+    def __init__(self):
+        self._queue = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def call_at(self, when, callback, *args):
+        """ Schedule callback(*args) to run at time.monotonic() == when
+
+        :param when: monotonic time at which to run the callback
+        :param callback: callable, if it returns a time it is rescheduled
+                        to run again at that time
+        """
+        with self._cond:
+            heapq.heappush(self._queue, (when, next(self._counter), callback, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, 
+                                                name="DeviceScheduler", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                when, _, callback, args = self._queue[0]
+                delay = when - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._queue)
+
+            # A failing activity must not stop the others sharing the thread
+            try:
+                next_when = callback(*args)
+            except Exception:
+                log.exception("Scheduled %s failed", getattr(callback, "__qualname__", callback))
+                continue
+            if next_when is not None:
+                self.call_at(next_when, callback, *args)
+
+
+#   Shared by all devices so the number of blinking LEDs never adds threads
+SCHEDULER = DeviceScheduler()
+
 
 class HdDevice:
     """ Represents a generic hardware device """
 
     def __init__(self, status, 
-                address, alias):
+                address, alias, cache_ttl=0, backend=None, history_size=3600):
         """ Superclass constructor
 
         :param status: on/off status of the device
         :param address: bus address of the device
         :param alias: descriptive name of the device for user interaction
+        :param cache_ttl: seconds a reading is served from cache by read()
+        :param backend: the HdBackend the device is attached to, 
+                        the default backend if None
+        :param history_size: number of numeric readings kept in self.history
 
         """
         self.status = status
         self.addr = address
         self.alias = alias
+        self.backend = backend or get_default_backend()
+        self.lock = threading.RLock()
+        self.cache_ttl = cache_ttl
+        self._sample = None
+        self._sample_gen = 0
+        self._sample_lock = threading.Lock()
+        self.history_size = history_size
+        self.history = None
+        # Tuple of hd_rules.Rule checked on every new sample, None if none
+        self.rules = None
+        # The SensorSimulator channel of a device with simulated readings
+        self.simulator = None
+        self.channel = None
 
     def get_status(self):
         return self.status
@@ -34,16 +125,162 @@ class HdDevice:
     def get_alias(self):
         return self.alias
 
+    def read(self, max_age=None):
+        """ Returns a reading, from cache if it is recent enough
+
+        :param max_age: oldest cached reading accepted in seconds, 
+                        cache_ttl if None
+        Returns a (value, timestamp, cached) tuple, value as get_value.
+        Concurrent reads share one call to get_value: a reader that waited
+        on another's read accepts its result, as it is no older than the
+        moment the reader arrived.
+        """
+        arrived = time.time()
+        max_age = self.cache_ttl if max_age is None else float(max_age)
+
+        sample = self._sample
+        if sample is not None and sample[1] >= arrived - max_age:
+            return sample[0], sample[1], True
+
+        with self._sample_lock:
+            sample = self._sample
+            if sample is not None and sample[1] >= arrived - max_age:
+                return sample[0], sample[1], True
+
+            gen = self._sample_gen
+            with self.lock:
+                value = self.get_value()
+            timestamp = time.time()
+            # A CONFIG during the read makes the reading unsafe to reuse
+            if gen == self._sample_gen:
+                self._sample = (value, timestamp)
+            return value, timestamp, False
+
+    def invalidate(self):
+        """ Drops the cached reading, called when the device is configured """
+        self._sample_gen += 1
+        self._sample = None
+
     #   MUST BE OVERRIDEN 
     def get_data(self):
         pass
 
+    def get_value(self):
+        """ Takes a new reading, as a number in get_unit() units,
+        or the status of a device that takes no numeric readings """
+
+        value = self.read_value()
+        return self.get_status() if value is None else value
+
+    def format_value(self, value):
+        """ Returns a value from get_value as text, with its unit """
+        return str(value)
+
+    def new_sample(self, value, recorded=None):
+        """ Records a numeric reading in the history and returns it
+
+        Called by read_value implementations for every new reading.
+        :param value: the reading in get_unit() units
+        :param recorded: the reading as the history keeps it and the rules
+                    check it, value if None, see history_values
+        """
+        if recorded is None:
+            recorded = value
+        if self.history is None:
+            self.history = SampleHistory(self.history_size)
+        self.history.append(time.time(), recorded)
+        if self.rules is not None:
+            for rule in self.rules:
+                rule.check(recorded)
+        return value
+
+    def new_samples(self, times, values, recorded=None):
+        """ Records arrays of numeric readings in the history, as new_sample """
+
+        if recorded is None:
+            recorded = values
+        if self.history is None:
+            self.history = SampleHistory(self.history_size)
+        self.history.extend(times, recorded)
+        if self.rules is not None:
+            for rule in self.rules:
+                rule.check_array(recorded)
+
+    def read_burst(self, count, interval=0):
+        """ Takes count numeric readings interval seconds apart
+
+        Devices that can read a whole burst at once override this.
+        Returns (times, values) float64 arrays
+        """
+        times = np.empty(count)
+        values = np.empty(count)
+        next_reading = time.monotonic()
+        for x in range(count):
+            values[x] = self.read_value()
+            times[x] = time.time()
+            next_reading += interval
+            time.sleep(max(0.0, next_reading - time.monotonic()))
+        return times, values
+
+    #   Overriden by devices that take numeric readings
+    def read_value(self):
+        """ Takes a new reading, returns it as a number or None """
+        return None
+
+    def get_unit(self):
+        """ Returns the unit of the numeric readings """
+        return None
+
+    def get_setpoint(self):
+        """ Returns the reading the device is configured to hold, as a
+        number in the units the rules check, None if it has none """
+        return None
+
+    def history_values(self, values):
+        """ Converts an array of readings from the history to get_unit() units
+
+        The history keeps one unit whatever the configuration, so a change
+        of unit never mixes units in it. Devices that record readings in
+        another unit than they report override this.
+        """
+        return values
+
+    def simulate(self, simulator, base, defaults, sim=None):
+        """ Gives the device a channel of simulated readings
+
+        :param simulator: the SensorSimulator, the default one if None
+        :param base: the nominal reading
+        :param defaults: the device type's simulation parameters
+        :param sim: dictionary of simulation parameters overriding defaults
+        """
+        self.simulator = simulator or get_default_simulator()
+        self.channel = self.simulator.add_channel(base, **dict(defaults, **(sim or {})))
+
+    def inject_fault(self, fault, value=None, seconds=None):
+        """ Makes the simulated readings faulty, see hd_sim
+
+        :param fault: STUCK, OFFSET, NOISY, DEAD or CLEAR
+        :param value: the value the fault uses
+        :param seconds: seconds until the fault clears, None to keep it
+        Raises ValueError if the device has no simulated readings or the
+        fault is unknown
+        """
+        if self.simulator is None:
+            raise ValueError("%s has no simulated readings" % self.alias)
+        self.simulator.inject(self.channel, fault, value, seconds)
+        self.invalidate()
+
     def get_config(self):
         pass
 
     def set_config(self, config):
         pass
 
+    def get_state(self):
+        """ Returns the configuration to restore after a restart,
+        as accepted by set_config, None if there is none """
+        return None
+
 
 class HdLed(HdDevice):
     """ Subclass, extends HD_DEVICE
@@ -53,12 +290,28 @@ class HdLed(HdDevice):
     
     """
     def __init__(self, status="OFF", 
-                address="0X01", alias="LED", pin="P8_10"):
+                address="0X01", alias="LED", pin="P8_10", cache_ttl=0, backend=None,
+                history_size=3600):
         """ Subclass constructor """
         
-        HdDevice.__init__(self, status, address, alias)
+        HdDevice.__init__(self, status, address, alias, cache_ttl, backend, history_size)
         self.pin = pin
-        GPIO.setup(self.pin, GPIO.OUT)
+        self.blink_rate = None
+        self.blink_end = None
+        self._blink_gen = 0
+        self._pin_high = False
+        self.backend.setup(self.pin, OUT)
+
+    # @ovveride
+    def get_status(self):
+        """ Returns the status of the LED
+
+        While blinking, the time left on the blink is included.
+        """
+        with self.lock:
+            if self.status == "BLINK":
+                return "BLINK (%.1f seconds remaining)" % self.blink_remaining()
+            return self.status
 
     # @ovveride
     def get_data(self):
@@ -67,7 +320,7 @@ class HdLed(HdDevice):
         As LED has no data, returns the status
         i.e ON/OFF
         """    
-        return self.status
+        return self.get_status()
 
     # @ovveride    
     def get_config(self):
@@ -79,30 +332,92 @@ class HdLed(HdDevice):
 
         return self.status
 
+    # @ovveride
+    def get_state(self):
+        # A blink is not restored, the LED is left OFF as after a blink
+        return "OFF" if self.status == "BLINK" else self.status
+
    # @ovveride
     def set_config(self, config, timeout=60, rate=5):
         """ Sets the status of the LED
         
-        :param config: ON/OFF status of the LED
+        :param config: ON/OFF/BLINK status of the LED
+        :param timeout: seconds to blink for, BLINK only
+        :param rate: seconds between pin changes, BLINK only
         As the LED has no configuration, 
-        sets the status i.e ON/OFF
+        sets the status i.e ON/OFF.
+        Any blink already running is replaced.
+        Raises ValueError for any other config or a bad timeout or rate
         """
-        if config == "ON":
-            GPIO.output(self.pin, GPIO.HIGH)
-        elif config == "OFF":
-            GPIO.output(self.pin, GPIO.LOW)
-        else:
-            self.blink(timeout,rate)
-        self.status = config
+        with self.lock:
+            if config == "ON":
+                self._blink_gen += 1
+                self.backend.output(self.pin, HIGH)
+            elif config == "OFF":
+                self._blink_gen += 1
+                self.backend.output(self.pin, LOW)
+            elif config == "BLINK":
+                self.blink(60 if timeout is None else timeout, 
+                           5 if rate is None else rate)
+            else:
+                raise ValueError("LED config must be ON, OFF or BLINK")
+            self.status = config
 
     def blink(self, timeout, rate):
-        start = time.time()
-        end = start + int(timeout)
-        while time.time() < end:
-            GPIO.output(self.pin, GPIO.HIGH)
-            time.sleep(int(rate))
-            GPIO.output(self.pin, GPIO.LOW)
-            time.sleep(int(rate))
+        """ Arms a blink on the background scheduler and returns at once
+
+        :param timeout: seconds to blink for
+        :param rate: seconds between pin changes
+        Raises ValueError unless rate is from MIN_BLINK_RATE to
+        MAX_BLINK_RATE and timeout from 0 to MAX_BLINK_TIMEOUT, before the
+        current state is touched
+        """
+        try:
+            timeout = float(timeout)
+            rate = float(rate)
+        except (TypeError, ValueError):
+            raise ValueError("BLINK TIMEOUT and RATE must be numbers")
+        # Written so that NaN fails them too
+        if not MIN_BLINK_RATE <= rate <= MAX_BLINK_RATE:
+            raise ValueError("BLINK RATE must be from %s to %s seconds"
+                             % (MIN_BLINK_RATE, MAX_BLINK_RATE))
+        if not 0 <= timeout <= MAX_BLINK_TIMEOUT:
+            raise ValueError("BLINK TIMEOUT must be from 0 to %s seconds" % MAX_BLINK_TIMEOUT)
+
+        with self.lock:
+            # A new generation makes any pending blink step a no-op
+            self._blink_gen += 1
+            now = time.monotonic()
+            self.blink_rate = rate
+            self.blink_end = now + timeout
+            self._pin_high = True
+            self.backend.output(self.pin, HIGH)
+            SCHEDULER.call_at(now + self.blink_rate, self._blink_step, self._blink_gen)
+
+    def blink_remaining(self):
+        """ Returns the seconds left on the current blink, 0 if not blinking """
+
+        with self.lock:
+            if self.status != "BLINK" or self.blink_end is None:
+                return 0
+            return max(0.0, self.blink_end - time.monotonic())
+
+    def _blink_step(self, gen):
+        """ Toggles the pin, returns when the next step is due """
+
+        with self.lock:
+            if gen != self._blink_gen:
+                return None
+            now = time.monotonic()
+            if now >= self.blink_end:
+                self.backend.output(self.pin, LOW)
+                self._pin_high = False
+                self.status = "OFF"
+                self.invalidate()
+                return None
+            self._pin_high = not self._pin_high
+            self.backend.output(self.pin, HIGH if self._pin_high else LOW)
+            return now + self.blink_rate
 
 
 class HdTemp(HdDevice):
@@ -110,18 +425,30 @@ class HdTemp(HdDevice):
 
     Represents a simple Temperature sensing hardware device
     Overrides get_data, get_config and set_config
-    :param temp: current temperature reading
+    :param temp: nominal temperature in Celcius, drawn at random if None
     :param fc: degrees configuration, F = Farenheit, C = Celcius
+    :param simulator: the SensorSimulator of the readings, the default if None
+    :param sim: simulation parameters overriding SIM_DEFAULTS
     
     """
+
+    #   Simulated readings, see hd_sim.CHANNEL_PARAMS
+    SIM_DEFAULTS = {"noise": 0.25, "drift": 0.05, "tau": 300.0, "step_rate": 0.001,
+                    "step_size": 2.0, "resolution": 0.0625}
+
     def __init__(self, status="OFF", address="0X02", 
-                temp=randint(-100, 200), fc="C", 
-                alias="TEMP"):
+                temp=None, fc="C", 
+                alias="TEMP", cache_ttl=0, backend=None, history_size=3600,
+                simulator=None, sim=None):
         """ Subclass constructor """
 
-        HdDevice.__init__(self, status, address, alias)
-        self.temp = temp
+        HdDevice.__init__(self, status, address, alias, cache_ttl, backend, history_size)
         self.fc = fc
+        simulator = simulator or get_default_simulator()
+        if temp is None:
+            temp = float(simulator.rng.uniform(25, 50))
+        self.temp = temp
+        self.simulate(simulator, temp, self.SIM_DEFAULTS, sim)
 
     # @ovveride
     def get_data(self):
@@ -131,19 +458,59 @@ class HdTemp(HdDevice):
         configuration.
         """
 
-        self.temp = randint(-100, 200)  # Fake a new temperature reading
+        return self.format_value(self.read_value())
 
+    # @ovveride
+    def format_value(self, value):
         if self.fc == "F":
-            return str((self.temp * 1.8) + 32) + self.fc
+            return str(value) + self.fc
         else:
-            return str(self.temp) + " " + self.fc
+            return str(value) + " " + self.fc
+
+    # @ovveride
+    def read_value(self):
+        """ Takes a new temperature reading in the configured degrees,
+        the history keeps it in Celcius """
+
+        self.backend.bus_transaction(self.addr)
+        self.temp = self.simulator.read(self.channel)
+
+        if self.fc == "F":
+            return self.new_sample((self.temp * 1.8) + 32, self.temp)
+        return self.new_sample(self.temp)
+
+    # @ovveride
+    def read_burst(self, count, interval=0):
+        """ Takes a burst of simulated temperature readings in one go """
+
+        start = time.time()
+        self.backend.bus_burst(self.addr, count, interval)
+        temps = self.simulator.read_burst(self.channel, count, interval)
+        self.temp = float(temps[-1]) if count else self.temp
+
+        times = start + np.arange(count) * float(interval)
+        values = temps * 1.8 + 32 if self.fc == "F" else temps
+        self.new_samples(times, values, temps)
+        return times, values
+
+    # @ovveride
+    def get_unit(self):
+        return self.fc
+
+    # @ovveride
+    def history_values(self, values):
+        # The history is kept in Celcius
+        return values * 1.8 + 32 if self.fc == "F" else values
 
     # @ovveride
     def set_config(self, fc):
         """ Sets the degree configuration
         
         :param fc: Farenheit or Celcius config option
+        Raises ValueError for anything but F or C
         """
+        if fc not in ("F", "C"):
+            raise ValueError("TEMP config must be F or C")
         self.fc = fc   
 
     # @ovveride
@@ -152,6 +519,10 @@ class HdTemp(HdDevice):
 
         return self.fc
 
+    # @ovveride
+    def get_state(self):
+        return self.fc
+
 
 class HdPower(HdDevice):
     """ Subclass, extends HD_DEVICE
@@ -159,36 +530,95 @@ class HdPower(HdDevice):
     Represents a simple Power control hardware device
     Overrides get_data, get_config and set_config
     :param volts: current voltage reading
+    :param simulator: the SensorSimulator of the readings, the default if None
+    :param sim: simulation parameters overriding SIM_DEFAULTS
     
     """
+
+    #   Simulated readings around the configured voltage, see hd_sim.CHANNEL_PARAMS
+    SIM_DEFAULTS = {"noise": 0.01, "drift": 0.002, "tau": 60.0, "step_rate": 0.0005,
+                    "step_size": 0.05, "resolution": 0.001}
+
     def __init__(self, status="OFF", address="0X03", 
-                volts="5", config="5", alias="POWER"):
+                volts="5", config="5", alias="POWER", cache_ttl=0, backend=None,
+                history_size=3600, simulator=None, sim=None):
         """ Subclass constructor """
 
-        HdDevice.__init__(self, status, address, alias)
+        HdDevice.__init__(self, status, address, alias, cache_ttl, backend, history_size)
         self.volts = volts
-        self.config = config
+        self.config = str(config)
+        self.setpoint = self.parse_setpoint(config)
+        self.simulate(simulator, self.setpoint, self.SIM_DEFAULTS, sim)
 
     # @ovveride
     def get_data(self):
         """ Returns the current voltage """
 
-        #Read a fake voltage reading around the current voltage config
-        volts1 = float(self.config) - 0.2
-        volts2 = float(self.config) + 0.2
-        fake_volts = random.uniform(volts1, volts2)
-        return str(fake_volts) + "V"
+        return self.format_value(self.read_value())
+
+    # @ovveride
+    def format_value(self, value):
+        return str(value) + "V"
+
+    # @ovveride
+    def read_value(self):
+        """ Takes a new voltage reading """
+
+        self.backend.bus_transaction(self.addr)
+        return self.new_sample(self.simulator.read(self.channel))
+
+    # @ovveride
+    def read_burst(self, count, interval=0):
+        """ Takes a burst of simulated voltage readings in one go """
+
+        start = time.time()
+        self.backend.bus_burst(self.addr, count, interval)
+
+        times = start + np.arange(count) * float(interval)
+        values = self.simulator.read_burst(self.channel, count, interval)
+        self.new_samples(times, values)
+        return times, values
+
+    # @ovveride
+    def get_unit(self):
+        return "V"
+
+    # @ovveride
+    def get_setpoint(self):
+        return self.setpoint
+
+    @staticmethod
+    def parse_setpoint(config):
+        """ Returns a voltage setting as a number, checking it is in range """
+
+        try:
+            setpoint = float(config)
+        except (TypeError, ValueError):
+            raise ValueError("POWER config must be a voltage, not %r" % (config,))
+        if not 0 <= setpoint <= MAX_POWER_VOLTS:
+            raise ValueError("POWER config must be from 0 to %sV" % MAX_POWER_VOLTS)
+        return setpoint
 
     # @ovveride
     def set_config(self, config):
         """ Set the voltage to 3.3 or 5
         
-        :param config: voltage setting, 3.3 or 5volts
+        :param config: voltage setting, 3.3 or 5volts, as text or a number
+        Raises ValueError unless it is a number from 0 to MAX_POWER_VOLTS
         """
-        self.config = config
+        setpoint = self.parse_setpoint(config)
+        self.simulator.set_base(self.channel, setpoint)
+        # Parsed once here, the drift rules compare every reading with it
+        self.setpoint = setpoint
+        # Kept as text whether CONFIG was sent as text or as a number
+        self.config = str(config)
 
     # @ovveride
     def get_config(self):
         """ Return the voltage configuration"""
 
-        return self.config + "V"
+        return "%sV" % self.config
+
+    # @ovveride
+    def get_state(self):
+        return self.config
@@ -1,17 +1,20 @@
-from HD_DEVICES import HD_LED, HD_VOLTS, HD_TEMP
+from HD_DEVICES import HdLed, HdPower, HdTemp
+from hd_backend import SimulatedBackend
 
 def main():
 
-    led = HD_LED()
-    volts = HD_VOLTS()
-    temp = HD_TEMP()
+    # Simulated pins, so this runs off the BeagleBone too
+    backend = SimulatedBackend()
+    led = HdLed(backend=backend)
+    volts = HdPower(backend=backend)
+    temp = HdTemp(backend=backend)
 
     print("LED: " + led.get_addr() + " " + led.get_status())
-    print("VOLTS: " + volts.get_addr() + " " + volts.get_status() + " " + volts.get_volts())
-    print("TEMP: " + temp.get_addr() + " " + temp.get_status() + " " + temp.get_temp())
+    print("VOLTS: " + volts.get_addr() + " " + volts.get_status() + " " + volts.get_data())
+    print("TEMP: " + temp.get_addr() + " " + temp.get_status() + " " + temp.get_data())
 
-    volts.set_volts("3.3")
-    print(volts.get_volts())
+    volts.set_config("3.3")
+    print(volts.get_data())
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,178 @@
+'''
+    GPIO/bus backends for the emulated hardware devices
+    BbioBackend drives the BeagleBone pins, importing Adafruit_BBIO only
+    when a pin is first used. SimulatedBackend keeps the pins in memory,
+    records every transition and can add latency to each operation, so
+    the server runs and can be benchmarked on any Linux box.
+
+'''
+
+import time
+import threading
+from collections import deque
+
+
+HIGH = 1
+LOW = 0
+OUT = "out"
+IN = "in"
+
+#   Operations that SimulatedBackend can add latency to
+OPERATIONS = ("setup", "output", "input", "bus")
+
+
+class HdBackend:
+    """ Interface to the pins and bus the devices are attached to """
+
+    #   MUST BE OVERRIDEN
+    def setup(self, pin, direction):
+        """ Sets a pin up as an input (IN) or output (OUT) """
+        pass
+
+    #   MUST BE OVERRIDEN
+    def output(self, pin, value):
+        """ Drives an output pin HIGH or LOW """
+        pass
+
+    #   MUST BE OVERRIDEN
+    def input(self, pin):
+        """ Returns the level of a pin, HIGH or LOW """
+        pass
+
+    #   MUST BE OVERRIDEN
+    def bus_transaction(self, address):
+        """ Performs one bus access to the device at address """
+        pass
+
+    def bus_burst(self, address, count, interval):
+        """ Performs count bus accesses interval seconds apart """
+
+        next_access = time.monotonic()
+        for x in range(count):
+            self.bus_transaction(address)
+            next_access += interval
+            time.sleep(max(0.0, next_access - time.monotonic()))
+
+
+class BbioBackend(HdBackend):
+    """ BeagleBone GPIO through Adafruit_BBIO
+
+    The library is imported on first use, so importing this module or
+    starting a server with no LEDs does not pay for it.
+    """
+
+    def __init__(self):
+        self._gpio = None
+
+    def gpio(self):
+        """ Returns the Adafruit_BBIO.GPIO module, importing it if needed """
+
+        if self._gpio is None:
+            import Adafruit_BBIO.GPIO as GPIO
+            self._gpio = GPIO
+        return self._gpio
+
+    def setup(self, pin, direction):
+        gpio = self.gpio()
+        gpio.setup(pin, gpio.OUT if direction == OUT else gpio.IN)
+
+    def output(self, pin, value):
+        gpio = self.gpio()
+        gpio.output(pin, gpio.HIGH if value == HIGH else gpio.LOW)
+
+    def input(self, pin):
+        return HIGH if self.gpio().input(pin) else LOW
+
+    def bus_transaction(self, address):
+        # The sensors are emulated, there is no bus to access
+        pass
+
+
+class SimulatedBackend(HdBackend):
+    """ In-memory pins that record every transition
+
+    :param latency: seconds added to every operation
+    :param op_latency: dictionary of seconds for individual OPERATIONS,
+                    overriding latency e.g. {"bus": 0.002}
+    :param history: number of transitions kept
+
+    """
+
+    def __init__(self, latency=0, op_latency=None, history=10000):
+        self.latency = {op: float(latency) for op in OPERATIONS}
+        self.latency.update(op_latency or {})
+        self.pins = {}
+        self.directions = {}
+        self.transitions = deque(maxlen=history)
+        self.bus_count = 0
+        self._lock = threading.Lock()
+
+    def wait(self, op):
+        """ Sleeps for the latency of an operation """
+
+        latency = self.latency[op]
+        if latency > 0:
+            time.sleep(latency)
+
+    def setup(self, pin, direction):
+        self.wait("setup")
+        with self._lock:
+            self.directions[pin] = direction
+            self.pins.setdefault(pin, LOW)
+
+    def output(self, pin, value):
+        self.wait("output")
+        with self._lock:
+            if self.directions.get(pin) != OUT:
+                raise RuntimeError("Pin %s is not set up as an output" % pin)
+            if self.pins.get(pin) != value:
+                self.transitions.append((time.time(), pin, value))
+            self.pins[pin] = value
+
+    def input(self, pin):
+        self.wait("input")
+        with self._lock:
+            return self.pins.get(pin, LOW)
+
+    def bus_transaction(self, address):
+        self.wait("bus")
+        with self._lock:
+            self.bus_count += 1
+
+    def bus_burst(self, address, count, interval):
+        # One sleep for the whole burst, paced by the slower of the
+        # requested interval and the bus latency
+        duration = count * max(float(interval), self.latency["bus"])
+        if duration > 0:
+            time.sleep(duration)
+        with self._lock:
+            self.bus_count += count
+
+    def get_transitions(self, pin=None):
+        """ Returns the recorded (timestamp, pin, value) transitions
+
+        :param pin: only return transitions of this pin, all pins if None
+        """
+        with self._lock:
+            return [transition for transition in self.transitions
+                    if pin is None or transition[1] == pin]
+
+
+BACKENDS = {"bbio": BbioBackend, "sim": SimulatedBackend}
+_default_backend = None
+
+
+def set_default_backend(backend):
+    """ Sets the backend given to devices created without one """
+
+    global _default_backend
+    _default_backend = backend
+
+
+def get_default_backend():
+    """ Returns the default backend, BbioBackend unless set otherwise """
+
+    global _default_backend
+    if _default_backend is None:
+        _default_backend = BbioBackend()
+    return _default_backend
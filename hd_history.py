@@ -0,0 +1,110 @@
+'''
+    Per-sensor sample history
+    A fixed-size NumPy ring buffer of (timestamp, value) samples, with
+    time range queries and vectorised min/max/mean downsampling
+
+'''
+
+import threading
+import numpy as np
+
+
+class SampleHistory:
+    """ Ring buffer of the last capacity (timestamp, value) samples
+
+    Memory is allocated once, appending overwrites the oldest sample.
+    Samples are expected in time order, as taken from a device.
+
+    :param capacity: number of samples kept
+
+    """
+
+    def __init__(self, capacity=3600):
+        self.capacity = int(capacity)
+        self.times = np.zeros(self.capacity, dtype=np.float64)
+        self.values = np.zeros(self.capacity, dtype=np.float64)
+        self.count = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, value):
+        """ Adds a sample, overwriting the oldest once the buffer is full """
+
+        with self._lock:
+            self.times[self._next] = timestamp
+            self.values[self._next] = value
+            self._next = (self._next + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+
+    def extend(self, times, values):
+        """ Adds arrays of samples, keeping only the newest capacity of them """
+
+        times = np.asarray(times, dtype=np.float64)[-self.capacity:]
+        values = np.asarray(values, dtype=np.float64)[-self.capacity:]
+        size = len(times)
+        with self._lock:
+            end = self._next + size
+            if end <= self.capacity:
+                self.times[self._next:end] = times
+                self.values[self._next:end] = values
+            else:
+                split = self.capacity - self._next
+                self.times[self._next:] = times[:split]
+                self.values[self._next:] = values[:split]
+                self.times[:size - split] = times[split:]
+                self.values[:size - split] = values[split:]
+            self._next = end % self.capacity
+            self.count = min(self.capacity, self.count + size)
+
+    def query(self, start=None, end=None):
+        """ Returns copies of the samples between start and end
+
+        :param start: earliest timestamp returned, the oldest sample if None
+        :param end: latest timestamp returned, the newest sample if None
+        Returns (times, values) arrays in time order
+        """
+        with self._lock:
+            if self.count < self.capacity:
+                times = self.times[:self.count].copy()
+                values = self.values[:self.count].copy()
+            else:
+                times = np.concatenate((self.times[self._next:], self.times[:self._next]))
+                values = np.concatenate((self.values[self._next:], self.values[:self._next]))
+
+        first = 0 if start is None else np.searchsorted(times, start, side="left")
+        last = len(times) if end is None else np.searchsorted(times, end, side="right")
+        return times[first:last], values[first:last]
+
+
+def downsample(times, values, start, end, buckets):
+    """ Aggregates samples into equal width time buckets
+
+    :param times: sample timestamps in time order, all within start and end
+    :param values: sample values
+    :param start: start of the first bucket
+    :param end: end of the last bucket
+    :param buckets: number of buckets
+    Returns a dictionary of arrays: the START time, COUNT, MIN, MAX and
+    MEAN of each bucket holding at least one sample
+    """
+    edges = np.linspace(start, end, int(buckets) + 1)
+    if len(times) == 0:
+        empty = np.zeros(0)
+        return {"START": empty, "COUNT": empty, "MIN": empty, "MAX": empty, "MEAN": empty}
+
+    # Index of the first sample in each bucket, the last bucket includes end
+    firsts = np.searchsorted(times, edges[:-1], side="left")
+    counts = np.diff(np.append(firsts, len(times)))
+    filled = counts > 0
+    firsts = firsts[filled]
+    counts = counts[filled]
+
+    return {"START": edges[:-1][filled],
+            "COUNT": counts,
+            "MIN": np.minimum.reduceat(values, firsts),
+            "MAX": np.maximum.reduceat(values, firsts),
+            "MEAN": np.add.reduceat(values, firsts) / counts}
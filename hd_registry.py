@@ -0,0 +1,155 @@
+'''
+    Registry of emulated hardware devices
+    Indexes devices by alias and by bus address
+    Devices can be loaded from a JSON configuration file
+
+'''
+
+import json
+from HD_DEVICES import HdLed, HdPower, HdTemp
+
+
+#   Device types accepted in the "type" field of a configuration entry
+DEVICE_TYPES = {"LED": HdLed, "TEMP": HdTemp, "POWER": HdPower}
+
+
+class DeviceRegistryError(Exception):
+    """ Raised for duplicate, unknown or badly configured devices """
+    pass
+
+
+class DeviceRegistry:
+    """ Devices indexed by alias and by address
+
+    Lookups by either key are a single dictionary access, so the cost
+    of finding a device does not grow with the number registered.
+    Addresses are allocated from a counter unless given explicitly.
+    """
+
+    def __init__(self, first_address=1, address_format="0X%02X"):
+        """ Constructor
+
+        :param first_address: the first address number to allocate
+        :param address_format: format string turning a number into an address
+        """
+        self.by_alias = {}
+        self.by_addr = {}
+        self.address_format = address_format
+        self._next_address = first_address
+
+    def __len__(self):
+        return len(self.by_alias)
+
+    def __iter__(self):
+        return iter(list(self.by_alias.values()))
+
+    def __contains__(self, alias):
+        return alias in self.by_alias
+
+    def allocate_address(self):
+        """ Returns the next free address """
+
+        address = self.address_format % self._next_address
+        while address in self.by_addr:
+            self._next_address += 1
+            address = self.address_format % self._next_address
+        self._next_address += 1
+        return address
+
+    def register(self, device, address=None):
+        """ Adds a device to the registry
+
+        :param device: the HdDevice to register
+        :param address: bus address to give the device, allocated if None
+        Returns the address of the device
+        """
+        alias = device.get_alias()
+        if alias in self.by_alias:
+            raise DeviceRegistryError("Device alias %s is already registered" % alias)
+        if address is None:
+            address = self.allocate_address()
+        elif address in self.by_addr:
+            raise DeviceRegistryError("Address %s is already in use by %s"
+                                      % (address, self.by_addr[address].get_alias()))
+
+        device.set_addr(address)
+        self.by_alias[alias] = device
+        self.by_addr[address] = device
+        return address
+
+    def unregister(self, alias):
+        """ Removes a device from the registry, returning it """
+
+        device = self.get(alias)
+        del self.by_alias[alias]
+        del self.by_addr[device.get_addr()]
+        return device
+
+    def move(self, alias, address):
+        """ Gives a registered device a different, unused address """
+
+        device = self.get(alias)
+        if address in self.by_addr and self.by_addr[address] is not device:
+            raise DeviceRegistryError("Address %s is already in use by %s"
+                                      % (address, self.by_addr[address].get_alias()))
+        del self.by_addr[device.get_addr()]
+        device.set_addr(address)
+        self.by_addr[address] = device
+
+    def get(self, alias):
+        """ Returns the device registered under an alias """
+
+        try:
+            return self.by_alias[alias]
+        except KeyError:
+            raise DeviceRegistryError("No device registered as %s" % alias)
+
+    def get_by_addr(self, address):
+        """ Returns the device registered at an address """
+
+        try:
+            return self.by_addr[address]
+        except KeyError:
+            raise DeviceRegistryError("No device registered at address %s" % address)
+
+    def lookup(self):
+        """ Returns a dictionary of alias names and their addresses """
+
+        return {alias: device.get_addr() for alias, device in self.by_alias.items()}
+
+    def load_config(self, config, backend=None):
+        """ Registers the devices described by a configuration dictionary
+
+        :param config: dictionary with a "devices" list, each entry has a
+                    "type" (LED/TEMP/POWER) and optionally an "alias", an
+                    "address", a "count" of copies to make, and any
+                    constructor arguments of the device class.
+                    With a count, aliases are numbered e.g. TEMP_0, TEMP_1
+        :param backend: the HdBackend to attach the devices to, 
+                    the default backend if None
+        """
+        for entry in config.get("devices", []):
+            entry = dict(entry, backend=backend)
+            device_type = entry.pop("type", None)
+            if device_type not in DEVICE_TYPES:
+                raise DeviceRegistryError("Device entry %s has no valid type, accepts: %s"
+                                          % (entry, sorted(DEVICE_TYPES)))
+            device_class = DEVICE_TYPES[device_type]
+
+            address = entry.pop("address", None)
+            count = entry.pop("count", None)
+            if count is None:
+                self.register(device_class(**entry), address)
+                continue
+
+            if address is not None:
+                raise DeviceRegistryError("Device entry with a count cannot set an address")
+            alias = entry.pop("alias", device_type)
+            for x in range(int(count)):
+                self.register(device_class(alias="%s_%d" % (alias, x), **entry))
+
+    def load_file(self, path, backend=None):
+        """ Registers the devices described in a JSON configuration file """
+
+        with open(path) as config_file:
+            self.load_config(json.load(config_file), backend)
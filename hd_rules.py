@@ -0,0 +1,273 @@
+'''
+    Interlock and alarm rules evaluated on device readings
+    Rules are checked by the device itself on every new sample, so an
+    interlock reacts to the reading that trips it rather than to the next
+    client poll. Rules are loaded from a JSON file such as
+
+        {"rules": [
+            {"name": "power_low", "device": "POWER", "below": 4.7, "samples": 3,
+             "then": [{"device": "LED", "config": "BLINK", "timeout": 10}],
+             "notify": true},
+            {"name": "rail_drift", "device": "RAIL_*", "drift": 0.2, "notify": true},
+            {"name": "asic_hot", "device": "ASIC_TEMP_*", "above": 85}
+        ]}
+
+    A rule trips when a reading is "below" or "above" a limit, or has
+    "drift"ed further than that from the device's setpoint (the POWER
+    configuration). Limits are in the unit the device records its history
+    in, Celcius for a TEMP whatever its CONFIG, so changing the unit a
+    device reports in never moves an interlock. It fires once it has
+    tripped on "samples" readings in a row, and again only after a
+    reading that does not trip it. "device" may be a glob, each matching
+    device gets its own copy of the rule.
+
+    Checks run on the device's thread, under its lock. The "then" CONFIG
+    actions and notifications of a fired rule run on the device scheduler
+    thread, so a rule never waits on another device's lock.
+
+'''
+
+import json
+import time
+import fnmatch
+import operator
+import functools
+import numpy as np
+from HD_DEVICES import SCHEDULER
+
+
+class RuleError(Exception):
+    """ Raised for badly configured rules """
+    pass
+
+
+def rule_number(spec, name, whole=False):
+    """ Returns a numeric setting of a rule
+
+    :param spec: the rule's configuration entry
+    :param name: the setting, e.g. "above"
+    :param whole: whether only whole numbers are accepted
+    Raises RuleError if it is not a number
+    """
+    value = spec[name]
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = None
+    if isinstance(value, bool) or number is None or number != number \
+            or (whole and not number.is_integer()):
+        raise RuleError("Rule %s: %s must be %s, not %r" % (
+            spec.get("name"), name, "a whole number" if whole else "a number", value))
+    return int(number) if whole else number
+
+
+def compile_test(spec, device):
+    """ Returns the test of a rule, a function of a reading or an array
+    of readings that is true where the rule trips
+
+    :param spec: the rule's configuration entry
+    :param device: the HdDevice the rule is checked on
+    Raises RuleError if a limit is not a number
+    """
+    tests = []
+    if "below" in spec:
+        low = rule_number(spec, "below")
+        tests.append(lambda value: value < low)
+    if "above" in spec:
+        high = rule_number(spec, "above")
+        tests.append(lambda value: value > high)
+    if "drift" in spec:
+        if device.get_setpoint() is None:
+            raise RuleError("Rule %s: %s has no setpoint to drift from"
+                            % (spec.get("name"), device.get_alias()))
+        band = rule_number(spec, "drift")
+        # get_setpoint returns the number parsed when the device was configured
+        tests.append(lambda value: abs(value - device.get_setpoint()) > band)
+
+    if not tests:
+        raise RuleError("Rule %s has no below, above or drift limit" % spec.get("name"))
+    if len(tests) == 1:
+        return tests[0]
+    return lambda value: functools.reduce(operator.or_, [test(value) for test in tests])
+
+
+class Rule:
+    """ One rule checked on the samples of one device
+
+    :param name: the rule name
+    :param device: the HdDevice it is checked on
+    :param test: function of a reading, true when the rule trips
+    :param samples: readings in a row that must trip it before it fires
+    :param actions: list of {"device", "config", "timeout", "rate"} CONFIG
+                    actions run when it fires
+    :param notify: whether firing is reported by the engine's notify
+    :param engine: the RuleEngine that runs its actions
+
+    """
+
+    def __init__(self, name, device, test, samples=1, actions=(), notify=False, engine=None):
+        self.name = name
+        self.device = device
+        self.test = test
+        self.samples = int(samples)
+        self.actions = list(actions)
+        self.notify = notify
+        self.engine = engine
+        self.streak = 0
+        self.hits = 0
+        self.last_fired = None
+        self.last_value = None
+        self.error = None
+
+    def check(self, value):
+        """ Checks a new reading, fires the rule if it completes a streak """
+
+        if self.test(value):
+            self.streak += 1
+            if self.streak == self.samples:
+                self.fire(value)
+        else:
+            self.streak = 0
+
+    def check_array(self, values):
+        """ Checks a burst of readings at once, as check would one by one
+
+        The rule fires once however many streaks the burst completes,
+        while every streak is counted as a hit.
+        """
+        trips = np.asarray(self.test(values), dtype=np.int8)
+        if not len(trips):
+            return
+
+        # Runs of tripping readings, the first continuing the current streak
+        edges = np.diff(np.concatenate(([0], trips, [0])))
+        starts = np.flatnonzero(edges == 1)
+        lengths = np.flatnonzero(edges == -1) - starts
+        carried = self.streak if len(starts) and starts[0] == 0 else 0
+        if carried:
+            lengths[0] += carried
+        fires = lengths >= self.samples
+        if carried >= self.samples:
+            fires[0] = False
+        self.streak = int(lengths[-1]) if trips[-1] else 0
+
+        fired = np.flatnonzero(fires)
+        if len(fired):
+            run = fired[-1]
+            index = starts[run] + self.samples - 1 - (carried if run == 0 else 0)
+            self.fire(float(values[index]), len(fired))
+
+    def fire(self, value, hits=1):
+        """ Counts a hit and hands the actions to the engine """
+
+        self.hits += hits
+        self.last_fired = time.time()
+        self.last_value = value
+        if self.engine is not None and (self.actions or self.notify):
+            self.engine.dispatch(self, value)
+
+    def snapshot(self):
+        """ Returns the rule's counters as reply parameters """
+
+        return {"RULE": self.name, "DEVICE": self.device.get_alias(), "HITS": self.hits,
+                "STREAK": self.streak, "LAST_FIRED": self.last_fired,
+                "LAST_VALUE": self.last_value, "ERROR": self.error}
+
+
+class RuleEngine:
+    """ Compiles rules onto the devices of a registry and runs their actions
+
+    :param registry: the DeviceRegistry the rules apply to
+    :param apply: function(alias, params) running a CONFIG action, params
+                holding CONFIG, TIMEOUT and RATE; sets the device directly
+                if None
+    :param notify: function(rule, value) called when a rule with notify
+                set fires
+
+    """
+
+    def __init__(self, registry, apply=None, notify=None):
+        self.registry = registry
+        self.apply = apply or self.set_config
+        self.notify = notify
+        self.specs = []
+        self.rules = []
+
+    def load_config(self, config):
+        """ Compiles the rules of a configuration dictionary onto the devices
+
+        :param config: dictionary with a "rules" list, see the module
+        Raises RuleError if a rule is malformed or matches no device
+        """
+        for spec in config.get("rules", []):
+            if "name" not in spec or "device" not in spec:
+                raise RuleError("Rule %s needs a name and a device" % spec)
+            for action in spec.get("then", []):
+                if "device" not in action or "config" not in action:
+                    raise RuleError("Rule %s: actions need a device and a config"
+                                    % spec["name"])
+            matched = [device for device in self.registry
+                       if fnmatch.fnmatchcase(device.get_alias(), spec["device"])]
+            if not matched:
+                raise RuleError("Rule %s matches no device %s" % (spec["name"], spec["device"]))
+            self.specs.append(spec)
+            for device in matched:
+                self.add_rule(spec, device)
+
+    def load_file(self, path):
+        """ Compiles the rules of a JSON rules file onto the devices """
+
+        with open(path) as rules_file:
+            self.load_config(json.load(rules_file))
+
+    def add_rule(self, spec, device):
+        """ Compiles one rule onto one device """
+
+        samples = rule_number(spec, "samples", whole=True) if "samples" in spec else 1
+        rule = Rule(spec["name"], device, compile_test(spec, device), samples,
+                    spec.get("then", []), spec.get("notify", False), self)
+        if rule.samples < 1:
+            raise RuleError("Rule %s: samples must be at least 1" % rule.name)
+        self.rules.append(rule)
+        # Replaced rather than appended to, new_sample may be iterating it
+        device.rules = (device.rules or ()) + (rule,)
+
+    def attach(self, device):
+        """ Compiles the loaded rules matching a newly registered device """
+
+        for spec in self.specs:
+            if fnmatch.fnmatchcase(device.get_alias(), spec["device"]):
+                self.add_rule(spec, device)
+
+    def dispatch(self, rule, value):
+        """ Runs a fired rule's actions on the scheduler thread """
+        SCHEDULER.call_at(time.monotonic(), self.run_actions, rule, value)
+
+    def run_actions(self, rule, value):
+        """ Applies a fired rule's CONFIG actions and notifies """
+
+        rule.error = None
+        for action in rule.actions:
+            try:
+                self.apply(action["device"], {"CONFIG": action["config"],
+                                              "TIMEOUT": action.get("timeout"),
+                                              "RATE": action.get("rate")})
+            except Exception as err:
+                rule.error = "%s: %s" % (action["device"], err)
+        if rule.notify and self.notify is not None:
+            self.notify(rule, value)
+
+    def set_config(self, alias, params):
+        """ Configures a device directly, the default apply """
+
+        device = self.registry.get(alias)
+        with device.lock:
+            if params["CONFIG"] == "BLINK":
+                device.set_config("BLINK", params["TIMEOUT"], params["RATE"])
+            else:
+                device.set_config(params["CONFIG"])
+            device.invalidate()
+
+    def snapshot(self):
+        """ Returns the counters of every rule """
+        return [rule.snapshot() for rule in self.rules]
@@ -0,0 +1,267 @@
+'''
+    Simulated sensor readings for the emulated devices
+    Every simulated sensor is a channel of one SensorSimulator, whose
+    state is held in NumPy arrays and advanced for all channels at once,
+    so thousands of TEMP/POWER devices cost one vectorised update per
+    sample clock tick rather than one random number per device read.
+
+    A channel reads base + offset + noise, where the offset wanders with
+    a mean reverting drift and jumps by occasional step changes. Faults
+    can be injected into a channel:
+        STUCK   the reading no longer changes
+        OFFSET  value is added to the reading
+        NOISY   the noise is multiplied by value
+        DEAD    the channel reads value
+        CLEAR   removes the fault
+
+    Readings come from a seeded generator: the same seed and the same
+    sequence of advance(now) times give the same readings. Driven by the
+    wall clock, the sample times, and so the readings, vary run to run;
+    driven by a TickClock, every read is one period after the last, so
+    the same seed and the same reads give the same readings.
+
+'''
+
+import time
+import threading
+import numpy as np
+
+
+FAULTS = {"CLEAR": 0, "STUCK": 1, "OFFSET": 2, "NOISY": 3, "DEAD": 4}
+
+#   Value a fault uses when none is given, None if one must be
+FAULT_DEFAULTS = {"CLEAR": 0.0, "STUCK": 0.0, "OFFSET": None, "NOISY": 10.0, "DEAD": 0.0}
+
+#   Channel parameters and their defaults
+CHANNEL_PARAMS = {"noise": 0.0, "drift": 0.0, "tau": 60.0, "step_rate": 0.0,
+                  "step_size": 0.0, "resolution": 0.0}
+
+#   Per channel arrays, with the fill value and dtype of unused entries
+ARRAYS = [("base", 0.0, np.float64), ("offset", 0.0, np.float64),
+          ("values", 0.0, np.float64), ("fault", 0, np.int8),
+          ("fault_value", 0.0, np.float64), ("fault_until", np.inf, np.float64)] + \
+         [(name, default, np.float64) for name, default in CHANNEL_PARAMS.items()]
+
+
+class TickClock:
+    """ A clock that moves on by one period each time it is read
+
+    :param period: seconds added by each call
+    """
+
+    def __init__(self, period=0.01):
+        self.period = float(period)
+        self.time = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.time += self.period
+            return self.time
+
+
+class SensorSimulator:
+    """ The readings of many simulated sensors
+
+    :param seed: seed of the random generator, None for a random seed
+    :param period: seconds of the sample clock, reads within one period
+                of the last advance share its readings
+    :param clock: function returning the time in seconds, time.monotonic
+                if None
+
+    """
+
+    def __init__(self, seed=None, period=0.01, clock=None):
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.period = float(period)
+        self.clock = clock or time.monotonic
+        self.time = self.clock()
+        # Set when a channel changed, so the next read advances at once
+        self.stale = False
+        self.size = 0
+        self.lock = threading.Lock()
+        self._allocate(64)
+
+    def _allocate(self, capacity):
+        """ Grows the channel arrays to capacity, keeping the channels """
+
+        for name, fill, dtype in ARRAYS:
+            grown = np.full(capacity, fill, dtype=dtype)
+            if self.size:
+                grown[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, grown)
+        self.capacity = capacity
+
+    def add_channel(self, base, **params):
+        """ Adds a sensor reading around base
+
+        :param base: the nominal reading
+        :param params: any of CHANNEL_PARAMS, noise (standard deviation of
+                    each reading), drift (of the offset per root second),
+                    tau (seconds for the offset to fall back by 1/e),
+                    step_rate (steps per second), step_size (standard
+                    deviation of a step) and resolution (of the readings)
+        Returns the channel index
+        """
+        unknown = set(params) - set(CHANNEL_PARAMS)
+        if unknown:
+            raise ValueError("Unknown simulation parameters %s, accepts: %s"
+                             % (sorted(unknown), sorted(CHANNEL_PARAMS)))
+        with self.lock:
+            if self.size == self.capacity:
+                self._allocate(self.capacity * 2)
+            index = self.size
+            self.size += 1
+            self.base[index] = base
+            for name, default in CHANNEL_PARAMS.items():
+                getattr(self, name)[index] = params.get(name, default)
+            self.values[index] = self.quantise(base, self.resolution[index])
+            return index
+
+    def set_base(self, index, base):
+        """ Moves the nominal reading of a channel, e.g. a new POWER setting """
+
+        with self.lock:
+            self.base[index] = base
+            self.offset[index] = 0.0
+            self.values[index] = self.quantise(base, self.resolution[index])
+
+    def inject(self, index, fault, value=None, seconds=None):
+        """ Injects a fault into a channel
+
+        :param fault: one of FAULTS
+        :param value: the value the fault uses, see the module
+        :param seconds: seconds until the fault clears, None to keep it
+        Raises ValueError for an unknown fault or a bad value or seconds,
+        leaving the channel as it was
+        """
+        if not isinstance(fault, str) or fault not in FAULTS:
+            raise ValueError("Unknown fault %s, accepts: %s" % (fault, sorted(FAULTS)))
+        if value is None:
+            value = FAULT_DEFAULTS[fault]
+            if value is None:
+                raise ValueError("A %s fault needs a value" % fault)
+        # Converted before any array is written, so a bad fault changes nothing
+        try:
+            value = float(value)
+            seconds = np.inf if seconds is None else float(seconds)
+        except TypeError:
+            raise ValueError("A fault value and seconds must be numbers, not %r and %r"
+                             % (value, seconds))
+        if not np.isfinite(value):
+            raise ValueError("A fault value must be finite, not %s" % value)
+        if not seconds >= 0:
+            raise ValueError("A fault must last zero seconds or more, not %s" % seconds)
+        with self.lock:
+            self.fault[index] = FAULTS[fault]
+            self.fault_value[index] = value
+            self.fault_until[index] = self.clock() + seconds
+            self.stale = True
+
+    def advance(self, now=None):
+        """ Takes a new reading of every channel at time now """
+
+        with self.lock:
+            self._advance(self.clock() if now is None else now)
+
+    def _advance(self, now):
+        size = self.size
+        dt = max(0.0, now - self.time)
+        self.time = now
+        self.stale = False
+        rng = self.rng
+
+        # One draw for the drift and noise of every channel
+        normal = rng.standard_normal(2 * size)
+        offset = self.offset[:size]
+        offset *= np.exp(-dt / self.tau[:size])
+        offset += self.drift[:size] * np.sqrt(dt) * normal[:size]
+        steps = np.flatnonzero(rng.random(size) < -np.expm1(-self.step_rate[:size] * dt))
+        if len(steps):
+            offset[steps] += self.step_size[steps] * rng.standard_normal(len(steps))
+
+        noise = self.noise[:size] * normal[size:]
+        values = self.base[:size] + offset + noise
+
+        fault = self.fault[:size]
+        if fault.any():
+            fault[self.fault_until[:size] <= now] = FAULTS["CLEAR"]
+            fault_value = self.fault_value[:size]
+            values = np.where(fault == FAULTS["STUCK"], self.values[:size], values)
+            values += np.where(fault == FAULTS["OFFSET"], fault_value, 0.0)
+            values += np.where(fault == FAULTS["NOISY"], noise * (fault_value - 1), 0.0)
+            values = np.where(fault == FAULTS["DEAD"], fault_value, values)
+
+        self.values[:size] = self.quantise(values, self.resolution[:size])
+
+    @staticmethod
+    def quantise(values, resolution):
+        """ Rounds readings to their resolution, where it is set """
+        step = np.where(resolution > 0, resolution, 1.0)
+        # Dividing by the inverse keeps decimal resolutions exact, 3300 / 1000.0 == 3.3
+        return np.where(resolution > 0, np.round(values / step) / (1.0 / step), values)
+
+    def read(self, index):
+        """ Returns the reading of a channel, advancing every channel first
+        if a sample clock period has passed or a channel was changed """
+
+        with self.lock:
+            now = self.clock()
+            if self.stale or now - self.time >= self.period:
+                self._advance(now)
+            return float(self.values[index])
+
+    def read_burst(self, index, count, interval=0):
+        """ Returns count readings of one channel, interval seconds apart
+
+        The offset drifts and steps over the burst as it would between
+        single reads, leaving out its fall back towards base, which is
+        slow next to a burst.
+        """
+        with self.lock:
+            rng = self.rng
+            dt = float(interval)
+            walk = self.drift[index] * np.sqrt(dt) * rng.standard_normal(count)
+            steps = rng.random(count) < -np.expm1(-self.step_rate[index] * dt)
+            walk += np.where(steps, self.step_size[index] * rng.standard_normal(count), 0.0)
+            offsets = self.offset[index] + np.cumsum(walk)
+            noise = self.noise[index] * rng.standard_normal(count)
+            values = self.base[index] + offsets + noise
+
+            fault = self.fault[index]
+            if fault and self.fault_until[index] <= self.clock():
+                fault = self.fault[index] = FAULTS["CLEAR"]
+            if fault == FAULTS["STUCK"]:
+                values[:] = self.values[index]
+            elif fault == FAULTS["OFFSET"]:
+                values += self.fault_value[index]
+            elif fault == FAULTS["NOISY"]:
+                values += noise * (self.fault_value[index] - 1)
+            elif fault == FAULTS["DEAD"]:
+                values[:] = self.fault_value[index]
+
+            values = self.quantise(values, self.resolution[index])
+            if count:
+                self.offset[index] = offsets[-1]
+                self.values[index] = values[-1]
+            return values
+
+
+_default_simulator = None
+
+
+def set_default_simulator(simulator):
+    """ Sets the simulator given to devices created without one """
+
+    global _default_simulator
+    _default_simulator = simulator
+
+
+def get_default_simulator():
+    """ Returns the default simulator, randomly seeded unless set otherwise """
+
+    global _default_simulator
+    if _default_simulator is None:
+        _default_simulator = SensorSimulator()
+    return _default_simulator
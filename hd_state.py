@@ -0,0 +1,122 @@
+'''
+    Persistent device state
+    Keeps the address and configuration of every device in a snapshot
+    file so a restarted server comes back as it was left, without the
+    control system pushing every CONFIG again
+
+    Changes are appended to a journal next to the snapshot as one JSON
+    line each, by a background thread, and the journal is folded into a
+    new snapshot every compact_every changes. Snapshots are written to a
+    temporary file and renamed over the old one, so a crash leaves either
+    the old or the new snapshot, and a torn last journal line is ignored.
+
+'''
+
+import os
+import json
+import queue
+import atexit
+import threading
+
+
+class StateStore:
+    """ Snapshot and journal of device states, keyed by alias
+
+    Each state is {"address": ..., "config": ...}, config being what the
+    device's set_config accepts.
+
+    :param path: the snapshot file, the journal is path + ".journal"
+    :param compact_every: journal entries written before a new snapshot
+
+    """
+
+    def __init__(self, path, compact_every=1000):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.compact_every = compact_every
+        self.states = {}
+        self.changes = queue.Queue()
+        self._journal = None
+        self._journalled = 0
+        self._thread = None
+
+    def load(self):
+        """ Reads the snapshot and replays the journal over it
+
+        Returns the dictionary of states by alias, empty if there is no
+        snapshot yet
+        """
+        states = {}
+        if os.path.exists(self.path):
+            with open(self.path) as snapshot:
+                states = json.load(snapshot).get("devices", {})
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as journal:
+                for line in journal:
+                    try:
+                        alias, state = json.loads(line)
+                    except ValueError:
+                        break
+                    states[alias] = state
+        self.states = states
+        return dict(states)
+
+    def start(self):
+        """ Writes a fresh snapshot and starts journalling changes """
+
+        self.write_snapshot()
+        self._journal = open(self.journal_path, "w")
+        self._thread = threading.Thread(target=self.run, name="StateStore", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, alias, address, config):
+        """ Queues the new state of a device to be saved """
+        self.changes.put((alias, {"address": address, "config": config}))
+
+    def write_snapshot(self):
+        """ Atomically replaces the snapshot with the current states """
+
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as snapshot:
+            json.dump({"version": 1, "devices": self.states}, snapshot,
+                      separators=(",", ":"))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temp_path, self.path)
+
+    def run(self):
+        """ Journalling loop, writes queued changes in batches """
+
+        while True:
+            changes = [self.changes.get()]
+            while not self.changes.empty():
+                changes.append(self.changes.get())
+
+            stop = None in changes
+            for change in changes:
+                if change is None:
+                    continue
+                alias, state = change
+                self.states[alias] = state
+                self._journal.write(json.dumps([alias, state], separators=(",", ":")) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journalled += len(changes)
+
+            if stop or self._journalled >= self.compact_every:
+                self.write_snapshot()
+                self._journal.seek(0)
+                self._journal.truncate()
+                self._journalled = 0
+            if stop:
+                self._journal.close()
+                return
+
+    def close(self):
+        """ Saves every queued change and writes a final snapshot """
+
+        if self._thread is not None and self._thread.is_alive():
+            self.changes.put(None)
+            self._thread.join()
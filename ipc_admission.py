@@ -0,0 +1,80 @@
+'''
+    Admission control for ipc_server
+    Requests can be turned away before they reach a device: a client
+    over its token bucket rate or a full queue gets a BUSY reply at once,
+    and a request whose DEADLINE has passed is not run at all, since its
+    client has already given up on it.
+
+'''
+
+import time
+
+
+#   Reasons a request is rejected, counted by RequestMetrics
+RATE_LIMITED = "rate_limited"
+QUEUE_FULL = "queue_full"
+EXPIRED = "expired"
+
+
+class RequestRejected(Exception):
+    """ A request turned away before it ran
+
+    :param reason: RATE_LIMITED, QUEUE_FULL or EXPIRED
+    :param message: the error reported to the client
+    :param retry_after: seconds until the client may try again, if known
+    """
+
+    def __init__(self, reason, message, retry_after=None):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """ Token bucket rate limit per client
+
+    :param rate: requests per second each client may sustain, 0 for no limit
+    :param burst: requests a client may send at once, rate if None
+
+    """
+
+    #   Buckets kept before those of idle clients are forgotten
+    MAX_CLIENTS = 4096
+
+    def __init__(self, rate=0, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(self.rate, 1))
+        self.buckets = {}
+
+    def acquire(self, client):
+        """ Takes a token from a client's bucket
+
+        :param client: the client identity
+        Returns 0 if the request may go ahead, otherwise the seconds until
+        the client has a token again
+        """
+        if not self.rate:
+            return 0.0
+
+        now = time.monotonic()
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_CLIENTS:
+                self.purge(now)
+            # [tokens, time of last refill]
+            bucket = self.buckets[client] = [self.burst, now]
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        bucket[0] = tokens
+        return (1 - tokens) / self.rate
+
+    def purge(self, now):
+        """ Forgets clients whose buckets have had time to refill """
+
+        refill = self.burst / self.rate
+        self.buckets = {client: bucket for client, bucket in self.buckets.items()
+                        if now - bucket[1] < refill}
@@ -0,0 +1,209 @@
+'''
+    Asyncio client.
+    Communicates with a single ipc_server
+    Keeps many requests in flight on one DEALER socket, matching each
+    reply to its request by the MSG_ID the server echoes back
+
+'''
+
+import time
+import asyncio
+import argparse
+import itertools
+from random import randint
+import zmq
+import zmq.asyncio
+from odin_data.ipc_message import IpcMessage, IpcMessageException
+from ipc_codec import CODECS, get_codec, detect_codec, unpack_arrays
+from ipc_transport import connect_endpoint, make_url
+from ipc_client import describe_reply
+
+
+class AsyncIpcClient:
+    """ Pipelining client, e.g. reply = await client.read("TEMP")
+
+    :param url: Remote server url i.e tcp://localhost or ipc:///tmp/femii.sock
+    :param port: Port of a tcp server, None if url names the endpoint in full
+    :param window: Maximum number of requests in flight at once
+    :param timeout: Seconds to wait for each reply before giving up
+    :param codec: Wire encoding, json or msgpack
+
+    """
+
+    def __init__(self, url, port, window=16, timeout=5.0, codec="json"):
+        ident = str(randint(0, 100000))
+        self.identity = "Client %s" % ident
+        self.url = make_url(url, port)
+        self.context = zmq.asyncio.Context()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.IDENTITY, self.identity.encode())
+        self.timeout = timeout
+        self.codec = get_codec(codec)
+        self.window = asyncio.Semaphore(window)
+        self.pending = {}
+        self._msg_ids = itertools.count(1)
+        self._receiver = None
+
+    async def __aenter__(self):
+        self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        """ Connect the socket """
+        connect_endpoint(self.socket, self.url)
+
+    def close(self):
+        """ Stop receiving replies and close the socket """
+
+        if self._receiver is not None:
+            self._receiver.cancel()
+            self._receiver = None
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.socket.close()
+
+    async def _receive_replies(self):
+        """ Resolves the future waiting on each reply as it arrives
+
+        Replies to requests that have already timed out are dropped.
+        """
+        while True:
+            r_address, reply, *frames = await self.socket.recv_multipart()
+            try:
+                reply = detect_codec(reply).decode(reply)
+                if frames:
+                    unpack_arrays(reply.attrs.get("params", {}), frames)
+                future = self.pending.pop(reply.get_param("MSG_ID"), None)
+            except IpcMessageException:
+                continue
+            if future is not None and not future.done():
+                future.set_result(reply)
+
+    async def request(self, msg_val, device=None, timeout=None, **params):
+        """ Sends a request and waits for its reply
+
+        :param msg_val: The value of the request i.e STATUS/CONFIG/READ
+        :param device: The device alias name
+        :param timeout: Seconds to wait for the reply, the client default if None
+        :param params: Any further request parameters e.g CONFIG="ON"
+        Returns the reply IPC Message, raises IpcMessageException if the
+        server reported an error and asyncio.TimeoutError on timeout.
+        The request carries a DEADLINE so the server does not run it
+        after this client has given up; a BUSY error means retry later.
+
+        """
+        if self._receiver is None:
+            self._receiver = asyncio.ensure_future(self._receive_replies())
+
+        timeout = self.timeout if timeout is None else timeout
+        async with self.window:
+            msg_id = next(self._msg_ids)
+            request = IpcMessage("CMD", msg_val)
+            request.set_param("MSG_ID", msg_id)
+            request.set_param("DEADLINE", time.time() + timeout)
+            if device is not None:
+                request.set_param("DEVICE", device)
+            for name, value in params.items():
+                request.set_param(name, value)
+
+            request = self.codec.encode(request)
+
+            future = asyncio.get_running_loop().create_future()
+            self.pending[msg_id] = future
+            try:
+                await self.socket.send(request)
+                reply = await asyncio.wait_for(future, timeout)
+            finally:
+                self.pending.pop(msg_id, None)
+
+        try:
+            error = reply.get_param("ERROR")
+        except IpcMessageException:
+            return reply
+        raise IpcMessageException(error)
+
+    async def read(self, device, **params):
+        """ Reads the current value of a device """
+        return await self.request("READ", device, **params)
+
+    async def status(self, device, **params):
+        """ Reads the status of a device """
+        return await self.request("STATUS", device, **params)
+
+    async def config(self, device, config, **params):
+        """ Configures a device, BLINK takes TIMEOUT and RATE params """
+        return await self.request("CONFIG", device, CONFIG=config, **params)
+
+    async def burst(self, device, count, interval=0, **params):
+        """ Takes count readings of a device interval seconds apart
+
+        The reply's TIMES and VALUES parameters are NumPy arrays
+        """
+        return await self.request("READ", device, COUNT=count, INTERVAL=interval, **params)
+
+    async def history(self, device, start=None, end=None, buckets=None, **params):
+        """ Reads a device's sample history between start and end
+
+        :param buckets: downsample into this many min/max/mean buckets
+        """
+        for name, value in (("START", start), ("END", end), ("BUCKETS", buckets)):
+            if value is not None:
+                params[name] = value
+        return await self.request("READ_HISTORY", device, **params)
+
+    async def stats(self, **params):
+        """ Reads the server's request metrics """
+        return await self.request("STATS", **params)
+
+    async def batch(self, entries, **params):
+        """ Runs an ordered list of (device, msg_val, config) tuples in one request """
+        return await self.request("BATCH", BATCH=[{"DEVICE": device, "OP": op, "CONFIG": config}
+                                                  for device, op, config in entries], **params)
+
+
+async def run_reads(url, port, device, count, window, timeout, codec):
+    """ Sends count concurrent READs to a device, printing each reply """
+
+    async with AsyncIpcClient(url, port, window, timeout, codec) as client:
+        start = time.perf_counter()
+        replies = await asyncio.gather(*[client.read(device) for x in range(count)],
+                                       return_exceptions=True)
+        elapsed = time.perf_counter() - start
+
+    for reply in replies:
+        if isinstance(reply, Exception):
+            print("Request failed: %r" % reply)
+        else:
+            print("Received Response: %s" % describe_reply(reply.attrs.get("params", {})))
+    print("%d requests in %.3f seconds" % (count, elapsed))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-url", "--url", help="Remote server url, \
+                        default = tcp://localhost", default="tcp://localhost")
+    parser.add_argument("-port", "--port", help="Port connection, default = 5555",
+                        default="5555")
+    parser.add_argument("-device", "--device", help="Target device, default = TEMP",
+                        default="TEMP")
+    parser.add_argument("-count", "--count", type=int, default=10,
+                        help="Number of READs to send, default = 10")
+    parser.add_argument("-window", "--window", type=int, default=16,
+                        help="Maximum requests in flight, default = 16")
+    parser.add_argument("-timeout", "--timeout", type=float, default=5.0,
+                        help="Seconds to wait for each reply, default = 5")
+    parser.add_argument("-codec", "--codec", choices=sorted(CODECS), default="json",
+                        help="Wire encoding, default = json")
+    args = parser.parse_args()
+
+    asyncio.run(run_reads(args.url, args.port, args.device, args.count, 
+                          args.window, args.timeout, args.codec))
+
+
+if __name__ == "__main__":
+    main()
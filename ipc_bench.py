@@ -0,0 +1,389 @@
+'''
+    Benchmarks for ipc_server
+    Starts an IpcServer in this process and drives it with DEALER clients
+    Results are printed as one JSON object per line
+
+    workers - READ throughput against the number of server worker threads
+    codec   - decode + dispatch + encode time per message for each codec
+    load    - M concurrent IpcClients sending a STATUS/READ/CONFIG mix,
+              reporting throughput and latency percentiles and histogram
+    transport - round-trip latency over tcp, ipc and inproc endpoints
+                of one server
+
+'''
+
+import zmq
+import math
+import time
+import json
+import random
+import os.path
+import argparse
+import tempfile
+import threading
+from odin_data.ipc_message import IpcMessage
+from HD_DEVICES import HdLed, HdPower, HdTemp
+from hd_backend import SimulatedBackend
+from hd_registry import DeviceRegistry
+from ipc_codec import CODECS, get_codec, detect_codec, get_optional_param
+from ipc_client import IpcClient
+from ipc_server import IpcServer
+
+
+#   Valid CONFIG values for each device type, used by the load mix
+CONFIG_OPTIONS = {HdLed: ["ON", "OFF"], HdTemp: ["C", "F"], HdPower: ["5", "3.3"]}
+
+
+def start_server(port, workers=0, device_latency=0, config=None, endpoints=None):
+    """ Starts an IpcServer on a background thread
+
+    :param port: the tcp port to bind
+    :param workers: number of worker threads, 0 serves on one thread
+    :param device_latency: seconds added to each simulated pin and bus operation
+    :param config: device configuration file, None for the default devices
+    :param endpoints: endpoints to bind instead of tcp on port
+    Returns the running server
+    """
+    server = IpcServer(port, config, SimulatedBackend(device_latency), endpoints)
+    server.make_lookup()
+    server.bind()
+
+    if workers > 0:
+        thread = threading.Thread(target=server.run_workers, args=(workers,), daemon=True)
+    else:
+        thread = threading.Thread(target=server.run_rep, daemon=True)
+    thread.start()
+    return server
+
+
+def encode_request(msg_val, device, codec="json"):
+    """ Returns an encoded request for a device """
+
+    request = IpcMessage("CMD", msg_val)
+    request.set_param("DEVICE", device)
+    return get_codec(codec).encode(request)
+
+
+def drive(context, url, device, count, window, ident):
+    """ Sends count READs to one device keeping window requests in flight
+
+    :param context: the zmq context to create the client socket in
+    :param url: the server url
+    :param device: the alias of the device to read
+    :param count: number of requests to send
+    :param window: maximum requests in flight at once
+    :param ident: the client identity, the server decodes it as text
+    """
+    socket = context.socket(zmq.DEALER)
+    socket.setsockopt(zmq.IDENTITY, ident.encode())
+    socket.connect(url)
+    request = encode_request("READ", device)
+    sent = 0
+    received = 0
+    while received < count:
+        while sent < count and sent - received < window:
+            socket.send(request)
+            sent += 1
+        socket.recv_multipart()
+        received += 1
+    socket.close()
+
+
+def bench_workers(port, worker_counts, count, window, device_latency, clients):
+    """ Measures READ throughput for each worker count
+
+    :param port: first tcp port to use, each run binds the next port
+    :param worker_counts: list of worker counts to benchmark
+    :param count: requests sent by each client
+    :param window: requests each client keeps in flight
+    :param device_latency: seconds added to each simulated pin and bus operation
+    :param clients: number of clients, spread across the devices
+    Returns a list of result dictionaries
+    """
+    results = []
+    context = zmq.Context()
+    for run, workers in enumerate(worker_counts):
+        server = start_server(int(port) + run, workers, device_latency)
+        url = "tcp://localhost:%d" % (int(port) + run)
+        aliases = [device.get_alias() for device in server.devices]
+
+        threads = [threading.Thread(target=drive,
+                                    args=(context, url, aliases[x % len(aliases)], count, window,
+                                          "Bench %d-%d" % (run, x)))
+                   for x in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        results.append({"bench": "workers", "workers": workers, "clients": clients,
+                        "requests": count * clients, "seconds": elapsed,
+                        "throughput": count * clients / elapsed})
+    return results
+
+
+def bench_codec(codecs, count):
+    """ Measures decode + dispatch + encode time per message for each codec
+
+    Calls IpcServer.handle_message directly, no sockets are involved.
+
+    :param codecs: list of codec names to benchmark
+    :param count: messages handled per codec and message value
+    Returns a list of result dictionaries
+    """
+    results = []
+    server = IpcServer(0, backend=SimulatedBackend())
+    client_address = b"Bench"
+    for codec in codecs:
+        for msg_val in ("STATUS", "READ"):
+            request = encode_request(msg_val, "TEMP", codec)
+            start = time.perf_counter()
+            for x in range(count):
+                reply = server.handle_message(client_address, request)
+            elapsed = time.perf_counter() - start
+
+            results.append({"bench": "codec", "codec": codec, "msg_val": msg_val,
+                            "messages": count, "request_bytes": len(request),
+                            "reply_bytes": len(reply[0]), 
+                            "us_per_message": elapsed / count * 1e6})
+    return results
+
+
+def parse_mix(mix):
+    """ Parses a request mix such as ["STATUS=1", "READ=8", "CONFIG=1"]
+
+    Returns a list of message values and a list of their weights
+    """
+    msg_vals = []
+    weights = []
+    for entry in mix:
+        msg_val, weight = entry.split("=")
+        if msg_val not in ("STATUS", "READ", "CONFIG"):
+            raise ValueError("Mix entries must be STATUS, READ or CONFIG, got %s" % msg_val)
+        msg_vals.append(msg_val)
+        weights.append(float(weight))
+    return msg_vals, weights
+
+
+def latency_summary(latencies):
+    """ Summarises a list of latencies in seconds
+
+    Returns a dictionary of percentiles in microseconds and a histogram 
+    of counts in power of two microsecond buckets, keyed by upper bound
+    """
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1e6
+
+    histogram = {}
+    for latency in latencies:
+        bucket = 2 ** max(0, math.ceil(math.log2(max(latency * 1e6, 1))))
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    return {"latency_us": {"min": latencies[0] * 1e6, "mean": sum(latencies) / len(latencies) * 1e6,
+                           "p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99),
+                           "p999": percentile(0.999), "max": latencies[-1] * 1e6},
+            "histogram_us": {"le_%d" % bucket: histogram[bucket] for bucket in sorted(histogram)}}
+
+
+def run_load_client(url, port, devices, mix, count, window, codec, seed, results):
+    """ Drives a server with one IpcClient, recording each request latency
+
+    :param url: the server url i.e tcp://localhost
+    :param port: the server port
+    :param devices: list of (alias, config options) to pick requests from
+    :param mix: (message values, weights) as returned by parse_mix
+    :param count: number of requests to send
+    :param window: maximum requests in flight, matched up by MSG_ID
+    :param codec: wire encoding, json or msgpack
+    :param seed: seed of the random request sequence
+    :param results: list the (latencies, errors) of this client is appended to
+    """
+    rng = random.Random(seed)
+    client = IpcClient(url, port, codec)
+    client.connect()
+
+    pending = {}
+    latencies = []
+    errors = 0
+    sent = 0
+    while len(latencies) < count:
+        while sent < count and len(pending) < window:
+            msg_val = rng.choices(mix[0], mix[1])[0]
+            alias, options = rng.choice(devices)
+            request = IpcMessage("CMD", msg_val)
+            request.set_param("DEVICE", alias)
+            request.set_param("MSG_ID", sent)
+            if msg_val == "CONFIG":
+                request.set_param("CONFIG", rng.choice(options))
+            request = client.codec.encode(request)
+
+            pending[sent] = time.perf_counter()
+            client.socket.send(request)
+            sent += 1
+
+        r_address, reply = client.socket.recv_multipart()
+        received = time.perf_counter()
+        reply = detect_codec(reply).decode(reply)
+        latencies.append(received - pending.pop(reply.get_param("MSG_ID")))
+        if get_optional_param(reply, "ERROR") is not None:
+            errors += 1
+
+    client.socket.close()
+    results.append((latencies, errors))
+
+
+def bench_load(port, clients, count, window, mix, workers=0, device_latency=0,
+               codec="json", url=None, seed=0, config=None):
+    """ Measures throughput and latency under a mix of requests
+
+    :param port: the port to bind, or of the server at url
+    :param clients: number of concurrent clients
+    :param count: requests sent by each client
+    :param window: requests each client keeps in flight
+    :param mix: list of MSG_VAL=WEIGHT strings
+    :param workers: server worker threads, 0 serves on one thread
+    :param device_latency: seconds added to each simulated pin and bus operation
+    :param codec: wire encoding, json or msgpack
+    :param url: url of an already running server, None starts one here
+    :param seed: seed of the random request sequences
+    :param config: device configuration file of the local server, or that
+                the server at url was started with
+    Returns a result dictionary
+    """
+    mix = parse_mix(mix)
+    if url is None:
+        server = start_server(port, workers, device_latency, config)
+        url = "tcp://localhost"
+        devices = server.devices
+    elif config is not None:
+        # The remote server is assumed to have been started with the same file
+        registry = DeviceRegistry()
+        registry.load_file(config, SimulatedBackend())
+        devices = list(registry)
+    else:
+        # Only the default devices can be assumed on a remote server
+        backend = SimulatedBackend()
+        devices = [HdLed(backend=backend), HdTemp(backend=backend), HdPower(backend=backend)]
+    devices = [(device.get_alias(), CONFIG_OPTIONS[type(device)]) for device in devices]
+
+    results = []
+    threads = [threading.Thread(target=run_load_client,
+                                args=(url, port, devices, mix, count, window, codec,
+                                      seed + x, results))
+               for x in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for client_latencies, errors in results for latency in client_latencies]
+    result = {"bench": "load", "clients": clients, "window": window, "workers": workers,
+              "codec": codec, "mix": dict(zip(*mix)), "requests": len(latencies),
+              "errors": sum(errors for client_latencies, errors in results),
+              "seconds": elapsed, "throughput": len(latencies) / elapsed}
+    result.update(latency_summary(latencies))
+    return result
+
+
+def bench_transport(port, count, workers=0, codec="json"):
+    """ Measures round-trip latency over each transport of one server
+
+    One request is in flight at a time, so the latency is the transport
+    and request handling alone. The client runs in the server's process,
+    sharing its zmq context so inproc can be reached.
+
+    :param port: the tcp port to bind
+    :param count: requests sent over each transport
+    :param workers: server worker threads, 0 serves on one thread
+    :param codec: wire encoding, json or msgpack
+    Returns a list of result dictionaries
+    """
+    ipc_path = os.path.join(tempfile.gettempdir(), "femii-bench-%s.sock" % port)
+    transports = [("tcp", "tcp://*:%s" % port, "tcp://localhost:%s" % port),
+                  ("ipc", "ipc://%s" % ipc_path, "ipc://%s" % ipc_path),
+                  ("inproc", "inproc://femii-bench", "inproc://femii-bench")]
+    server = start_server(port, workers, endpoints=[bind for name, bind, url in transports])
+    request = encode_request("STATUS", "LED", codec)
+
+    results = []
+    for name, bind, url in transports:
+        client = IpcClient(url, None, codec, server.context)
+        client.connect()
+        for x in range(min(count, 100)):
+            client.socket.send(request)
+            client.socket.recv_multipart()
+
+        latencies = []
+        start = time.perf_counter()
+        for x in range(count):
+            sent = time.perf_counter()
+            client.socket.send(request)
+            client.socket.recv_multipart()
+            latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - start
+        client.socket.close()
+
+        result = {"bench": "transport", "transport": name, "workers": workers, "codec": codec,
+                  "requests": count, "seconds": elapsed, "throughput": count / elapsed}
+        result.update(latency_summary(latencies))
+        results.append(result)
+    return results
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bench", nargs="?", choices=["workers", "codec", "load", "transport"], 
+                        default="workers", help="Benchmark to run, default = workers")
+    parser.add_argument("-url", "--url", 
+                        help="load: url of a running server to drive, default = start one here")
+    parser.add_argument("-config", "--config", 
+                        help="load: device configuration file of the local server, or \
+                        that a --url server was started with")
+    parser.add_argument("-mix", "--mix", nargs="+", default=["STATUS=1", "READ=8", "CONFIG=1"],
+                        help="load: weights of each request, default = STATUS=1 READ=8 CONFIG=1")
+    parser.add_argument("-codec", "--codec", choices=sorted(CODECS), default="json",
+                        help="load/transport: wire encoding, default = json")
+    parser.add_argument("-seed", "--seed", type=int, default=0,
+                        help="load: seed of the random request sequences, default = 0")
+    parser.add_argument("-codecs", "--codecs", nargs="+", choices=sorted(CODECS),
+                        default=sorted(CODECS), help="Codecs to benchmark, default = all")
+    parser.add_argument("-port", "--port", help="First port to bind, default = 5600",
+                        default="5600")
+    parser.add_argument("-workers", "--workers", type=int, nargs="+", default=[0, 1, 2, 3],
+                        help="Worker counts to benchmark, default = 0 1 2 3")
+    parser.add_argument("-count", "--count", type=int, default=200,
+                        help="Requests sent by each client, default = 200")
+    parser.add_argument("-window", "--window", type=int, default=4,
+                        help="Requests each client keeps in flight, default = 4")
+    parser.add_argument("-clients", "--clients", type=int, default=6,
+                        help="Number of clients, default = 6")
+    parser.add_argument("-device_latency", "--device_latency", type=float, default=0.002,
+                        help="Seconds added to each simulated pin and bus operation, default = 0.002")
+    args = parser.parse_args()
+
+    if args.bench == "codec":
+        results = bench_codec(args.codecs, args.count * 100)
+    elif args.bench == "transport":
+        results = bench_transport(args.port, args.count * 10, args.workers[0], args.codec)
+    elif args.bench == "load":
+        results = [bench_load(args.port, args.clients, args.count, args.window, args.mix,
+                              args.workers[0], args.device_latency, args.codec, args.url,
+                              args.seed, args.config)]
+    else:
+        results = bench_workers(args.port, args.workers, args.count, args.window,
+                                args.device_latency, args.clients)
+    for result in results:
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+'''
+    Broker for a fleet of FEM-II boards
+    Connects to the ipc_server of every board and serves them all on one
+    ROUTER endpoint, so clients talk to a rack as they would to one board
+
+    A request with a BOARD parameter is forwarded to that board. A READ
+    or STATUS without one, or with BOARD "ALL", goes to every board at
+    once and the replies are merged into a RESULTS list with one entry
+    per board. Each board has its own timeout: a board that does not
+    answer in time gets an ERROR entry instead of stalling the others.
+    The copy sent to a board carries that timeout as its EXPIRES_IN, which
+    the board counts on its own clock, so a board that catches up late
+    does not run requests nobody waits for, and a board that is not
+    connected is not sent anything at all.
+
+'''
+
+import zmq
+import time
+import heapq
+import argparse
+import itertools
+from random import randint
+from odin_data.ipc_message import IpcMessage, IpcMessageException
+from ipc_codec import STATUS_CODES, detect_codec, get_optional_param
+from ipc_log import FORMATS, configure_logging, get_logger
+from ipc_transport import connect_endpoint, parse_endpoint
+
+
+log = get_logger("broker")
+
+#   Message values that are sent to every board when no BOARD is given
+FAN_OUT_VALS = {"READ", "STATUS"}
+ALL_BOARDS = "ALL"
+
+
+def offset_frames(params, offset):
+    """ Shifts the {FRAME} array references in reply parameters
+
+    Used when the frames of several replies are sent after one message
+    """
+    for name, value in params.items():
+        if isinstance(value, dict) and "FRAME" in value:
+            params[name] = dict(value, FRAME=value["FRAME"] + offset)
+        elif isinstance(value, list):
+            for entry in value:
+                if isinstance(entry, dict):
+                    offset_frames(entry, offset)
+
+
+class PendingRequest:
+    """ A client request waiting on the replies of one or more boards """
+
+    def __init__(self, client_address, msg_id, codec, fan_out, legacy=False):
+        self.client_address = client_address
+        self.msg_id = msg_id
+        self.codec = codec
+        self.fan_out = fan_out
+        self.legacy = legacy
+        self.waiting = {}
+        self.results = {}
+        self.frames = []
+
+
+class IpcBroker:
+
+    def __init__(self, port, boards, timeout=1.0):
+        """ Constructor
+
+        :param port: the tcp port to bind for clients
+        :param boards: dictionary of board name to ipc_server endpoint,
+                    i.e {"rack1": "tcp://fem1:5555?tcp_keepalive=1"}
+        :param timeout: seconds each board has to answer a request
+        """
+
+        ident = str(randint(0, 100000))
+        self.identity = "Broker %s" % ident
+        self.url = "tcp://*:%s" % port
+        self.timeout = float(timeout)
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+
+        self.boards = {}
+        self.urls = dict(boards)
+        for name in self.urls:
+            socket = self.context.socket(zmq.DEALER)
+            socket.setsockopt(zmq.IDENTITY, ("%s %s" % (self.identity, name)).encode())
+            socket.setsockopt(zmq.LINGER, 0)
+            # Fail sends to a board that is down rather than queue them for later
+            socket.setsockopt(zmq.IMMEDIATE, 1)
+            self.boards[name] = socket
+
+        # Broker MSG_ID of each forwarded request -> (PendingRequest, board)
+        self.pending = {}
+        self.deadlines = []
+        self._msg_ids = itertools.count(1)
+
+    def bind(self):
+        """ binds the client socket and connects to every board """
+
+        self.socket.bind(self.url)
+        for name, socket in self.boards.items():
+            connect_endpoint(socket, self.urls[name])
+
+    def get_targets(self, request):
+        ''' Returns the names of the boards a request is sent to
+
+        :param request: the decoded IPCmessage from the client
+        '''
+
+        board = get_optional_param(request, "BOARD")
+        if board is None and len(self.boards) == 1:
+            return list(self.boards)
+        if board is None or board == ALL_BOARDS:
+            if request.get_msg_val() not in FAN_OUT_VALS:
+                raise IpcMessageException("%s needs a BOARD, one of: %s"
+                                          % (request.get_msg_val(), list(self.boards)))
+            return list(self.boards)
+        if board not in self.boards:
+            raise IpcMessageException("Unknown board %s, accepts: %s"
+                                      % (board, list(self.boards)))
+        return [board]
+
+    def handle_request(self, client_address, raw):
+        ''' Forwards a client request to its boards
+
+        Each board is sent a copy with its own broker MSG_ID, so replies
+        from any board can be matched to the client request, and with the
+        broker timeout as its EXPIRES_IN. A client DEADLINE is passed on
+        as it is, the broker does not stamp its own clock on requests.
+        '''
+
+        codec = detect_codec(raw)
+        request = None
+        try:
+            request = codec.decode(raw)
+            targets = self.get_targets(request)
+        except IpcMessageException as err:
+            log.warning("Request failed", extra={"client": client_address.decode(errors="replace"),
+                        "error": str(err)})
+            msg_id = None if request is None else get_optional_param(request, "MSG_ID")
+            legacy = request is not None and bool(get_optional_param(request, "LEGACY"))
+            self.send_error(client_address, msg_id, codec, err, legacy)
+            return
+
+        # A single board broker answers requests without a BOARD as the board would
+        board = get_optional_param(request, "BOARD")
+        fan_out = board == ALL_BOARDS or (board is None and len(self.boards) > 1)
+        pending = PendingRequest(client_address, get_optional_param(request, "MSG_ID"), codec,
+                                 fan_out, bool(get_optional_param(request, "LEGACY")))
+        deadline = time.monotonic() + self.timeout
+        request.set_param("EXPIRES_IN", self.timeout)
+        for name in targets:
+            broker_id = next(self._msg_ids)
+            request.set_param("MSG_ID", broker_id)
+            try:
+                self.boards[name].send(codec.encode(request), zmq.NOBLOCK)
+            except zmq.Again:
+                pending.results[name] = {"ERROR": "Board %s is not accepting requests" % name,
+                                         "STATUS_CODE": STATUS_CODES["BUSY"]}
+                continue
+            pending.waiting[broker_id] = name
+            self.pending[broker_id] = (pending, name)
+            heapq.heappush(self.deadlines, (deadline, broker_id))
+
+        if not pending.waiting:
+            self.finish(pending)
+
+    def handle_reply(self, name, frames):
+        ''' Records a board's reply, answers the client once every board has
+
+        :param name: the board that replied
+        :param frames: the received frames, an empty delimiter, the reply
+                    and any array frames
+        '''
+
+        empty, raw, *arrays = frames
+        try:
+            reply = detect_codec(raw).decode(raw)
+        except IpcMessageException as err:
+            log.warning("Bad reply from board", extra={"board": name, "error": str(err)})
+            return
+
+        # Replies to requests that already timed out are dropped
+        broker_id = get_optional_param(reply, "MSG_ID")
+        entry = self.pending.pop(broker_id, None)
+        if entry is None:
+            return
+        pending, name = entry
+        pending.waiting.pop(broker_id)
+
+        params = dict(reply.attrs.get("params", {}))
+        params.pop("MSG_ID", None)
+        if arrays:
+            offset_frames(params, len(pending.frames))
+            pending.frames.extend(arrays)
+        pending.results[name] = params
+
+        if not pending.waiting:
+            self.finish(pending)
+
+    def expire(self):
+        ''' Gives an ERROR result to every board that missed its deadline '''
+
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, broker_id = heapq.heappop(self.deadlines)
+            entry = self.pending.pop(broker_id, None)
+            if entry is None:
+                continue
+            pending, name = entry
+            pending.waiting.pop(broker_id)
+            pending.results[name] = {"ERROR": "Board %s timed out after %s seconds"
+                                     % (name, self.timeout),
+                                     "STATUS_CODE": STATUS_CODES["TIMEOUT"]}
+            log.warning("Board timed out", extra={"board": name, "error": "timeout"})
+            if not pending.waiting:
+                self.finish(pending)
+
+    def finish(self, pending):
+        ''' Sends the merged reply of a request to its client '''
+
+        reply_message = IpcMessage(msg_type="CMD", msg_val="NOTIFY")
+        if pending.legacy:
+            # Errors made here rather than by a board have no REPLY yet
+            for result in pending.results.values():
+                if "ERROR" in result and "REPLY" not in result:
+                    result["REPLY"] = "Error processing request: %s" % result["ERROR"]
+        if pending.fan_out:
+            # In board order, as a BATCH reply is in request order
+            results = []
+            for name in self.boards:
+                if name in pending.results:
+                    results.append(dict(pending.results[name], BOARD=name))
+            reply_message.set_param("RESULTS", results)
+        else:
+            name, result = next(iter(pending.results.items()))
+            for param, value in result.items():
+                reply_message.set_param(param, value)
+            reply_message.set_param("BOARD", name)
+
+        if pending.msg_id is not None:
+            reply_message.set_param("MSG_ID", pending.msg_id)
+        self.socket.send_multipart([pending.client_address, b"",
+                                    pending.codec.encode(reply_message)] + pending.frames)
+
+    def send_error(self, client_address, msg_id, codec, err, legacy=False):
+        ''' Sends a client an error reply, with a REPLY string if legacy '''
+
+        reply_message = IpcMessage(msg_type="CMD", msg_val="NOTIFY")
+        reply_message.set_param("ERROR", str(err))
+        reply_message.set_param("STATUS_CODE", STATUS_CODES["ERROR"])
+        if legacy:
+            reply_message.set_param("REPLY", "Error processing request: %s" % str(err))
+        if msg_id is not None:
+            reply_message.set_param("MSG_ID", msg_id)
+        self.socket.send_multipart([client_address, b"", codec.encode(reply_message)])
+
+    def run(self):
+        ''' Broker loop, forwards requests and merges replies '''
+
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        names = {}
+        for name, socket in self.boards.items():
+            poller.register(socket, zmq.POLLIN)
+            names[socket] = name
+
+        while True:
+            timeout = None
+            if self.deadlines:
+                timeout = max(0.0, self.deadlines[0][0] - time.monotonic()) * 1000
+            socks = dict(poller.poll(timeout))
+
+            if socks.get(self.socket) == zmq.POLLIN:
+                # The request is the last frame, as the server reads it
+                frames = self.socket.recv_multipart()
+                client_address, request = frames[0], frames[-1]
+                self.handle_request(client_address, request)
+
+            for socket, name in names.items():
+                if socks.get(socket) == zmq.POLLIN:
+                    self.handle_reply(name, socket.recv_multipart())
+
+            self.expire()
+
+
+def parse_boards(boards):
+    """ Parses NAME=URL board arguments into a dictionary """
+
+    parsed = {}
+    for board in boards:
+        name, sep, url = board.partition("=")
+        if not sep or not name or not url:
+            raise ValueError("Boards must be given as NAME=URL, got %s" % board)
+        if name == ALL_BOARDS:
+            raise ValueError("%s is reserved for sending to every board" % ALL_BOARDS)
+        parse_endpoint(url)
+        parsed[name] = url
+    return parsed
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-port", "--port", help="Port clients connect to, default = 5550",
+                        default="5550")
+    parser.add_argument("-board", "--board", nargs="+", required=True,
+                        help="Board servers as NAME=URL e.g. fem1=tcp://fem1:5555")
+    parser.add_argument("-timeout", "--timeout", type=float, default=1.0,
+                        help="Seconds each board has to reply, default = 1")
+    parser.add_argument("-log_level", "--log_level", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Lowest level logged, default = INFO")
+    parser.add_argument("-log_format", "--log_format", choices=sorted(FORMATS), default="text",
+                        help="Log as text with key=value fields or as JSON lines, default = text")
+    args = parser.parse_args()
+
+    try:
+        boards = parse_boards(args.board)
+    except ValueError as err:
+        parser.error(str(err))
+
+    configure_logging(args.log_level, format=args.log_format)
+    broker = IpcBroker(args.port, boards, args.timeout)
+    broker.bind()
+    log.info("Brokering boards: %s", boards)
+    broker.run()
+
+
+if __name__ == "__main__":
+    main()
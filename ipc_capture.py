@@ -0,0 +1,98 @@
+'''
+    Traffic capture for ipc_server
+    Every request received, BUSY ones included, is appended to a capture
+    file, as it arrived on the wire, with its arrival time, client identity
+    and how long the server took to reply. Records are written as replies
+    are sent, so a request served out of turn is out of arrival order in
+    the file; ipc_replay sorts them back before playing a capture back.
+
+    The file is a header followed by records of
+        arrived (float64), latency (float64), client length (uint16),
+        request length (uint32), client bytes, request bytes
+    all little-endian. Records are written by a background thread.
+
+'''
+
+import queue
+import atexit
+import struct
+import threading
+
+
+MAGIC = b"FEMIICAP1\n"
+RECORD = struct.Struct("<ddHI")
+
+
+class CaptureWriter:
+    """ Appends received requests to a capture file
+
+    :param path: the capture file, created with a header if it does not
+                exist, appended to otherwise
+    :param flush_every: records written between flushes to disk
+
+    """
+
+    def __init__(self, path, flush_every=100):
+        self.path = path
+        self.flush_every = flush_every
+        self.records = queue.Queue()
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self._thread = threading.Thread(target=self.run, name="CaptureWriter", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, arrived, latency, client, request):
+        """ Queues a request to be written
+
+        :param arrived: arrival time, seconds since the epoch
+        :param latency: seconds from arrival until the reply was sent
+        :param client: the client identity frame
+        :param request: the raw request frame
+        """
+        self.records.put((arrived, latency, client, request))
+
+    def run(self):
+        """ Writing loop, stops at a None record """
+
+        written = 0
+        while True:
+            record = self.records.get()
+            if record is None:
+                break
+            arrived, latency, client, request = record
+            self.file.write(RECORD.pack(arrived, latency, len(client), len(request)))
+            self.file.write(client)
+            self.file.write(request)
+            written += 1
+            if written % self.flush_every == 0 or self.records.empty():
+                self.file.flush()
+        self.file.close()
+
+    def close(self):
+        """ Writes everything queued and closes the file """
+
+        self.records.put(None)
+        self._thread.join()
+
+
+def read_capture(path):
+    """ Yields the (arrived, latency, client, request) records of a capture
+
+    Raises ValueError if the file is not a capture, a record cut short by
+    the server stopping mid-write ends the capture.
+    """
+    with open(path, "rb") as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a capture file" % path)
+        while True:
+            header = capture.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            arrived, latency, client_size, request_size = RECORD.unpack(header)
+            client = capture.read(client_size)
+            request = capture.read(request_size)
+            if len(request) < request_size:
+                return
+            yield arrived, latency, client, request
@@ -2,14 +2,20 @@
     Client. 
     Communicates with a single ipc_server
     Uses Ipc Message formatting
+    With --script, runs newline-delimited commands such as READ TEMP
+    over one connection and writes the replies as JSON lines
     
 '''
 import sys
+import json
+import time
 from random import randint
 import zmq
 import argparse
 from odin_data.ipc_message import IpcMessage
-from zmq.utils.strtypes import unicode, cast_bytes
+from ipc_codec import CODECS, get_codec, detect_codec, unpack_arrays
+from ipc_log import configure_logging, get_logger
+from ipc_transport import connect_endpoint, make_url
 
 #   Fixed config options for quick validating of user input
 MSG_TYPES = {"CMD"}
@@ -18,48 +24,143 @@ HD_DEVICES = {"LED", "TEMP", "POWER"}
 LED_STATES = {"ON", "OFF", "BLINK"}
 TEMP_STATES = {"C", "F"}
 VOLT_STATES = {"5", "3.3"}
+REQUEST_ARGS = {"msg_type", "msg_val", "device", "led_config", "temp_config", "power_config"}
+
+log = get_logger("client")
+
+
+def parse_command(line):
+    """ Parses a script command: MSG_VAL DEVICE [CONFIG] [NAME=VALUE ...]
+
+    e.g. "READ TEMP", "CONFIG POWER 3.3", "READ POWER COUNT=100" or
+    "CONFIG LED BLINK TIMEOUT=10 RATE=1". Values are read as JSON
+    where they can be, so numbers are sent as numbers.
+    Returns (msg_val, device, params), raises ValueError if malformed
+    """
+    words = line.split()
+    if len(words) < 2:
+        raise ValueError("Commands are MSG_VAL DEVICE [CONFIG] [NAME=VALUE ...]")
+
+    msg_val, device = words[0].upper(), words[1]
+    params = {}
+    for word in words[2:]:
+        name, sep, value = word.partition("=")
+        if not sep:
+            if "CONFIG" in params:
+                raise ValueError("Unexpected %s, give further parameters as NAME=VALUE" % word)
+            name, value = "CONFIG", word
+        else:
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        params[name.upper()] = value
+    return msg_val, device, params
+
+
+def describe_reply(params):
+    """ Returns the text shown for the typed parameters of a reply """
+
+    if "ERROR" in params:
+        return "Error processing request: %s" % params["ERROR"]
+
+    where = "%s at address %s" % (params.get("DEVICE"), params.get("ADDRESS"))
+    unit = params.get("UNIT")
+    unit = "" if unit is None else " %s" % unit
+    if "VALUE" in params:
+        value = params["VALUE"]
+        value = "%g" % value if isinstance(value, float) else value
+        return "Value of %s is: %s%s" % (where, value, unit)
+    if "FAULT" in params:
+        return "Injected %s fault into %s" % (params["FAULT"], where)
+    if "CONFIG" in params:
+        return "Set %s to: %s%s, status %s" % (where, params["CONFIG"], unit, params.get("STATUS"))
+    if "SAMPLES" in params:
+        return "%s has %d readings%s" % (where, params["SAMPLES"], unit and " in" + unit)
+    if "STATUS" in params:
+        return "Status of %s is: %s" % (where, params["STATUS"])
+    return json.dumps(params, default=str)
+
 
 class IpcClient:
 
 
-    def __init__(self, url, port):
+    def __init__(self, url, port, codec="json", context=None):
+        """ Constructor
+
+        :param url: Remote server url i.e tcp://localhost, ipc:///tmp/femii.sock
+                    or inproc://femii, with optional socket options
+        :param port: Port of a tcp server, None if url names the endpoint in full
+        :param codec: Wire encoding, json or msgpack
+        :param context: zmq context to use, an inproc server's own context,
+                    a new one if None
+        """
         ident= str(randint(0,100000))
         self.identity = "Client %s" % ident
-        self.url = "%s:%s" % (url, port)
-        self.context = zmq.Context()
+        self.url = make_url(url, port)
+        self.codec = get_codec(codec)
+        self.context = context or zmq.Context()
         self.socket = self.context.socket(zmq.DEALER)
         self.socket.setsockopt(zmq.IDENTITY, self.identity.encode())
         
     def connect(self):
         """ Connect the socket """
-        self.socket.connect(self.url)
+        connect_endpoint(self.socket, self.url)
 
     def recv_reply(self):
         """ Receive reply from ZMQ socket
             
         Receives a multipart message, forms an IPCmessage 
-        and prints out the REPLY string 
+        and prints out its typed parameters
         
         """
-        # Strip off the address
-        r_address, reply = self.socket.recv_multipart()
+        # Strip off the address, a burst READ has its arrays in extra frames
+        r_address, reply, *frames = self.socket.recv_multipart()
 
         # format it as an IPC message
-        reply = IpcMessage(from_str=reply)
-        print("Received Response: %s" % reply.get_param("REPLY"))
+        reply = detect_codec(reply).decode(reply)
+
+        # A broker sending to every board replies with one result per board
+        results = reply.attrs.get("params", {}).get("RESULTS")
+        if results is not None:
+            for result in results:
+                print("Received Response from %s: %s" % (result["BOARD"],
+                      describe_reply(result)))
+            return
+        print("Received Response: %s" % describe_reply(reply.attrs.get("params", {})))
 
-    def form_ipc_msg(self, msgType, msgVal, msgDevice, msgConfig, blink_timeout, blink_rate):
+        if frames:
+            unpack_arrays(reply.attrs.get("params", {}), frames)
+            values = reply.get_param("VALUES")
+            if len(values):
+                print("Min %s, max %s, mean %s %s" % (values.min(), values.max(),
+                      values.mean(), reply.get_param("UNIT")))
+
+    def form_ipc_msg(self, msgType, msgVal, msgDevice, msgConfig, blink_timeout, blink_rate,
+                     max_age=None, count=None, interval=None, board=None):
         """ Forms and returns an encoded IPC Message
         
         :param msgtype: The type of message i.e CMD
         :param msgVal: The value of the request i.e STATUS/CONFIG
         :param msgDevice: The device alias name
         :param msgConfig: The configuration parameter
+        :param max_age: Oldest cached reading accepted by a READ, in seconds
+        :param count: Number of readings a burst READ takes
+        :param interval: Seconds between the readings of a burst READ
+        :param board: The board to send to when connected to an ipc_broker
         Returns the encoded ipc message for sending over zmq socket
         
         """
         request = IpcMessage(msgType, msgVal)
         request.set_param("DEVICE", msgDevice)
+        if board is not None:
+            request.set_param("BOARD", board)
+
+        if msgVal == "READ" and max_age is not None:
+            request.set_param("MAX_AGE", max_age)
+        if msgVal == "READ" and count is not None:
+            request.set_param("COUNT", count)
+            request.set_param("INTERVAL", interval or 0)
 
         if msgVal == "CONFIG":
             request.set_param("CONFIG", msgConfig)
@@ -67,16 +168,193 @@ class IpcClient:
                 request.set_param("TIMEOUT", blink_timeout)
                 request.set_param("RATE", blink_rate)
 
-        print("%s Configuring service request..." % self.identity)
+        log.debug("%s Configuring service request...", self.identity)
 
         #   Encode the message to be sent
-        request = request.encode()
-        if isinstance(request, unicode):
-            request = cast_bytes(request)
+        return self.codec.encode(request)
+
+    def form_batch_msg(self, msgType, entries):
+        """ Forms and returns an encoded BATCH IPC Message
+        
+        :param msgType: The type of message i.e CMD
+        :param entries: Ordered list of (device, msg_val, config) tuples,
+                        config is None for STATUS and READ
+        Returns the encoded ipc message for sending over zmq socket
+        
+        """
+        request = IpcMessage(msgType, "BATCH")
+        request.set_param("BATCH", [{"DEVICE": device, "OP": op, "CONFIG": config} 
+                                    for device, op, config in entries])
+
+        #   Encode the message to be sent
+        return self.codec.encode(request)
+
+    def run_batch(self, msgType, entries):
+        """ Sends a BATCH request and waits for the single reply
+
+        :param msgType: The type of message i.e CMD
+        :param entries: Ordered list of (device, msg_val, config) tuples
+        Prints and returns the per-entry results, each has its reply
+        parameters or an ERROR
+        
+        """
+        self.socket.send(self.form_batch_msg(msgType, entries))
+        r_address, reply = self.socket.recv_multipart()
+
+        results = detect_codec(reply).decode(reply).get_param("RESULTS")
+        for result in results:
+            print("Received Response for %s %s: %s" % (result["OP"], result["DEVICE"],
+                  describe_reply(result)))
+        return results
+
+    def run_stats(self, msgType):
+        """ Requests the server's metrics and prints them as JSON 
+
+        :param msgType: The type of message i.e CMD
+        Returns the STATS dictionary
+        
+        """
+        self.socket.send(self.codec.encode(IpcMessage(msgType, "STATS")))
+        r_address, reply = self.socket.recv_multipart()
 
-        return request
+        stats = detect_codec(reply).decode(reply).get_param("STATS")
+        print(json.dumps(stats, indent=4, sort_keys=True))
+        return stats
 
-    def run_req(self, run_once, msgType, msgVal, msgDevice, msgConfig):
+    def run_rules(self, msgType):
+        """ Requests the hit counters of the server's rules and prints them
+
+        :param msgType: The type of message i.e CMD
+        Returns the list of RULES, one per rule and device
+
+        """
+        self.socket.send(self.codec.encode(IpcMessage(msgType, "RULES")))
+        r_address, reply = self.socket.recv_multipart()
+
+        rules = detect_codec(reply).decode(reply).get_param("RULES")
+        for rule in rules:
+            print("%s on %s: %d hits%s" % (rule["RULE"], rule["DEVICE"], rule["HITS"],
+                  "" if rule["LAST_FIRED"] is None else ", last at %s = %s"
+                  % (time.ctime(rule["LAST_FIRED"]), rule["LAST_VALUE"])))
+        return rules
+
+    def run_profile(self, msgType, seconds, top=10):
+        """ Profiles the server for a while and prints the result as JSON
+
+        :param msgType: The type of message i.e CMD
+        :param seconds: Seconds the server samples its threads for
+        :param top: Number of hot functions reported
+        Returns the reply parameters, the stacks are left in a file on
+        the server named by PATH
+
+        """
+        request = IpcMessage(msgType, "PROFILE")
+        request.set_param("ACTION", "START")
+        request.set_param("SECONDS", seconds)
+        self.socket.send(self.codec.encode(request))
+        r_address, reply = self.socket.recv_multipart()
+        result = detect_codec(reply).decode(reply).attrs.get("params", {})
+
+        request = IpcMessage(msgType, "PROFILE")
+        request.set_param("ACTION", "RESULT")
+        request.set_param("TOP", top)
+        time.sleep(seconds)
+        while result.get("PROFILING"):
+            self.socket.send(self.codec.encode(request))
+            r_address, reply = self.socket.recv_multipart()
+            result = detect_codec(reply).decode(reply).attrs.get("params", {})
+            if result.get("PROFILING"):
+                time.sleep(0.1)
+
+        print(json.dumps(result, indent=4))
+        return result
+
+    def run_script(self, lines, msgType="CMD", window=16, timeout=5.0, out=sys.stdout):
+        """ Runs script commands over this connection, see parse_command
+
+        :param lines: iterable of command lines, blank lines and lines
+                    starting with # are skipped
+        :param msgType: The type of message i.e CMD
+        :param window: Maximum number of requests in flight at once
+        :param timeout: Seconds to wait for a reply before failing the
+                    commands in flight and carrying on with the rest,
+                    also sent as each request's DEADLINE
+        :param out: where the results are written, one JSON object per
+                    command in script order with its LINE, COMMAND and
+                    the reply parameters or an ERROR
+        Returns the number of commands that failed
+
+        """
+        commands = enumerate(lines, 1)
+        pending = {}
+        results = {}
+        sequence = 0
+        written = 0
+        failed = 0
+        exhausted = False
+
+        while not exhausted or pending or written < sequence:
+            # Keep the window full
+            while not exhausted and len(pending) < window:
+                try:
+                    number, line = next(commands)
+                except StopIteration:
+                    exhausted = True
+                    break
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+
+                try:
+                    msg_val, device, params = parse_command(line)
+                except ValueError as err:
+                    results[sequence] = {"LINE": number, "COMMAND": line, "ERROR": str(err)}
+                    sequence += 1
+                    continue
+
+                request = IpcMessage(msgType, msg_val)
+                request.set_param("DEVICE", device)
+                request.set_param("MSG_ID", sequence)
+                request.set_param("DEADLINE", time.time() + timeout)
+                for name, value in params.items():
+                    request.set_param(name, value)
+                self.socket.send(self.codec.encode(request))
+                pending[sequence] = (number, line)
+                sequence += 1
+
+            if pending:
+                if not self.socket.poll(timeout * 1000):
+                    for msg_id, (number, line) in pending.items():
+                        results[msg_id] = {"LINE": number, "COMMAND": line,
+                                           "ERROR": "No reply within %s seconds" % timeout}
+                    # A late reply to one of them is not in pending and is dropped
+                    pending.clear()
+                else:
+                    r_address, reply, *frames = self.socket.recv_multipart()
+                    reply = detect_codec(reply).decode(reply)
+                    params = reply.attrs.get("params", {})
+                    if frames:
+                        unpack_arrays(params, frames)
+                    msg_id = params.pop("MSG_ID", None)
+                    if msg_id in pending:
+                        number, line = pending.pop(msg_id)
+                        result = {"LINE": number, "COMMAND": line}
+                        for name, value in params.items():
+                            result[name] = value.tolist() if hasattr(value, "tolist") else value
+                        results[msg_id] = result
+
+            # Write results in script order as soon as they are complete
+            while written in results:
+                result = results.pop(written)
+                failed += "ERROR" in result
+                out.write(json.dumps(result) + "\n")
+                written += 1
+
+        out.flush()
+        return failed
+
+    def run_req(self, run_once, msgType, msgVal, msgDevice, msgConfig, max_age=None,
+                count=None, interval=None, board=None):
         """ Req-Reply loop, sends request, waits for response
         
         :param run_once: Boolean value, true when command line arguments were 
@@ -86,13 +364,18 @@ class IpcClient:
         :param msgVal: The message value i.e STATUS/CONFIG
         :param msgDevice: The alias of the target hardware device
         :param msgConfig: The configuration parameter, None if not provided.
+        :param max_age: Oldest cached reading accepted by a one-shot READ.
+        :param count: Number of readings a one-shot burst READ takes.
+        :param interval: Seconds between the readings of a burst READ.
+        :param board: The board a one-shot request goes to through an ipc_broker.
         
         """
 
         if run_once == True:
             blink_timeout = None
             blink_rate = None
-            request = self.form_ipc_msg(msgType, msgVal, msgDevice, msgConfig, blink_timeout, blink_rate)
+            request = self.form_ipc_msg(msgType, msgVal, msgDevice, msgConfig, blink_timeout, blink_rate,
+                                        max_age, count, interval, board)
             self.socket.send(request)
             self.recv_reply()
 
@@ -163,8 +446,9 @@ def main():
         (URL, PORT, TYPE, VAL, DEVICE, CONFIG)
     """
     parser = argparse.ArgumentParser()
-    parser.add_argument("-url", "--url", help="Remote server url, \
-                        default = tcp://localhost", default="tcp://localhost")
+    parser.add_argument("-url", "--url", help="Remote server url, tcp:// urls get --port \
+                        added, ipc:// urls are used as given, default = tcp://localhost",
+                        default="tcp://localhost")
     parser.add_argument("-port", "--port", help="Port connection, default = 5555", 
                         default="5555")
     parser.add_argument("-msg_type", "--msg_type", help="Message type, accepts: %s" 
@@ -182,8 +466,87 @@ def main():
     parser.add_argument("-power_config", "--power_config", 
                         help="Power device configuration option, accepts: %s " 
                         % VOLT_STATES, choices=VOLT_STATES)
+    parser.add_argument("-max_age", "--max_age", type=float,
+                        help="Accept a cached READ value up to this many seconds old")
+    parser.add_argument("-count", "--count", type=int,
+                        help="Take a burst of this many READ values, returned as one array")
+    parser.add_argument("-interval", "--interval", type=float,
+                        help="Seconds between the values of a --count burst, default = 0")
+    parser.add_argument("-board", "--board",
+                        help="Board to send to through an ipc_broker, default = every board \
+                        for READ/STATUS")
+    parser.add_argument("-codec", "--codec", choices=sorted(CODECS),
+                        help="Wire encoding, default = json")
+    parser.add_argument("-batch", "--batch", nargs="+", 
+                        help="Send several operations in one request, each given as \
+                        MSG_VAL:DEVICE[:CONFIG] e.g. READ:TEMP CONFIG:LED:ON")
+    parser.add_argument("-stats", "--stats", action="store_true",
+                        help="Print the server's request metrics")
+    parser.add_argument("-rules", "--rules", action="store_true",
+                        help="Print the hit counters of the server's rules")
+    parser.add_argument("-profile", "--profile", type=float,
+                        help="Profile the server for this many seconds and print its \
+                        hottest functions")
+    parser.add_argument("-top", "--top", type=int, default=10,
+                        help="Number of hot functions --profile prints, default = 10")
+    parser.add_argument("-script", "--script",
+                        help="Run the commands in this file, - for stdin, one per line \
+                        e.g. READ TEMP or CONFIG POWER 3.3, and print JSON line results")
+    parser.add_argument("-window", "--window", type=int, default=16,
+                        help="Maximum --script requests in flight, default = 16")
+    parser.add_argument("-timeout", "--timeout", type=float, default=5.0,
+                        help="Seconds to wait for a --script reply, default = 5")
+    parser.add_argument("-log_level", "--log_level", default="WARNING",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Lowest level logged, default = WARNING")
     args = parser.parse_args()
 
+    configure_logging(args.log_level)
+    log.debug("Arguments: %s", vars(args))
+
+    if args.script is not None:
+        client = IpcClient(args.url, args.port, args.codec or "json")
+        client.connect()
+        if args.script == "-":
+            failed = client.run_script(sys.stdin, args.msg_type or "CMD",
+                                       args.window, args.timeout)
+        else:
+            with open(args.script) as script:
+                failed = client.run_script(script, args.msg_type or "CMD",
+                                           args.window, args.timeout)
+        sys.exit(1 if failed else 0)
+
+    if args.stats:
+        client = IpcClient(args.url, args.port, args.codec or "json")
+        client.connect()
+        client.run_stats(args.msg_type or "CMD")
+        return
+
+    if args.rules:
+        client = IpcClient(args.url, args.port, args.codec or "json")
+        client.connect()
+        client.run_rules(args.msg_type or "CMD")
+        return
+
+    if args.profile is not None:
+        client = IpcClient(args.url, args.port, args.codec or "json")
+        client.connect()
+        client.run_profile(args.msg_type or "CMD", args.profile, args.top)
+        return
+
+    # A batch is sent on its own and replaces the single request arguments
+    if args.batch is not None:
+        entries = []
+        for entry in args.batch:
+            fields = entry.split(":")
+            if len(fields) < 2 or fields[0] not in MSG_VALS:
+                parser.error("--batch entries must be MSG_VAL:DEVICE[:CONFIG], got %s" % entry)
+            entries.append((fields[1], fields[0], fields[2] if len(fields) > 2 else None))
+        client = IpcClient(args.url, args.port, args.codec or "json")
+        client.connect()
+        client.run_batch(args.msg_type or "CMD", entries)
+        return
+
     # Ensure that the config options are given for config messages + right devices
     if (args.msg_val == "CONFIG" and args.device == "LED" 
         and args.led_config == None):
@@ -209,29 +572,27 @@ def main():
 
     """ 
         Ensure a full CMD message has been provided 
-        or none at all - count the non none arguments
+        or none at all - count the non none request arguments
     """
     arg_length = 0
     for arg in vars(args):
-        if getattr(args, arg) != None:
+        if arg in REQUEST_ARGS and getattr(args, arg) != None:
             arg_length += 1
-        print (arg, getattr(args, arg))
-    print (arg_length)
 
     """
-        If we have more than just the url and the port
-        but less than url, port, type, val and device throw an error
+        If we have some request arguments but less 
+        than type, val and device throw an error
     """
-    if arg_length > 2 and arg_length < 5:
+    if arg_length > 0 and arg_length < 3:
         parser.error("A full client request is required or none at all. \
                     Message consists of a msg_type, msg_val, a target device \
                     and optional configuration arguments if msg_val == config.")
     else:
         # A proper message has been provided, run_once is true
         run_once = True
-        if arg_length == 2:
+        if arg_length == 0:
             run_once = False
-        client = IpcClient(args.url, args.port)
+        client = IpcClient(args.url, args.port, args.codec or "json")
         client.connect()
 
         # Assign the config argument depending on the device given
@@ -243,7 +604,7 @@ def main():
             _config = args.power_config
         client.run_req(run_once, args.msg_type, 
                         args.msg_val, args.device, 
-                        _config)
+                        _config, args.max_age, args.count, args.interval, args.board)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,176 @@
+'''
+    Wire encodings for IPC Messages
+    JSON is the default and what odin_data produces. A compact msgpack
+    encoding with numeric message type/value codes can be chosen per
+    connection: binary frames start with a marker byte that JSON never
+    does, so the server detects the encoding of each request and replies
+    in kind, and JSON clients keep working unchanged.
+
+    Numeric arrays, e.g. the readings of a burst READ, are not encoded in
+    the message at all: each is sent raw as an extra frame after it and
+    the parameter holds a {FRAME, DTYPE, SHAPE} reference to that frame.
+
+'''
+
+from odin_data.ipc_message import IpcMessage, IpcMessageException
+from zmq.utils.strtypes import unicode, cast_bytes
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+#   First byte of a msgpack encoded message, JSON messages start with "{"
+MSGPACK_MARKER = b"\xb1"
+
+MSG_TYPE_CODES = {"CMD": 1, "ACK": 2, "NACK": 3, "NOTIFY": 4}
+MSG_VAL_CODES = {"STATUS": 1, "CONFIG": 2, "READ": 3, "BATCH": 4,
+                 "NOTIFY": 5, "TELEMETRY": 6, "STATS": 7,
+                 "READ_HISTORY": 8, "PROFILE": 9, "RULES": 10, "ALARM": 11,
+                 "FAULT": 12}
+MSG_TYPE_NAMES = {code: name for name, code in MSG_TYPE_CODES.items()}
+
+#   STATUS_CODE of a reply, 0 when the request succeeded
+STATUS_CODES = {"OK": 0, "ERROR": 1, "NO_DEVICE": 2, "BUSY": 3, "EXPIRED": 4,
+                "TIMEOUT": 5}
+STATUS_OK = STATUS_CODES["OK"]
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+MSG_VAL_NAMES = {code: name for name, code in MSG_VAL_CODES.items()}
+
+
+def get_optional_param(message, name):
+    ''' Returns a parameter of an IPCmessage, None if it is not set '''
+
+    try:
+        return message.get_param(name)
+    except IpcMessageException:
+        return None
+
+
+def check_message(message):
+    """ Returns a decoded IPC Message, raising IpcMessageException unless
+    it has a msg_type and msg_val and its params are a dictionary """
+
+    attrs = message.attrs
+    if not isinstance(attrs, dict) or not isinstance(attrs.get("msg_type"), str) \
+            or not isinstance(attrs.get("msg_val"), str) \
+            or not isinstance(attrs.get("params", {}), dict):
+        raise IpcMessageException("Illegal message, needs a msg_type, msg_val and params")
+    return message
+
+
+class JsonCodec:
+    """ The odin_data JSON encoding """
+
+    name = "json"
+
+    def encode(self, message):
+        """ Returns an IPC Message encoded as bytes """
+
+        data = message.encode()
+        if isinstance(data, unicode):
+            data = cast_bytes(data)
+        return data
+
+    def decode(self, data):
+        """ Returns the IPC Message encoded in data """
+
+        return check_message(IpcMessage(from_str=data))
+
+
+class MsgpackCodec:
+    """ Compact binary encoding
+
+    A message is the marker byte followed by a msgpack array of
+    [msg_type, msg_val, params]. Known message types and values are
+    sent as small integers, anything else as its name.
+    """
+
+    name = "msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise IpcMessageException("The msgpack encoding needs the msgpack package")
+
+    def encode(self, message):
+        """ Returns an IPC Message encoded as bytes """
+
+        msg_type = message.get_msg_type()
+        msg_val = message.get_msg_val()
+        return MSGPACK_MARKER + msgpack.packb(
+            [MSG_TYPE_CODES.get(msg_type, msg_type), MSG_VAL_CODES.get(msg_val, msg_val),
+             message.attrs.get("params", {})], use_bin_type=True)
+
+    def decode(self, data):
+        """ Returns the IPC Message encoded in data """
+
+        try:
+            msg_type, msg_val, params = msgpack.unpackb(data[1:], raw=False)
+            message = IpcMessage(MSG_TYPE_NAMES.get(msg_type, msg_type),
+                                 MSG_VAL_NAMES.get(msg_val, msg_val))
+            for name, value in params.items():
+                message.set_param(name, value)
+        except (ValueError, TypeError, AttributeError, msgpack.UnpackException) as err:
+            raise IpcMessageException("Illegal message msgpack format: " + str(err))
+        return check_message(message)
+
+
+CODECS = {"json": JsonCodec, "msgpack": MsgpackCodec}
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec() if msgpack is not None else None
+
+
+def get_codec(name):
+    """ Returns the codec called name, json or msgpack """
+
+    if name == "json":
+        return JSON_CODEC
+    if name == "msgpack":
+        return MSGPACK_CODEC or MsgpackCodec()
+    raise IpcMessageException("Unknown encoding %s, accepts: %s" % (name, sorted(CODECS)))
+
+
+def pack_arrays(params, frames):
+    """ Moves NumPy arrays out of reply parameters into binary frames
+
+    :param params: dictionary of parameters, arrays in it and in lists
+                of dictionaries in it (BATCH results) are replaced by
+                {FRAME, DTYPE, SHAPE} references
+    :param frames: list the raw array bytes are appended to
+    """
+    for name, value in params.items():
+        if hasattr(value, "tobytes"):
+            params[name] = {"FRAME": len(frames), "DTYPE": value.dtype.str,
+                            "SHAPE": list(value.shape)}
+            frames.append(value.tobytes())
+        elif isinstance(value, list):
+            for entry in value:
+                if isinstance(entry, dict):
+                    pack_arrays(entry, frames)
+
+
+def unpack_arrays(params, frames):
+    """ Replaces the frame references made by pack_arrays with NumPy arrays
+
+    :param params: dictionary of decoded parameters
+    :param frames: the frames received after the message frame
+    """
+    import numpy as np
+
+    for name, value in params.items():
+        if isinstance(value, dict) and "FRAME" in value:
+            params[name] = np.frombuffer(frames[value["FRAME"]],
+                                         dtype=value["DTYPE"]).reshape(value["SHAPE"])
+        elif isinstance(value, list):
+            for entry in value:
+                if isinstance(entry, dict):
+                    unpack_arrays(entry, frames)
+
+
+def detect_codec(data):
+    """ Returns the codec a received message was encoded with """
+
+    if data[:1] == MSGPACK_MARKER:
+        return get_codec("msgpack")
+    return JSON_CODEC
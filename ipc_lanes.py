@@ -0,0 +1,173 @@
+'''
+    Priority lanes for the requests waiting in ipc_server
+    Waiting requests are sorted into lanes by what they do: control
+    (CONFIG, FAULT) ahead of status (STATUS and the server queries) ahead
+    of bulk (READ, READ_HISTORY), so a CONFIG never queues behind a flood
+    of READs. Within a lane clients take turns, one request each, so one
+    busy client cannot crowd out the others.
+
+    Higher lanes always go first, except that the lower lanes with
+    requests waiting take turns to be served once every starvation_limit
+    requests, which keeps status and bulk moving under a steady stream of
+    control requests and costs a control request at most one lower
+    request of extra wait.
+
+    A client's requests to one device keep their order: a request is
+    queued no higher than an earlier request of the same client to the
+    same device that is still waiting, so a pipelined CONFIG never
+    overtakes the client's own READ before it.
+
+'''
+
+import itertools
+from collections import deque
+from odin_data.ipc_message import IpcMessageException
+
+
+#   Lane names, highest priority first
+LANES = ("control", "status", "bulk")
+CONTROL, STATUS, BULK = range(len(LANES))
+
+#   Lane of each message value, anything else is bulk
+MSG_VAL_LANES = {"CONFIG": CONTROL, "FAULT": CONTROL,
+                 "STATUS": STATUS, "STATS": STATUS, "RULES": STATUS, "PROFILE": STATUS}
+
+
+def request_devices(request):
+    """ Returns the device aliases a decoded request is for, in order
+
+    A BATCH is for the devices of all its entries. Anything but a string
+    alias is left out, as is everything if the request is None.
+    """
+    if request is None:
+        return []
+    try:
+        if request.get_msg_val() == "BATCH":
+            batch = request.get_param("BATCH")
+            aliases = [entry.get("DEVICE") for entry in batch if isinstance(entry, dict)] \
+                if isinstance(batch, list) else []
+        else:
+            aliases = [request.get_param("DEVICE")]
+    except IpcMessageException:
+        return []
+    return list(dict.fromkeys(alias for alias in aliases if isinstance(alias, str)))
+
+
+def request_lane(request):
+    """ Returns the lane of a decoded request, BULK if it is None
+
+    A BATCH goes in the lowest lane of its operations, so bulk work
+    cannot jump the queue by riding along with a CONFIG.
+    """
+    if request is None:
+        return BULK
+    msg_val = request.get_msg_val()
+    if msg_val != "BATCH":
+        return MSG_VAL_LANES.get(msg_val, BULK)
+    try:
+        return max([MSG_VAL_LANES.get(entry.get("OP"), BULK)
+                    for entry in request.get_param("BATCH")] or [BULK])
+    except (IpcMessageException, AttributeError, TypeError):
+        return BULK
+
+
+class LaneQueue:
+    """ Requests waiting to be served, by lane and then by client
+
+    :param starvation_limit: requests served from higher lanes before a
+                    waiting lower lane gets one
+
+    """
+
+    def __init__(self, starvation_limit=8):
+        self.starvation_limit = starvation_limit
+        # Per lane, the queue of each client with requests waiting
+        self.clients = [{} for lane in LANES]
+        # Per lane, the clients with requests waiting in turn order
+        self.turns = [deque() for lane in LANES]
+        self.depths = [0] * len(LANES)
+        # The (sequence, lane) of the waiting items of each (client, device)
+        self.keys = {}
+        self._sequence = itertools.count()
+        self._passed = 0
+        # The lower lane that last took the starvation slot
+        self._starved = 0
+
+    def __len__(self):
+        return sum(self.depths)
+
+    def depth(self, lane):
+        """ Returns the number of requests waiting in a lane """
+        return self.depths[lane]
+
+    def push(self, lane, client, item, devices=()):
+        """ Queues an item of a client in a lane
+
+        :param devices: the devices the item is for, it is queued no higher
+                    than a waiting item of the client for one of them
+        Returns the lane the item was queued in
+        """
+        keys = [(client, device) for device in devices]
+        for key in keys:
+            waiting = self.keys.get(key)
+            if waiting:
+                # Lanes only fall along a key's waiting items, the last is lowest
+                lane = max(lane, waiting[-1][1])
+
+        sequence = next(self._sequence)
+        for key in keys:
+            self.keys.setdefault(key, deque()).append((sequence, lane))
+
+        queue = self.clients[lane].get(client)
+        if queue is None:
+            queue = self.clients[lane][client] = deque()
+            self.turns[lane].append(client)
+        queue.append((sequence, keys, item))
+        self.depths[lane] += 1
+        return lane
+
+    def _blocked(self, lane):
+        """ Whether the next item of a lane waits on an earlier item of its
+        client for the same device in a higher lane """
+
+        sequence, keys, item = self.clients[lane][self.turns[lane][0]][0]
+        return any(self.keys[key][0][0] != sequence for key in keys)
+
+    def pop(self):
+        """ Returns the (lane, item) to serve next
+
+        Raises IndexError if nothing is waiting
+        """
+        waiting = [lane for lane, depth in enumerate(self.depths) if depth]
+        if not waiting:
+            raise IndexError("pop from an empty LaneQueue")
+
+        lane = waiting[0]
+        if len(waiting) > 1:
+            self._passed += 1
+            if self._passed > self.starvation_limit:
+                self._passed = 0
+                # The lower lanes take the slot in turn
+                lower = waiting[1:]
+                starved = ([other for other in lower if other > self._starved] or lower)[0]
+                self._starved = starved
+                # Unless its next item must wait for one in a higher lane
+                if not self._blocked(starved):
+                    lane = starved
+        else:
+            self._passed = 0
+
+        client = self.turns[lane].popleft()
+        queue = self.clients[lane][client]
+        sequence, keys, item = queue.popleft()
+        if queue:
+            self.turns[lane].append(client)
+        else:
+            del self.clients[lane][client]
+        for key in keys:
+            waiting = self.keys[key]
+            waiting.popleft()
+            if not waiting:
+                del self.keys[key]
+        self.depths[lane] -= 1
+        return lane, item
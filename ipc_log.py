@@ -0,0 +1,106 @@
+'''
+    Logging for ipc_server and ipc_client
+    Records are put on a queue by the thread that logs them and written
+    by a background thread, so serving a request never waits on the
+    terminal or a file. Records carry structured fields (client, board, device,
+    op, duration, error) written as key=value pairs or JSON lines.
+
+'''
+
+import sys
+import json
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+
+#   Structured fields a record may carry, passed as extra={...}
+FIELDS = ("client", "board", "device", "op", "duration", "error")
+FORMATS = {"text", "json"}
+
+
+class StructuredFormatter(logging.Formatter):
+    """ Formats a record as text followed by its fields as key=value """
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = " ".join("%s=%s" % (name, getattr(record, name))
+                          for name in FIELDS if getattr(record, name, None) is not None)
+        return "%s %s" % (line, fields) if fields else line
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as one JSON object per line """
+
+    def format(self, record):
+        entry = {"time": record.created, "level": record.levelname,
+                 "logger": record.name, "message": record.getMessage()}
+        for name in FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class _QueueHandler(QueueHandler):
+    """ Queues records as they are, formatting happens on the listener thread
+
+    QueueHandler.prepare formats the message in the logging thread so the
+    record can be pickled, an in-process queue does not need that.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+_listener = None
+
+
+def configure_logging(level="INFO", path=None, format="text"):
+    """ Sends the femii loggers to stderr or a file through a background thread
+
+    :param level: lowest level written, a logging level name
+    :param path: file to append to, stderr if None
+    :param format: text for key=value fields or json for JSON lines
+    Safe to call again, the previous configuration is replaced
+    """
+    global _listener
+
+    handler = logging.FileHandler(path) if path else logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if format == "json" else StructuredFormatter())
+
+    logger = logging.getLogger("femii")
+    if _listener is not None:
+        _listener.stop()
+    logger.handlers = []
+
+    records = queue.Queue()
+    _listener = QueueListener(records, handler)
+    _listener.start()
+    logger.addHandler(_QueueHandler(records))
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+
+def stop_logging():
+    """ Writes any queued records and stops the background thread """
+
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
+def get_logger(name):
+    """ Returns the logger for a part of femii e.g. server or client """
+
+    return logging.getLogger("femii.%s" % name)
@@ -0,0 +1,237 @@
+'''
+    Request metrics for ipc_server
+    Counts requests and errors and keeps latency histograms for each
+    device and message value, split into the decode, dispatch, device
+    and encode stages of handling a request. Cheap enough to leave on:
+    recording a request is one lock and a bisect per stage.
+    Callers record unknown devices and ops as UNKNOWN, so a client making
+    up names cannot grow the metrics without bound.
+    The depth of each priority lane and how long requests waited in it
+    are kept too, see ipc_lanes.
+
+'''
+
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from ipc_lanes import LANES
+
+
+#   Stages of handling a request, in order
+STAGES = ("decode", "dispatch", "device", "encode")
+
+#   Histogram bucket upper bounds in seconds, 1us to ~16s in powers of two
+BUCKETS = tuple(2 ** x * 1e-6 for x in range(25))
+_bisect_left = bisect.bisect_left
+
+#   Device or op recorded for a request naming one the server does not have
+UNKNOWN = "unknown"
+
+
+def escape_label(value):
+    """ Escapes a Prometheus label value """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    """ Fixed bucket latency histogram """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """ Adds a value in seconds """
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, fraction):
+        """ Returns the upper bound of the bucket holding a percentile """
+
+        if self.count == 0:
+            return 0.0
+        target = fraction * self.count
+        total = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            total += count
+            if total >= target:
+                return bound
+        return float("inf")
+
+    def summary(self):
+        """ Returns the count, mean and approximate percentiles in seconds """
+
+        return {"count": self.count,
+                "mean": self.sum / self.count if self.count else 0.0,
+                "p50": self.percentile(0.5), "p99": self.percentile(0.99),
+                "p999": self.percentile(0.999)}
+
+
+class RequestMetrics:
+    """ Request counters and stage latency histograms per device and op """
+
+    def __init__(self):
+        self.requests = {}
+        self.errors = {}
+        self.rejected = {}
+        self.latency = {}
+        self.backlog = 0
+        self.lane_depths = [0] * len(LANES)
+        self.lane_wait = [Histogram() for lane in LANES]
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, device, op, timings, error=False):
+        """ Records one handled request
+
+        :param device: the alias of the target device, "" if none,
+                    UNKNOWN if it is not one of the server's
+        :param op: the message value of the request, "" if not decoded,
+                    UNKNOWN if the server does not handle it
+        :param timings: seconds spent in each of the STAGES, in order
+        :param error: True if the request failed
+        """
+        key = (device or "", op or "")
+        with self._lock:
+            histograms = self.latency.get(key)
+            if histograms is None:
+                histograms = self.latency[key] = [Histogram() for stage in STAGES]
+                self.requests[key] = 0
+                self.errors[key] = 0
+            self.requests[key] += 1
+            if error:
+                self.errors[key] += 1
+            # Histogram.observe inlined, this runs for every request
+            for histogram, timing in zip(histograms, timings):
+                histogram.counts[_bisect_left(BUCKETS, timing)] += 1
+                histogram.count += 1
+                histogram.sum += timing
+
+    def record_rejected(self, reason):
+        """ Counts a request turned away before it ran, see ipc_admission """
+
+        with self._lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+    def set_backlog(self, backlog):
+        """ Sets the number of requests waiting to be served """
+        self.backlog = backlog
+
+    def set_lane_depths(self, depths):
+        """ Sets the number of requests waiting in each lane """
+        self.lane_depths = list(depths)
+
+    def record_wait(self, lane, wait):
+        """ Records the seconds a request waited in a lane before it ran """
+
+        with self._lock:
+            self.lane_wait[lane].observe(wait)
+
+    def snapshot(self):
+        """ Returns the metrics as a dictionary, keyed by DEVICE/OP """
+
+        with self._lock:
+            return {"uptime": time.time() - self.started,
+                    "backlog": self.backlog,
+                    "requests": {"%s/%s" % key: count for key, count in self.requests.items()},
+                    "errors": {"%s/%s" % key: count for key, count in self.errors.items()},
+                    "rejected": dict(self.rejected),
+                    "lanes": {name: {"depth": depth, "wait": histogram.summary()}
+                              for name, depth, histogram in zip(LANES, self.lane_depths,
+                                                                self.lane_wait)},
+                    "latency": {"%s/%s" % key: {stage: histogram.summary()
+                                                for stage, histogram in zip(STAGES, histograms)}
+                                for key, histograms in self.latency.items()}}
+
+    def prometheus(self, prefix="femii"):
+        """ Returns the metrics in the Prometheus text exposition format """
+
+        lines = ["# TYPE %s_requests_total counter" % prefix]
+        with self._lock:
+            for (device, op), count in sorted(self.requests.items()):
+                lines.append('%s_requests_total{device="%s",op="%s"} %d'
+                             % (prefix, escape_label(device), escape_label(op), count))
+
+            lines.append("# TYPE %s_errors_total counter" % prefix)
+            for (device, op), count in sorted(self.errors.items()):
+                lines.append('%s_errors_total{device="%s",op="%s"} %d'
+                             % (prefix, escape_label(device), escape_label(op), count))
+
+            lines.append("# TYPE %s_rejected_total counter" % prefix)
+            for reason, count in sorted(self.rejected.items()):
+                lines.append('%s_rejected_total{reason="%s"} %d'
+                             % (prefix, escape_label(reason), count))
+
+            lines.append("# TYPE %s_request_stage_seconds histogram" % prefix)
+            for (device, op), histograms in sorted(self.latency.items()):
+                for stage, histogram in zip(STAGES, histograms):
+                    labels = 'device="%s",op="%s",stage="%s"' % (escape_label(device),
+                                                                 escape_label(op), stage)
+                    total = 0
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        total += count
+                        lines.append('%s_request_stage_seconds_bucket{%s,le="%g"} %d'
+                                     % (prefix, labels, bound, total))
+                    lines.append('%s_request_stage_seconds_bucket{%s,le="+Inf"} %d'
+                                 % (prefix, labels, histogram.count))
+                    lines.append("%s_request_stage_seconds_sum{%s} %.9f"
+                                 % (prefix, labels, histogram.sum))
+                    lines.append("%s_request_stage_seconds_count{%s} %d"
+                                 % (prefix, labels, histogram.count))
+
+            lines.append("# TYPE %s_backlog gauge" % prefix)
+            lines.append("%s_backlog %d" % (prefix, self.backlog))
+
+            lines.append("# TYPE %s_lane_depth gauge" % prefix)
+            for name, depth in zip(LANES, self.lane_depths):
+                lines.append('%s_lane_depth{lane="%s"} %d' % (prefix, name, depth))
+
+            lines.append("# TYPE %s_lane_wait_seconds histogram" % prefix)
+            for name, histogram in zip(LANES, self.lane_wait):
+                total = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    total += count
+                    lines.append('%s_lane_wait_seconds_bucket{lane="%s",le="%g"} %d'
+                                 % (prefix, name, bound, total))
+                lines.append('%s_lane_wait_seconds_bucket{lane="%s",le="+Inf"} %d'
+                             % (prefix, name, histogram.count))
+                lines.append('%s_lane_wait_seconds_sum{lane="%s"} %.9f'
+                             % (prefix, name, histogram.sum))
+                lines.append('%s_lane_wait_seconds_count{lane="%s"} %d'
+                             % (prefix, name, histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_metrics(metrics, port):
+    """ Serves metrics.prometheus() over HTTP on a background thread
+
+    :param metrics: the RequestMetrics to expose
+    :param port: the tcp port to listen on, any path returns the metrics
+    Returns the HTTP server
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _ThreadingHTTPServer(("", int(port)), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True)
+    thread.start()
+    return server
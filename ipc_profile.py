@@ -0,0 +1,152 @@
+'''
+    Sampling profiler for a running ipc_server
+    Started and stopped by PROFILE requests, so a board can be profiled
+    while it misbehaves rather than after a restart under cProfile.
+
+    While it runs, a background thread takes the stack of every other
+    thread (run_rep, workers, the scheduler...) each interval. Nothing is
+    hooked into the interpreter, so the server runs at full speed when no
+    profile is running and pays only for the sampling thread while one is.
+    Stacks are written in collapsed form, one "thread;outer;...;inner count"
+    line per distinct stack, for flamegraph.pl or speedscope.
+
+'''
+
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+
+#   Longest profile a PROFILE request may start
+MAX_SECONDS = 600
+
+#   Shortest interval between samples a PROFILE request may ask for
+MIN_INTERVAL = 0.001
+
+
+def frame_name(code):
+    """ Returns the name a code object is shown by """
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class SamplingProfiler:
+    """ Samples the stacks of every thread of the process
+
+    :param interval: seconds between samples
+
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.seconds = 0.0
+        self.path = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, path, interval=None):
+        """ Starts sampling for a number of seconds, returns at once
+
+        :param seconds: seconds to sample for, stopped early by stop()
+        :param path: the collapsed stack file written when sampling ends
+        :param interval: seconds between samples, self.interval if None
+        Raises RuntimeError if a profile is already running
+        """
+        with self.lock:
+            if self.running:
+                raise RuntimeError("A profile is already running, until %s"
+                                   % time.ctime(self.started + self.seconds))
+            if interval is not None:
+                self.interval = float(interval)
+            self.stacks = Counter()
+            self.samples = 0
+            self.started = time.time()
+            self.seconds = float(seconds)
+            self.path = path
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name="SamplingProfiler",
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ Stops a running profile and waits for its file to be written """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        """ Sampling loop, see start """
+
+        own = threading.get_ident()
+        end = time.monotonic() + self.seconds
+        stacks = Counter()
+        samples = 0
+        while not self._stop.wait(self.interval) and time.monotonic() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread-%d" % ident))
+                stacks[tuple(reversed(stack))] += 1
+            samples += 1
+
+        with self.lock:
+            self.stacks = stacks
+            self.samples = samples
+            self.seconds = time.time() - self.started
+        self.write(self.path)
+
+    def write(self, path):
+        """ Writes the collapsed stacks of the last profile to a file """
+
+        with open(path, "w") as collapsed:
+            for stack, count in self.stacks.most_common():
+                names = [stack[0]] + [frame_name(code) for code in stack[1:]]
+                collapsed.write("%s %d\n" % (";".join(names), count))
+
+    def top(self, count=10):
+        """ Returns the functions most often on top of a sampled stack
+
+        Each entry has the FUNCTION, its SELF samples (running it) and
+        TOTAL samples (running it or something it called), hottest first.
+        Threads waiting in zmq or a sleep count as samples of that wait.
+        """
+        hits = Counter()
+        totals = Counter()
+        with self.lock:
+            for stack, samples in self.stacks.items():
+                if len(stack) < 2:
+                    continue
+                hits[stack[-1]] += samples
+                for code in set(stack[1:]):
+                    totals[code] += samples
+            thread_samples = sum(self.stacks.values())
+
+        return [{"FUNCTION": frame_name(code), "SELF": samples, "TOTAL": totals[code],
+                 "SELF_PERCENT": round(100.0 * samples / thread_samples, 1)}
+                for code, samples in hits.most_common(count)]
+
+    def result(self, count=10):
+        """ Returns the reply parameters describing the last profile """
+
+        with self.lock:
+            result = {"PROFILING": self.running, "SAMPLES": self.samples,
+                      "SECONDS": self.seconds, "PATH": self.path}
+        if not result["PROFILING"] and self.path is not None:
+            result["TOP"] = self.top(count)
+        return result
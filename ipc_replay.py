@@ -0,0 +1,163 @@
+'''
+    Replays a capture made with ipc_server --capture
+    The captured requests are sent again from one socket per original
+    client, at their captured pace scaled by --speed or, with --speed 0,
+    as fast as --window requests in flight allows. Prints one JSON result
+    comparing the replayed latencies with the captured ones.
+
+    Captured latencies are measured in the server, from arrival to reply,
+    while replayed latencies are measured here and include the network.
+
+'''
+
+import zmq
+import time
+import json
+import argparse
+from odin_data.ipc_message import IpcMessageException
+from ipc_capture import read_capture
+from ipc_codec import detect_codec, get_optional_param
+from ipc_transport import connect_endpoint, make_url
+from ipc_bench import latency_summary
+
+
+def prepare_requests(records):
+    """ Readies captured requests to be sent again
+
+    :param records: (arrived, latency, client, request) capture records,
+                in the order they were written
+    Returns a list of (offset, client, request, latency) in arrival order,
+    offset being the seconds since the first request arrived. Each request
+    gets its index in the list as its MSG_ID so replies can be matched,
+    and its DEADLINE, long passed, is dropped.
+    """
+    requests = []
+    first = None
+    # Written as they were answered, which priority lanes reorder
+    for arrived, latency, client, request in sorted(records, key=lambda record: record[0]):
+        if first is None:
+            first = arrived
+        codec = detect_codec(request)
+        try:
+            message = codec.decode(request)
+        except IpcMessageException:
+            continue
+        message.attrs.get("params", {}).pop("DEADLINE", None)
+        message.set_param("MSG_ID", len(requests))
+        requests.append((arrived - first, client, codec.encode(message), latency))
+    return requests
+
+
+def replay(url, requests, speed=1.0, window=1000, clients=64, timeout=5.0):
+    """ Sends captured requests to a server and times the replies
+
+    :param url: the server endpoint
+    :param requests: list of (offset, client, request, latency) from prepare_requests
+    :param speed: multiple of the captured pace, 0 sends as fast as window allows
+    :param window: most requests in flight at once
+    :param clients: most sockets opened, original clients share them beyond this
+    :param timeout: seconds without a reply before the requests in flight are lost
+    Returns a result dictionary
+    """
+    context = zmq.Context()
+    poller = zmq.Poller()
+    sockets = {}
+    opened = []
+    pending = {}
+    latencies = []
+    originals = []
+    errors = 0
+    lost = 0
+    index = 0
+
+    start = time.perf_counter()
+    last_reply = start
+    while index < len(requests) or pending:
+        # Send everything that is due
+        now = time.perf_counter()
+        while index < len(requests) and len(pending) < window:
+            offset, client, request, latency = requests[index]
+            if speed and start + offset / speed > now:
+                break
+            socket = sockets.get(client)
+            if socket is None:
+                if len(opened) < clients:
+                    socket = context.socket(zmq.DEALER)
+                    socket.setsockopt(zmq.IDENTITY, b"Replay " + client)
+                    socket.setsockopt(zmq.LINGER, 0)
+                    connect_endpoint(socket, url)
+                    poller.register(socket, zmq.POLLIN)
+                    opened.append(socket)
+                else:
+                    socket = opened[len(sockets) % clients]
+                sockets[client] = socket
+            socket.send(request)
+            pending[index] = (time.perf_counter(), latency)
+            index += 1
+
+        wait = timeout
+        if index < len(requests) and speed and len(pending) < window:
+            wait = min(wait, start + requests[index][0] / speed - time.perf_counter())
+        events = poller.poll(max(0.0, wait) * 1000)
+
+        for socket, event in events:
+            empty, reply, *frames = socket.recv_multipart()
+            received = time.perf_counter()
+            reply = detect_codec(reply).decode(reply)
+            sent = pending.pop(get_optional_param(reply, "MSG_ID"), None)
+            if sent is None:
+                continue
+            latencies.append(received - sent[0])
+            originals.append(sent[1])
+            errors += get_optional_param(reply, "ERROR") is not None
+            last_reply = received
+
+        if pending and not events and time.perf_counter() - last_reply > timeout:
+            lost += len(pending)
+            pending.clear()
+            last_reply = time.perf_counter()
+
+    elapsed = time.perf_counter() - start
+    for socket in opened:
+        socket.close()
+
+    result = {"bench": "replay", "speed": speed, "requests": len(requests),
+              "replies": len(latencies), "errors": errors, "lost": lost,
+              "seconds": elapsed, "captured_seconds": requests[-1][0] if requests else 0.0,
+              "throughput": len(latencies) / elapsed if elapsed else 0.0,
+              "replay": latency_summary(latencies), "captured": latency_summary(originals)}
+    if latencies:
+        result["change_us"] = {name: result["replay"]["latency_us"][name]
+                               - result["captured"]["latency_us"][name]
+                               for name in ("p50", "p90", "p99", "max")}
+    return result
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture", help="Capture file written by ipc_server --capture")
+    parser.add_argument("-url", "--url", help="Server url, default = tcp://localhost",
+                        default="tcp://localhost")
+    parser.add_argument("-port", "--port", help="Port connection, default = 5555",
+                        default="5555")
+    parser.add_argument("-speed", "--speed", type=float, default=1.0,
+                        help="Multiple of the captured pace, 0 for as fast as possible, \
+                        default = 1")
+    parser.add_argument("-window", "--window", type=int, default=1000,
+                        help="Most requests in flight, default = 1000")
+    parser.add_argument("-clients", "--clients", type=int, default=64,
+                        help="Most client sockets, captured clients share them beyond \
+                        this, default = 64")
+    parser.add_argument("-timeout", "--timeout", type=float, default=5.0,
+                        help="Seconds without a reply before giving up on the requests \
+                        in flight, default = 5")
+    args = parser.parse_args()
+
+    requests = prepare_requests(read_capture(args.capture))
+    print(json.dumps(replay(make_url(args.url, args.port), requests, args.speed,
+                            args.window, args.clients, args.timeout)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,382 @@
 '''
-    Server with three emulated hardware devices
+    Server with emulated hardware devices, three by default
+    or as many as a --config device file describes
     Communicates with N number of ipc_clients
+    over tcp by default, or any --endpoint tcp://, ipc:// or inproc:// urls
+    Requests past their DEADLINE are dropped, and clients over their rate
+    or beyond a full queue get a BUSY reply
     Uses Ipc Message formatting
+    With --workers N, requests are brokered to N worker threads
+    A READ with COUNT takes a burst of readings, returned as raw arrays
+    in extra frames after the reply
+    Replies carry typed parameters, VALUE, UNIT, ADDRESS, TIMESTAMP and
+    STATUS_CODE; the prose REPLY of old clients is sent only to requests
+    with LEGACY set, or to all with --legacy_replies
+    A PROFILE request samples every thread of the running server for a
+    while and reports the hottest functions, see ipc_profile
+    With --rules, interlock and alarm rules are checked on every reading,
+    see hd_rules, and a RULES request returns their hit counters
+    Sensor readings are simulated, see hd_sim: --seed with --sim_clock
+    ticks makes them reproducible and a FAULT request injects a fault
+    into a sensor
+    Waiting requests are served by priority lane, CONFIG ahead of STATUS
+    ahead of READ, taking turns between clients, see ipc_lanes
 
 
 '''
 
+import os
 import zmq
+import time
+import struct
+import tempfile
 import argparse
+import itertools
+import threading
+from collections import deque
 from odin_data.ipc_message import IpcMessage, IpcMessageException
 from HD_DEVICES import HdLed, HdPower, HdTemp
-from zmq.utils.strtypes import unicode, cast_bytes
+from hd_registry import DeviceRegistry, DeviceRegistryError
+from hd_backend import BACKENDS, SimulatedBackend
+from ipc_telemetry import TelemetryPublisher
+from ipc_metrics import UNKNOWN, RequestMetrics, serve_metrics
+from hd_history import SampleHistory, downsample
+from ipc_codec import JSON_CODEC, STATUS_CODES, STATUS_OK, detect_codec, pack_arrays, \
+    get_optional_param
+from ipc_log import FORMATS, configure_logging, get_logger
+from ipc_transport import bind_endpoint, parse_endpoint
+from ipc_admission import RateLimiter, RequestRejected, RATE_LIMITED, QUEUE_FULL, EXPIRED
+from ipc_capture import CaptureWriter
+from hd_state import StateStore
+from ipc_profile import SamplingProfiler, MAX_SECONDS, MIN_INTERVAL
+from hd_rules import RuleEngine, RuleError
+from hd_sim import SensorSimulator, TickClock, set_default_simulator
+from ipc_lanes import LaneQueue, request_devices, request_lane
 
 
 MSG_TYPES = {"CMD"}
-MSG_VALS = {"STATUS", "CONFIG", "NOTIFY"}
+MSG_VALS = {"STATUS", "CONFIG", "READ", "READ_HISTORY", "BATCH", "STATS", "PROFILE",
+            "RULES", "FAULT", "NOTIFY"}
 HD_ADDR = {"0X01", "0X02", "0X03"}
+WORKER_URL = "inproc://workers"
+
+#   Most queued requests run_rep takes off the socket at once
+BACKLOG_DRAIN = 100
+
+#   Default most requests waiting in a lane before new ones are BUSY
+QUEUE_LIMIT = 1000
+
+#   Requests served from higher lanes before a waiting lower lane gets one
+LANE_STARVATION = 8
+
+#   Most requests handed to one worker thread and not yet answered
+WORKER_CREDIT = 2
+
+#   Arrival time frame handed to a worker with each request, for the capture
+ARRIVAL = struct.Struct("<d")
+
+log = get_logger("server")
+
+#   Most readings one burst READ can take
+MAX_BURST = 100000
+
+#   Default longest COUNT * INTERVAL of a burst READ, a burst holds the
+#   serving thread and its device for that long
+MAX_BURST_SECONDS = 0.5
+
+#   Most buckets a READ_HISTORY can downsample into
+MAX_BUCKETS = 10000
+
+#   Optional parameters of a device operation
+OPERATION_PARAMS = ("CONFIG", "TIMEOUT", "RATE", "MAX_AGE", "START", "END", "BUCKETS",
+                    "COUNT", "INTERVAL", "VALUE", "LEGACY")
+
+
+def check_number(name, value, low=None, high=None, whole=False, coerce=False):
+    ''' Returns a numeric request parameter, None if it is not set
+
+    :param name: the parameter name, for the error message
+    :param value: the parameter value
+    :param low: the smallest value accepted, if any
+    :param high: the largest value accepted, if any
+    :param whole: whether only whole numbers are accepted
+    :param coerce: whether a number sent as text, e.g. "5", is accepted
+    Raises IpcMessageException if the value is of the wrong type or out
+    of range, so a bad parameter gets an ERROR reply
+    '''
+
+    if value is None:
+        return None
+    if coerce and isinstance(value, str):
+        try:
+            value = float(value)
+            if whole and value.is_integer():
+                value = int(value)
+        except ValueError:
+            pass
+    kind = "a whole number" if whole else "a number"
+    if isinstance(value, bool) or not isinstance(value, int if whole else (int, float)) \
+            or value != value:
+        raise IpcMessageException("%s must be %s, not %r" % (name, kind, value))
+    if low is not None and value < low:
+        raise IpcMessageException("%s must be at least %s" % (name, low))
+    if high is not None and value > high:
+        raise IpcMessageException("%s must be at most %s" % (name, high))
+    return value
+
+
+def error_status(err):
+    ''' Returns the STATUS_CODE of a reply reporting an error '''
+
+    if isinstance(err, RequestRejected):
+        return STATUS_CODES["EXPIRED" if err.reason == EXPIRED else "BUSY"]
+    if isinstance(err, DeviceRegistryError):
+        return STATUS_CODES["NO_DEVICE"]
+    return STATUS_CODES["ERROR"]
+
+
+class ReplyTemplate:
+    """ The parts of a device's replies that are the same for every request
+
+    Built once when the device is registered, so a reply only adds what
+    the request changed.
+
+    :param device: the HdDevice replied for
+    """
+
+    def __init__(self, device):
+        self.address = device.get_addr()
+        self.fields = {"DEVICE": device.get_alias(), "ADDRESS": self.address,
+                       "STATUS_CODE": STATUS_OK}
+        where = "%s at address %s" % (device.get_alias(), self.address)
+        # Legacy REPLY sentences, by operation
+        self.replies = {"READ": "Value of %s is: %%s." % where,
+                        "BURST": "Burst of %%d readings of %s." % where,
+                        "CONFIG": "Set %s to: %%s." % where,
+                        "BLINK": "%s is blinking for %%s seconds. Current status is %%s." % where,
+                        "STATUS": "Status of %s is: %%s." % where,
+                        "FAULT": "Injected %%s fault into %s." % where,
+                        "READ_HISTORY": "History of %s has %%d samples." % where}
+
+    def reply(self, client_address, operation, *values):
+        """ Returns the legacy REPLY string of an operation """
+
+        return "Processed Request from %s. %s" % (client_address.decode(errors="replace"),
+                                                  self.replies[operation] % values)
 
 
 class IpcServer:
 
-    def __init__(self, port):
+    def __init__(self, port, config=None, backend=None, endpoints=None):
+        """ Constructor
+
+        :param port: the tcp port to bind
+        :param config: path of a JSON device configuration file, 
+                    None registers one LED, TEMP and POWER device
+        :param backend: the HdBackend the devices are attached to,
+                    the default backend if None
+        :param endpoints: list of endpoints to bind instead of tcp on port,
+                    each a url with optional socket options, see ipc_transport
+        """
 
         ident = 'FEMII-ZYNQ'
         self.identity = "Server %s" % ident
-        self.url = "tcp://*:%s" % port
+        self.endpoints = list(endpoints or ["tcp://*:%s" % port])
+        for endpoint in self.endpoints:
+            parse_endpoint(endpoint)
+        self.url = parse_endpoint(self.endpoints[0])[0]
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.ROUTER)
         self.socket.setsockopt(zmq.IDENTITY, self.identity.encode())
-        self.address_pool = ["0X01", "0X02", "0X03", "0X04", "0X05"]
-        self.devices = [HdLed(), HdTemp(), HdPower()]
+        self.registry = DeviceRegistry()
+        if config is None:
+            for device in [HdLed(backend=backend), HdTemp(backend=backend), 
+                           HdPower(backend=backend)]:
+                self.registry.register(device)
+        else:
+            self.registry.load_file(config, backend)
         self.lookup = {}
+        self.templates = {}
+        # Send the prose REPLY to requests that do not set LEGACY themselves
+        self.legacy_replies = False
+        self.shards = {}
+        self.num_workers = 0
+        # Log every log_every'th request served, 0 logs none
+        self.log_every = 0
+        self._log_count = itertools.count()
+        self.telemetry = None
+        self.capture = None
+        self.state = None
+        self.rules = None
+        self.queue_limit = QUEUE_LIMIT
+        self.max_burst_seconds = MAX_BURST_SECONDS
+        self.limiter = RateLimiter()
+        self.metrics = RequestMetrics()
+        self.request_timing = threading.local()
+        # Idle until a PROFILE request starts it
+        self.profiler = SamplingProfiler()
+        self.profile_dir = tempfile.gettempdir()
 
     def bind(self):
-        """ binds the zmq socket """
-        self.socket.bind(self.url)
+        """ binds the zmq socket to every endpoint """
+        for endpoint in self.endpoints:
+            bind_endpoint(self.socket, endpoint)
 
-    def assign_addresses(self):
-        ''' Assign addresses to hardware devices.
-        
-        Assigns an address from address_pool to 
-        all registered hardware devices in self.devices
+    def start_telemetry(self, port, period=1.0):
+        """ Starts publishing device readings on a PUB socket
+
+        :param port: the tcp port to publish on
+        :param period: seconds between samples
+        """
+        self.telemetry = TelemetryPublisher(self.context, "tcp://*:%s" % port,
+                                            self.registry, period)
+        self.telemetry.start()
+
+    def start_metrics_endpoint(self, port):
+        """ Serves the request metrics as Prometheus text over HTTP 
+
+        :param port: the tcp port to listen on
+        """
+        return serve_metrics(self.metrics, port)
+
+    def start_capture(self, path):
+        """ Appends every request served to a capture file for ipc_replay
+
+        :param path: the capture file, appended to if it exists
+        """
+        self.capture = CaptureWriter(path)
+
+    def load_state(self, path):
+        """ Restores device addresses and configuration from a snapshot,
+        then saves every change to it
+
+        :param path: the snapshot file, created if it does not exist
+        Returns the number of devices restored
+        """
+        self.state = StateStore(path)
+        restored = 0
+        for alias, state in self.state.load().items():
+            if alias not in self.registry:
+                continue
+            device = self.registry.get(alias)
+            try:
+                if state.get("address") not in (None, device.get_addr()):
+                    self.registry.move(alias, state["address"])
+            except DeviceRegistryError as err:
+                log.warning("Address not restored", extra={"device": alias, "error": str(err)})
+            if state.get("config") is not None:
+                with device.lock:
+                    try:
+                        device.set_config(state["config"])
+                    except ValueError as err:
+                        log.warning("Configuration not restored",
+                                    extra={"device": alias, "error": str(err)})
+                    device.invalidate()
+            restored += 1
+
+        # Start the new snapshot from every device as it now is
+        self.state.states = {device.get_alias(): {"address": device.get_addr(),
+                                                  "config": device.get_state()}
+                             for device in self.registry}
+        self.state.start()
+        return restored
+
+    def load_rules(self, path):
+        """ Compiles the rules of a JSON rules file onto the devices
+
+        :param path: the rules file, see hd_rules
+        Returns the number of rules compiled, one per matching device.
+        Raises RuleError if a rule is malformed.
+        """
+        self.rules = RuleEngine(self.registry, self.apply_rule_action, self.notify_rule)
+        self.rules.load_file(path)
+        return len(self.rules.rules)
+
+    def apply_rule_action(self, alias, params):
+        """ Runs the CONFIG action of a fired rule as a request would """
+        self.run_operation(b"rules", alias, "CONFIG", params)
+
+    def notify_rule(self, rule, value):
+        """ Logs a fired rule and publishes its alarm on the telemetry socket """
+
+        device = rule.device
+        log.warning("Rule %s fired at %s", rule.name, value,
+                    extra={"device": device.get_alias(), "op": "RULE", "error": rule.error})
+        if self.telemetry is not None:
+            alarm = IpcMessage(msg_type="CMD", msg_val="ALARM")
+            alarm.set_param("RULE", rule.name)
+            alarm.set_param("DEVICE", device.get_alias())
+            alarm.set_param("ADDRESS", device.get_addr())
+            alarm.set_param("VALUE", value)
+            alarm.set_param("UNIT", device.get_unit())
+            alarm.set_param("HITS", rule.hits)
+            alarm.set_param("TIMESTAMP", rule.last_fired)
+            self.telemetry.send_alarm(rule.name, alarm)
+
+    def start_history_sampler(self, period):
+        """ Takes a reading from every numeric device each period
+
+        Keeps the device histories filled whether or not clients poll.
+
+        :param period: seconds between readings
+        """
+        thread = threading.Thread(target=self.run_history_sampler, args=(float(period),),
+                                  name="HistorySampler", daemon=True)
+        thread.start()
+
+    def run_history_sampler(self, period):
+        """ History sampling loop, see start_history_sampler """
+
+        next_sample = time.monotonic()
+        while True:
+            for device in self.registry:
+                if device.get_unit() is not None:
+                    with device.lock:
+                        device.read_value()
+            next_sample += period
+            time.sleep(max(0.0, next_sample - time.monotonic()))
+
+    def add_device_time(self, start):
+        """ Adds the time since start to the device stage of this request """
+
+        timing = self.request_timing
+        timing.device = getattr(timing, "device", 0.0) + time.perf_counter() - start
+
+    @property
+    def devices(self):
+        """ List of all registered hardware devices """
+        return list(self.registry)
+
+    def register_device(self, device, address=None):
+        ''' Registers a hardware device while the server is running
+
+        :param device: the HdDevice to register
+        :param address: bus address for the device, allocated if None
+        Returns the address of the device
         '''
 
-        x = 0
-        for device in self.devices:
-            if x < len(self.address_pool):
-                device.set_addr(self.address_pool[x])
-                x += 1
+        address = self.registry.register(device, address)
+        self.lookup[device.get_alias()] = address
+        self.templates[device.get_alias()] = ReplyTemplate(device)
+        if self.rules is not None:
+            self.rules.attach(device)
+        if self.state is not None:
+            self.state.record(device.get_alias(), address, device.get_state())
+        return address
 
     def make_lookup(self):
         ''' Generates list of alias names and their addresses '''
 
-        for device in self.devices:
-            address = device.get_addr()
-            alias = device.get_alias()
-            self.lookup[alias] = address
+        self.lookup = self.registry.lookup()
+        self.templates = {device.get_alias(): ReplyTemplate(device) for device in self.registry}
+
+    def get_template(self, device):
+        ''' Returns the ReplyTemplate of a device, rebuilt if it has moved '''
+
+        template = self.templates.get(device.get_alias())
+        if template is None or template.address != device.get_addr():
+            template = self.templates[device.get_alias()] = ReplyTemplate(device)
+        return template
 
     def process_address(self, request):
         ''' Return the address of the alias in request
@@ -66,80 +387,727 @@ class IpcServer:
         '''
 
         _alias = request.get_param("DEVICE")
-        for device in self.devices:
-            if _alias == device.get_alias():
-                address = device.get_addr()
-
-        return address
+        return self.registry.get(_alias).get_addr()
     
-    def run_rep(self):
-        ''' sends a request, waits for a reply, returns response  '''
+    def run_operation(self, client_address, req_alias, req_msg_val, req_params):
+        ''' Runs one operation on a device
 
-        while True:
+        :param client_address: the identity frame of the requesting client
+        :param req_alias: the alias of the target device
+        :param req_msg_val: the operation, CONFIG/STATUS/READ/READ_HISTORY/FAULT
+        :param req_params: dictionary of the optional OPERATION_PARAMS,
+                        unset parameters are None
+        Returns a dictionary of typed reply parameters, with the REPLY
+        string as well if LEGACY is set or legacy_replies is on
 
-            try:
-                client_address, request = self.socket.recv_multipart()
-                request = IpcMessage(from_str=request)
-                print("received request : %s from %s" % 
-                    (request, client_address.decode()))
-                
-                # Get the alias device name used in the request
-                req_alias = request.get_param("DEVICE")
-                
-                # get the address of the device
-                req_address = self.process_address(request)
-
-                # get the message value (CONFIG/STATUS/READ)
-                req_msg_val = request.get_msg_val()
-                req_device = None
-                req_config = None
-
-                reply_message = IpcMessage(msg_type="CMD", msg_val="NOTIFY")
-                
-                # Find the device attached to that request address
-                for device in self.devices:
-                    if req_address == device.get_addr():
-                        req_device = device
-
-                if req_msg_val == "CONFIG":
-                    req_config = request.get_param("CONFIG")
+        '''
+
+        # Find the device and the fixed part of its replies
+        req_device = self.registry.get(req_alias)
+        template = self.get_template(req_device)
+        reply_params = dict(template.fields)
+        legacy = req_params.get("LEGACY")
+        legacy = self.legacy_replies if legacy is None else legacy
+        device_start = time.perf_counter()
+
+        if req_msg_val == "READ" and req_params.get("COUNT") is not None:
+            reply_params.update(self.read_burst(req_device, req_params))
+            self.add_device_time(device_start)
+            legacy_reply = ("BURST", reply_params["SAMPLES"])
+
+        elif req_msg_val == "READ":
+            # The device serialises reads itself so identical reads coalesce
+            max_age = check_number("MAX_AGE", req_params.get("MAX_AGE"), low=0)
+            rep_value, rep_time, rep_cached = req_device.read(max_age)
+            self.add_device_time(device_start)
+            reply_params["VALUE"] = rep_value
+            unit = req_device.get_unit()
+            if unit is not None:
+                reply_params["UNIT"] = unit
+            reply_params["CACHED"] = rep_cached
+            reply_params["TIMESTAMP"] = rep_time
+            if legacy:
+                legacy_reply = ("READ", req_device.format_value(rep_value))
+
+        elif req_msg_val == "CONFIG":
+            req_config = req_params.get("CONFIG")
+            if req_config is None:
+                raise IpcMessageException("Missing parameter CONFIG")
+
+            # Hold the device for the whole operation, workers may share it
+            req_timeout = req_params.get("TIMEOUT")
+            with req_device.lock:
+                try:
                     if req_config == "BLINK":
-                        req_timeout = request.get_param("TIMEOUT")
-                        req_rate = request.get_param("RATE")
-                        req_device.set_config(req_config, req_timeout, req_rate)
-                        reply_string = "Processed request from %s. %s at address %s blinked for %s seconds. \
-                                        Current status is %s." % (client_address.decode(),req_alias, req_address, req_timeout, req_device.get_config())
+                        req_device.set_config(req_config, req_timeout, req_params.get("RATE"))
                     else:
                         req_device.set_config(req_config)
-                        reply_string = "Processed Request from %s. Set %s at \
-                                        address %s to: %s." % (client_address.decode(),
-                                        req_alias, req_address, req_device.get_config())
-  
-                if req_msg_val == "STATUS":
-                    rep_status = req_device.get_status()
-                    reply_string = "Processed Request from %s. Status of %s at \
-                                    address %s is: %s." % (client_address.decode(), 
-                                    req_alias, req_address, rep_status)
+                except ValueError as err:
+                    raise IpcMessageException("Invalid CONFIG %s for %s: %s"
+                                              % (req_config, req_alias, err))
+                except TypeError:
+                    # Only the LED takes a BLINK TIMEOUT and RATE
+                    raise IpcMessageException("Invalid CONFIG %s for %s" % (req_config, req_alias))
+                rep_config = req_config if req_config == "BLINK" else req_device.get_state()
+                req_device.invalidate()
+                rep_status = req_device.get_status()
+                unit = req_device.get_unit()
+                if legacy:
+                    legacy_reply = (("BLINK", req_timeout, rep_status) if req_config == "BLINK"
+                                    else ("CONFIG", req_device.get_config()))
+                if self.state is not None:
+                    self.state.record(req_alias, template.address, req_device.get_state())
+            self.add_device_time(device_start)
+            reply_params["CONFIG"] = rep_config
+            reply_params["STATUS"] = rep_status
+            if unit is not None:
+                reply_params["UNIT"] = unit
+
+        elif req_msg_val == "STATUS":
+            with req_device.lock:
+                rep_status = req_device.get_status()
+            self.add_device_time(device_start)
+            reply_params["STATUS"] = rep_status
+            legacy_reply = ("STATUS", rep_status)
+
+        elif req_msg_val == "READ_HISTORY":
+            reply_params.update(self.read_history(req_device, req_params))
+            legacy_reply = ("READ_HISTORY", reply_params["SAMPLES"])
+
+        elif req_msg_val == "FAULT":
+            # CONFIG names the fault, VALUE is what it uses, TIMEOUT when it clears
+            req_fault = req_params.get("CONFIG") or "CLEAR"
+            # Checked before anything changes, so a bad FAULT leaves the channel alone
+            req_value = check_number("VALUE", req_params.get("VALUE"), coerce=True)
+            req_timeout = check_number("TIMEOUT", req_params.get("TIMEOUT"), low=0, coerce=True)
+            with req_device.lock:
+                try:
+                    req_device.inject_fault(req_fault, req_value, req_timeout)
+                except (TypeError, ValueError) as err:
+                    raise IpcMessageException("Invalid FAULT %r for %s: %s"
+                                              % (req_fault, req_alias, err))
+            self.add_device_time(device_start)
+            reply_params["FAULT"] = req_fault
+            legacy_reply = ("FAULT", req_fault)
+
+        else:
+            raise IpcMessageException("Unknown message value %s" % req_msg_val)
+
+        if legacy:
+            reply_params["REPLY"] = template.reply(client_address, *legacy_reply)
+        return reply_params
+
+    def read_burst(self, req_device, req_params):
+        ''' Returns the reply parameters of a burst READ
+
+        :param req_device: the device to read
+        :param req_params: COUNT readings to take, INTERVAL seconds apart
+        Returns TIMES and VALUES as float64 arrays, sent as binary frames
+        A burst paced over more than max_burst_seconds is refused, as
+        nothing else is served while it runs.
+
+        '''
+
+        req_count = check_number("COUNT", req_params.get("COUNT"), 1, MAX_BURST, whole=True)
+        req_interval = check_number("INTERVAL", req_params.get("INTERVAL"), low=0) or 0
+        if req_count * req_interval > self.max_burst_seconds:
+            raise IpcMessageException("COUNT * INTERVAL must be at most %s seconds, "
+                                      "READ_HISTORY serves longer spans"
+                                      % self.max_burst_seconds)
+        if req_device.get_unit() is None:
+            raise IpcMessageException("%s takes no numeric readings" % req_device.get_alias())
+
+        # Hold the device for the whole burst so readings are evenly spaced
+        with req_device.lock:
+            times, values = req_device.read_burst(req_count, req_interval)
+        return {"SAMPLES": len(values), "UNIT": req_device.get_unit(),
+                "TIMES": times, "VALUES": values}
+
+    def read_history(self, req_device, req_params):
+        ''' Returns the reply parameters of a READ_HISTORY request
+
+        :param req_device: the device whose history is read
+        :param req_params: START and END timestamps, the whole history if
+                        None, and BUCKETS to downsample into if set
+        Returns TIMES and VALUES lists, or with BUCKETS the START, COUNT,
+        MIN, MAX and MEAN of each bucket holding samples
+
+        '''
+
+        req_start = check_number("START", req_params.get("START"))
+        req_end = check_number("END", req_params.get("END"))
+        req_buckets = check_number("BUCKETS", req_params.get("BUCKETS"), 0, MAX_BUCKETS,
+                                   whole=True)
+        # A device that has not been read yet has an empty history
+        history = req_device.history or SampleHistory(1)
+        times, values = history.query(req_start, req_end)
+        values = req_device.history_values(values)
+
+        reply_params = {"SAMPLES": len(times), "UNIT": req_device.get_unit()}
+        if not req_buckets:
+            reply_params["TIMES"] = times.tolist()
+            reply_params["VALUES"] = values.tolist()
+            return reply_params
+
+        start = req_start if req_start is not None else (times[0] if len(times) else 0)
+        end = req_end if req_end is not None else (times[-1] if len(times) else 0)
+        for name, column in downsample(times, values, start, end, req_buckets).items():
+            reply_params[name] = column.tolist()
+        return reply_params
+
+    def process_batch(self, client_address, request):
+        ''' Runs every operation of a BATCH request in a single pass
+
+        :param client_address: the identity frame of the requesting client
+        :param request: the decoded BATCH IPCmessage, its BATCH parameter is
+                        an ordered list of {DEVICE, OP} entries with any of
+                        the OPERATION_PARAMS
+        Returns a list of results in request order, each with the DEVICE 
+        and OP and either the reply parameters or an ERROR.
+        A LEGACY set on the request applies to entries that do not set it.
+        Whatever goes wrong with one entry is its ERROR, the rest still run.
+
+        '''
+
+        batch = request.get_param("BATCH")
+        if not isinstance(batch, list):
+            raise IpcMessageException("BATCH must be a list of {DEVICE, OP} entries")
+
+        results = []
+        legacy = get_optional_param(request, "LEGACY")
+        for entry in batch:
+            if not isinstance(entry, dict):
+                results.append({"DEVICE": None, "OP": None, "STATUS_CODE": STATUS_CODES["ERROR"],
+                                "ERROR": "BATCH entry %r is not a {DEVICE, OP} entry" % (entry,)})
+                continue
+            if legacy is not None and entry.get("LEGACY") is None:
+                entry = dict(entry, LEGACY=legacy)
+            result = {"DEVICE": entry.get("DEVICE"), "OP": entry.get("OP")}
+            try:
+                result.update(self.run_operation(client_address, entry.get("DEVICE"), 
+                                                 entry.get("OP"), entry))
+            except Exception as err:
+                if not isinstance(err, (IpcMessageException, DeviceRegistryError)):
+                    log.exception("BATCH entry crashed", extra={"client": client_address.decode(
+                                  errors="replace"), "device": result["DEVICE"],
+                                  "op": result["OP"], "error": repr(err)})
+                    err = "Internal error: %r" % err
+                result["ERROR"] = str(err)
+                result["STATUS_CODE"] = error_status(err)
+                if self.legacy_replies if entry.get("LEGACY") is None else entry["LEGACY"]:
+                    result["REPLY"] = "Error processing request: %s" % str(err)
+            results.append(result)
+
+        return results
+
+    def process_request(self, client_address, request):
+        ''' Runs a decoded request against its device
 
-                if req_msg_val == "READ":
-                    rep_value = req_device.get_data()
-                    reply_string = "Processed Request from %s. Value of %s at \
-                                    address %s is: %s." % (client_address.decode(), 
-                                    req_alias, req_address, rep_value)
+        :param client_address: the identity frame of the requesting client
+        :param request: the decoded IPCmessage from the client request
+        Returns the reply IPCmessage
 
-                reply_message.set_param("REPLY", reply_string)
+        '''
+
+        reply_message = IpcMessage(msg_type="CMD", msg_val="NOTIFY")
+
+        # get the message value (CONFIG/STATUS/READ/BATCH)
+        req_msg_val = request.get_msg_val()
+
+        if req_msg_val == "BATCH":
+            reply_message.set_param("RESULTS", self.process_batch(client_address, request))
+            reply_message.set_param("STATUS_CODE", STATUS_OK)
+            return reply_message
+
+        if req_msg_val == "STATS":
+            reply_message.set_param("STATS", self.metrics.snapshot())
+            reply_message.set_param("STATUS_CODE", STATUS_OK)
+            return reply_message
+
+        if req_msg_val == "RULES":
+            reply_message.set_param("RULES", self.rules.snapshot() if self.rules else [])
+            reply_message.set_param("STATUS_CODE", STATUS_OK)
+            return reply_message
+
+        if req_msg_val == "PROFILE":
+            for name, value in self.profile(request).items():
+                reply_message.set_param(name, value)
+            reply_message.set_param("STATUS_CODE", STATUS_OK)
+            return reply_message
+
+        # Get the alias device name used in the request
+        req_alias = request.get_param("DEVICE")
+        req_params = {name: get_optional_param(request, name) for name in OPERATION_PARAMS}
+
+        reply_params = self.run_operation(client_address, req_alias, req_msg_val, req_params)
+        for name, value in reply_params.items():
+            reply_message.set_param(name, value)
+        return reply_message
+
+    def profile(self, request):
+        ''' Starts, stops or reports on the sampling profiler
+
+        :param request: the decoded PROFILE IPCmessage, its ACTION is START
+                    to sample for SECONDS every INTERVAL, STOP to end a
+                    profile early or RESULT, the default, to report on it
+        Returns the reply parameters: whether a profile is PROFILING, and
+        the SAMPLES, SECONDS, the collapsed stack file PATH and the TOP
+        (10 by default) hottest functions of the last one
+
+        '''
+
+        action = get_optional_param(request, "ACTION") or "RESULT"
+        top = check_number("TOP", get_optional_param(request, "TOP"), 1, whole=True,
+                           coerce=True) or 10
+        if action == "START":
+            seconds = check_number("SECONDS", get_optional_param(request, "SECONDS"),
+                                   high=MAX_SECONDS, coerce=True)
+            seconds = 10 if seconds is None else seconds
+            if seconds <= 0:
+                raise IpcMessageException("SECONDS must be more than 0")
+            # Sampling more often would take the GIL from the threads profiled
+            interval = check_number("INTERVAL", get_optional_param(request, "INTERVAL"),
+                                    low=MIN_INTERVAL, coerce=True)
+            path = os.path.join(self.profile_dir, "femii-profile-%s-%d.collapsed"
+                                % (time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+            try:
+                self.profiler.start(seconds, path, interval)
+            except RuntimeError as err:
+                raise IpcMessageException(str(err))
+            log.info("Profiling for %s seconds into %s", seconds, path)
+        elif action == "STOP":
+            self.profiler.stop()
+        elif action != "RESULT":
+            raise IpcMessageException("Unknown ACTION %s, accepts START, STOP or RESULT" % action)
+        return self.profiler.result(top)
+
+    def encode_reply(self, reply_message, codec=JSON_CODEC):
+        ''' Encodes a reply IPCmessage as bytes for sending 
+
+        :param reply_message: the reply IPCmessage
+        :param codec: the encoding the request arrived in
+        '''
+
+        return codec.encode(reply_message)
+
+    def error_reply(self, err, legacy=None):
+        ''' Returns a reply IPCmessage reporting an error
+
+        :param err: the exception, its type gives the STATUS_CODE
+        :param legacy: whether to add the REPLY string for clients that
+                    only read REPLY, legacy_replies if None
+        '''
+
+        reply_message = IpcMessage(msg_type="CMD", msg_val="NOTIFY")
+        reply_message.set_param("ERROR", str(err))
+        reply_message.set_param("STATUS_CODE", error_status(err))
+        if self.legacy_replies if legacy is None else legacy:
+            reply_message.set_param("REPLY", "Error processing request: %s" % str(err))
+        return reply_message
+
+    def rejected_reply(self, err, legacy=None):
+        ''' Returns a reply IPCmessage for a RequestRejected
+
+        BUSY is set when the client should retry later, with RETRY_AFTER
+        seconds if known, and EXPIRED when the DEADLINE had passed.
+        '''
+
+        reply_message = self.error_reply(err, legacy)
+        if err.reason == EXPIRED:
+            reply_message.set_param("EXPIRED", True)
+        else:
+            reply_message.set_param("BUSY", True)
+        if err.retry_after is not None:
+            reply_message.set_param("RETRY_AFTER", err.retry_after)
+        return reply_message
+
+    def admit(self, client_address, request, waiting, decoded=None):
+        ''' Decides whether a received request may wait to be served
+
+        :param client_address: the identity frame of the requesting client
+        :param request: the raw request frame
+        :param waiting: the number of requests already waiting in its lane
+        :param decoded: the decoded request, if it has been decoded
+        Returns True if it may, otherwise the client has been sent BUSY
+        '''
+
+        arrived = time.time()
+        retry_after = self.limiter.acquire(client_address)
+        if retry_after:
+            err = RequestRejected(RATE_LIMITED, "Rate limit of %s requests per second exceeded"
+                                  % self.limiter.rate, retry_after)
+        elif waiting >= self.queue_limit:
+            err = RequestRejected(QUEUE_FULL, "Server busy, %d requests waiting" % waiting)
+        else:
+            return True
+
+        self.metrics.record_rejected(err.reason)
+        codec = JSON_CODEC
+        try:
+            codec = detect_codec(request)
+            if decoded is None:
+                decoded = codec.decode(request)
+        except IpcMessageException:
+            pass
+        reply_message = self.rejected_reply(
+            err, None if decoded is None else get_optional_param(decoded, "LEGACY"))
+        msg_id = None if decoded is None else get_optional_param(decoded, "MSG_ID")
+        if msg_id is not None:
+            reply_message.set_param("MSG_ID", msg_id)
+        self.socket.send_multipart([client_address, b"", self.encode_reply(reply_message, codec)])
+        if self.capture is not None:
+            self.capture.record(arrived, time.time() - arrived, client_address, request)
+        return False
+
+    def recv_request(self, flags=0):
+        ''' Receives a request, returns the (client identity, request) frames
+
+        The request is taken from the last frame, so the empty delimiter
+        of a REQ client, or any other extra frame, cannot stop the server
+        '''
+
+        frames = self.socket.recv_multipart(flags)
+        return frames[0], frames[-1]
+
+    def classify(self, request):
+        ''' Decodes a received request to find its priority lane
+
+        Returns the lane, the decoded request (None if it does not decode)
+        and the seconds spent decoding it
+        '''
+
+        start = time.perf_counter()
+        try:
+            decoded = detect_codec(request).decode(request)
+        except IpcMessageException:
+            decoded = None
+        return request_lane(decoded), decoded, time.perf_counter() - start
+
+    def enqueue(self, lanes, client_address, request):
+        ''' Queues a received request in its lane of a LaneQueue, unless
+        it is turned away BUSY '''
+
+        lane, decoded, decode_time = self.classify(request)
+        if self.admit(client_address, request, lanes.depth(lane), decoded):
+            lanes.push(lane, client_address,
+                       (client_address, request, time.time(), decoded, decode_time),
+                       request_devices(decoded))
+
+    @staticmethod
+    def metric_name(name, known):
+        ''' Returns the DEVICE or op name to record metrics under, UNKNOWN
+        for any the server does not know, which the client can make up '''
+
+        if name is None or (isinstance(name, str) and name in known):
+            return name
+        return UNKNOWN
+
+    def handle_message(self, client_address, request, decoded=None, decode_time=0.0,
+                       arrived=None):
+        ''' Decodes and runs one request, returns the reply frames
+
+        :param client_address: the identity frame of the requesting client
+        :param request: the raw request frame
+        :param decoded: the request already decoded by classify, if it was
+        :param decode_time: the seconds classify spent decoding it
+        :param arrived: the time the request was received, now if None
+        The MSG_ID of the request, if any, is echoed in the reply so 
+        clients with several requests in flight can match them up.
+        A request with a DEADLINE (seconds since the epoch) that has
+        passed, or received longer ago than its EXPIRES_IN seconds, is
+        answered EXPIRED without running.
+        The reply uses the same encoding (JSON/msgpack) as the request.
+        Array parameters follow the encoded reply as raw frames.
+        The time spent in each stage is recorded in self.metrics, and
+        every log_every'th request is logged.
+        '''
+
+        start = time.perf_counter() - decode_time
+        self.request_timing.device = 0.0
+        codec = JSON_CODEC
+        error = None
+        try:
+            codec = detect_codec(request)
+            if decoded is None:
+                decoded = codec.decode(request)
+            decoded_at = time.perf_counter()
+            deadline = check_number("DEADLINE", get_optional_param(decoded, "DEADLINE"))
+            # Relative to this server's clock, for senders whose clock may differ
+            expires_in = check_number("EXPIRES_IN", get_optional_param(decoded, "EXPIRES_IN"),
+                                      low=0)
+            if expires_in is not None:
+                expires = (time.time() if arrived is None else arrived) + expires_in
+                deadline = expires if deadline is None else min(deadline, expires)
+            if deadline is not None and time.time() > deadline:
+                raise RequestRejected(EXPIRED, "Deadline passed %.3f seconds ago"
+                                      % (time.time() - deadline))
+            reply_message = self.process_request(client_address, decoded)
+        except RequestRejected as err:
+            self.metrics.record_rejected(err.reason)
+            reply_message = self.rejected_reply(err, get_optional_param(decoded, "LEGACY"))
+            error = str(err)
+        except (IpcMessageException, DeviceRegistryError) as err:
+            legacy = None if decoded is None else get_optional_param(decoded, "LEGACY")
+            reply_message = self.error_reply(err, legacy)
+            error = str(err)
+        except Exception as err:
+            # A request must never take the serve loop down, whatever it holds
+            log.exception("Request crashed", extra={"client": client_address.decode(
+                          errors="replace"), "error": repr(err)})
+            legacy = None if decoded is None else get_optional_param(decoded, "LEGACY")
+            reply_message = self.error_reply("Internal error: %r" % err, legacy)
+            error = repr(err)
+        processed_at = time.perf_counter()
+
+        req_alias = None
+        req_msg_val = None
+        if decoded is not None:
+            msg_id = get_optional_param(decoded, "MSG_ID")
+            if msg_id is not None:
+                reply_message.set_param("MSG_ID", msg_id)
+            req_alias = get_optional_param(decoded, "DEVICE")
+            req_msg_val = decoded.get_msg_val()
+        else:
+            decoded_at = processed_at
+
+        frames = []
+        pack_arrays(reply_message.attrs.get("params", {}), frames)
+        frames.insert(0, self.encode_reply(reply_message, codec))
+
+        device_time = self.request_timing.device
+        end = time.perf_counter()
+        self.metrics.record(self.metric_name(req_alias, self.lookup),
+                            self.metric_name(req_msg_val, MSG_VALS), 
+                            (decoded_at - start, processed_at - decoded_at - device_time,
+                             device_time, end - processed_at), bool(error))
+
+        if error:
+            log.warning("Request failed", extra={"client": client_address.decode(errors="replace"),
+                        "device": req_alias, "op": req_msg_val, "error": error})
+        elif self.log_every and next(self._log_count) % self.log_every == 0:
+            log.info("Served request", extra={"client": client_address.decode(errors="replace"),
+                     "device": req_alias, "op": req_msg_val, "duration": round(end - start, 6)})
+        return frames
+
+    def run_rep(self):
+        ''' sends a request, waits for a reply, returns response  
+
+        Before each request is served whatever else has arrived is taken
+        off the socket, so requests beyond the queue limit or a client's
+        rate are answered BUSY straight away rather than after everything
+        ahead of them, and a CONFIG behind a flood of READs is sorted into
+        its lane and served next.
+        '''
+
+        lanes = LaneQueue(LANE_STARVATION)
+        while True:
+            if not len(lanes):
+                client_address, request = self.recv_request()
+                self.enqueue(lanes, client_address, request)
+
+            # Take whatever else is already queued so the backlog can be measured
+            for x in range(BACKLOG_DRAIN):
+                try:
+                    client_address, request = self.recv_request(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self.enqueue(lanes, client_address, request)
+
+            if not len(lanes):
+                continue
+            lane, (client_address, request, arrived, decoded, decode_time) = lanes.pop()
+            self.metrics.set_backlog(len(lanes))
+            self.metrics.set_lane_depths(lanes.depths)
+            self.metrics.record_wait(lane, time.time() - arrived)
+            reply_frames = self.handle_message(client_address, request, decoded, decode_time,
+                                               arrived)
+
+            # send a multipart back to the client 
+            self.socket.send_multipart([client_address, b""] + reply_frames)
+            if self.capture is not None:
+                self.capture.record(arrived, time.time() - arrived, client_address, request)
+
+    def get_request_workers(self, request, devices):
+        ''' Returns the sorted indexes of the workers serving a request
+
+        :param request: the decoded request
+        :param devices: its device aliases, from request_devices
+        A BATCH needs the worker of the device of every one of its entries,
+        a request for no device is routed as None and fails on its worker.
+        '''
+
+        return sorted({self.get_worker(alias) for alias in devices or [None]})
+
+    def get_worker(self, alias):
+        ''' Returns the index of the worker that serves a device alias
+
+        Aliases are handed out to workers round-robin the first time they
+        are seen and stay with that worker, so requests to one device are
+        always served in order while different devices run in parallel.
+        An alias that is not a registered device, which a client can make
+        up, goes to the first worker to fail there and is not remembered.
+        '''
+
+        worker = self.shards.get(alias)
+        if worker is None:
+            if not isinstance(alias, str) or alias not in self.registry:
+                return 0
+            worker = len(self.shards) % self.num_workers
+            self.shards[alias] = worker
+        return worker
 
-                # Encode the message for sending
-                reply_message = reply_message.encode()
+    def run_workers(self, num_workers):
+        ''' Brokers requests from the ROUTER frontend to worker threads
 
-                # check if its unicode, if so covert to bytes
-                if isinstance(reply_message, unicode):
-                    reply_message = cast_bytes(reply_message)
+        :param num_workers: the number of worker threads to start
+        Workers connect as DEALER sockets to an inproc ROUTER backend, 
+        which lets the broker pick the worker for each device.
+        Each worker has at most WORKER_CREDIT requests in hand, the rest
+        wait in its own LaneQueue so they are handed out by priority.
 
-                # send a multipart back to the client 
-                self.socket.send_multipart([client_address, b"", reply_message,])
-            except IpcMessageException as err:
-                print("IPC MESSAGE Error Found %s: " % str(err))
+        A BATCH over devices of several workers is a barrier: it waits
+        until those workers have served everything queued before it and
+        runs on the first of them while the others hold, and any request
+        behind it for one of them is held until it is done. Requests to a
+        device are so served in order whichever worker runs them.
+
+        '''
+
+        self.num_workers = num_workers
+        backend = self.context.socket(zmq.ROUTER)
+        backend.bind(WORKER_URL)
+
+        worker_ids = []
+        queues = [LaneQueue(LANE_STARVATION) for x in range(num_workers)]
+        credits = [WORKER_CREDIT] * num_workers
+        for x in range(num_workers):
+            ident = ("worker-%d" % x).encode()
+            worker_ids.append(ident)
+            thread = threading.Thread(target=self.run_worker, args=(ident,),
+                                      name=ident.decode(), daemon=True)
+            thread.start()
+
+        # Wait until every worker is connected, ROUTER drops unroutable messages
+        ready = 0
+        while ready < num_workers:
+            backend.recv_multipart()
+            ready += 1
+
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(backend, zmq.POLLIN)
+        worker_index = {ident: x for x, ident in enumerate(worker_ids)}
+
+        # Admitted requests not yet routed, as
+        # (client, request, arrived, lane, workers, devices)
+        arrivals = deque()
+        # The BATCH over several workers being run, whether it has been
+        # handed out, and the requests held behind it for those workers
+        barrier = None
+        barrier_sent = False
+        held = deque()
+        held_workers = set()
+
+        while True:
+            socks = dict(poller.poll())
+
+            if socks.get(self.socket) == zmq.POLLIN:
+                client_address, request = self.recv_request()
+                arrived = time.time()
+                codec = JSON_CODEC
+                try:
+                    codec = detect_codec(request)
+                    decoded = codec.decode(request)
+                    devices = request_devices(decoded)
+                    workers = self.get_request_workers(decoded, devices)
+                except IpcMessageException as err:
+                    log.warning("Request failed", extra={"client": client_address.decode(
+                                errors="replace"), "error": str(err)})
+                    self.socket.send_multipart([client_address, b"", 
+                                                self.encode_reply(self.error_reply(err), codec)])
+                    if self.capture is not None:
+                        self.capture.record(arrived, time.time() - arrived, client_address,
+                                            request)
+                else:
+                    lane = request_lane(decoded)
+                    waiting = queues[workers[0]].depth(lane) + len(held)
+                    if self.admit(client_address, request, waiting, decoded):
+                        arrivals.append((client_address, request, arrived, lane,
+                                         workers, devices))
+
+            if socks.get(backend) == zmq.POLLIN:
+                worker, client_address, *reply_frames = backend.recv_multipart(copy=False)
+                self.socket.send_multipart([client_address, b""] + reply_frames, copy=False)
+                worker = worker_index[worker.bytes]
+                credits[worker] += 1
+                # Nothing else is handed to a barrier's worker, this is its reply
+                if barrier_sent and worker == barrier[4][0]:
+                    barrier = None
+                    barrier_sent = False
+                    arrivals.extendleft(reversed(held))
+                    held.clear()
+                    held_workers.clear()
+
+            # Queue arrivals with their worker, or behind a barrier
+            while arrivals:
+                item = arrivals.popleft()
+                client_address, request, arrived, lane, workers, devices = item
+                if barrier is not None and (len(workers) > 1
+                                            or held_workers.intersection(workers)):
+                    held.append(item)
+                    held_workers.update(workers)
+                elif len(workers) > 1:
+                    barrier = item
+                    held_workers.update(workers)
+                else:
+                    queues[workers[0]].push(lane, client_address,
+                                            (client_address, request, arrived), devices)
+
+            # Hand each worker with credit the next requests of its lanes
+            for worker, queue in enumerate(queues):
+                while credits[worker] and len(queue):
+                    lane, (client_address, request, arrived) = queue.pop()
+                    self.metrics.record_wait(lane, time.time() - arrived)
+                    backend.send_multipart([worker_ids[worker], client_address,
+                                            ARRIVAL.pack(arrived), request])
+                    credits[worker] -= 1
+
+            # Run a barrier once its workers have nothing queued or in hand
+            if barrier is not None and not barrier_sent and all(
+                    not len(queues[worker]) and credits[worker] == WORKER_CREDIT
+                    for worker in barrier[4]):
+                client_address, request, arrived, lane, workers, devices = barrier
+                self.metrics.record_wait(lane, time.time() - arrived)
+                backend.send_multipart([worker_ids[workers[0]], client_address,
+                                        ARRIVAL.pack(arrived), request])
+                credits[workers[0]] -= 1
+                barrier_sent = True
+
+            # Requests waiting or handed to workers and not yet answered
+            depths = [sum(lane) for lane in zip(*[queue.depths for queue in queues])]
+            self.metrics.set_lane_depths(depths)
+            self.metrics.set_backlog(sum(depths) + len(held) + (barrier is not None)
+                                     - barrier_sent + num_workers * WORKER_CREDIT - sum(credits))
+
+    def run_worker(self, ident):
+        ''' Worker thread loop, serves requests handed out by run_workers 
+
+        :param ident: the identity of this worker on the backend socket
+        '''
+
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.IDENTITY, ident)
+        socket.connect(WORKER_URL)
+        socket.send(b"READY")
+
+        while True:
+            client_address, arrived, request = socket.recv_multipart()
+            # Captured with the time it reached the broker, not this worker
+            arrived, = ARRIVAL.unpack(arrived)
+            reply_frames = self.handle_message(client_address, request, arrived=arrived)
+            socket.send_multipart([client_address] + reply_frames)
+            if self.capture is not None:
+                self.capture.record(arrived, time.time() - arrived, client_address, request)
 
 
 def main(): 
@@ -148,22 +1116,123 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-port", "--port", help="Port connection, default = 5555", 
                         default="5555")
+    parser.add_argument("-endpoint", "--endpoint", nargs="+",
+                        help="Endpoints to bind instead of --port, each a tcp://, ipc:// or \
+                        inproc:// url with optional ?option=value&... socket options \
+                        e.g. tcp://*:5555?sndhwm=10000&tcp_keepalive=1 ipc:///tmp/femii.sock")
+    parser.add_argument("-config", "--config", 
+                        help="JSON device configuration file, default = one LED, TEMP and POWER")
+    parser.add_argument("-backend", "--backend", choices=sorted(BACKENDS), default="bbio",
+                        help="Device backend, bbio for BeagleBone pins or sim for \
+                        in-memory simulated pins, default = bbio")
+    parser.add_argument("-seed", "--seed", type=int,
+                        help="Seed of the simulated sensor readings, default = random")
+    parser.add_argument("-sim_period", "--sim_period", type=float, default=0.01,
+                        help="Seconds between simulated sensor samples, default = 0.01")
+    parser.add_argument("-sim_clock", "--sim_clock", choices=["wall", "ticks"], default="wall",
+                        help="Time of the simulated sensor samples, wall for the real time or \
+                        ticks for one --sim_period per read, so that a --seed run repeats its \
+                        readings, default = wall")
+    parser.add_argument("-sim_latency", "--sim_latency", type=float, default=0,
+                        help="Seconds added to each simulated pin and bus operation, default = 0")
+    parser.add_argument("-telemetry_port", "--telemetry_port", 
+                        help="Port to publish TEMP/POWER telemetry on, default = off")
+    parser.add_argument("-telemetry_period", "--telemetry_period", type=float, default=1.0,
+                        help="Seconds between telemetry samples, default = 1")
+    parser.add_argument("-history_period", "--history_period", type=float,
+                        help="Seconds between readings kept for READ_HISTORY, default = off")
+    parser.add_argument("-metrics_port", "--metrics_port", 
+                        help="Port to serve Prometheus text metrics on over HTTP, default = off")
+    parser.add_argument("-workers", "--workers", type=int, default=0,
+                        help="Number of worker threads, default = 0 (serve on the main thread)")
+    parser.add_argument("-state", "--state",
+                        help="Device state snapshot to restore at startup and keep up to \
+                        date, default = off")
+    parser.add_argument("-rules", "--rules",
+                        help="JSON file of interlock and alarm rules checked on every \
+                        reading, default = none")
+    parser.add_argument("-capture", "--capture",
+                        help="File to append every request received to, for ipc_replay, \
+                        default = off")
+    parser.add_argument("-queue_limit", "--queue_limit", type=int, default=QUEUE_LIMIT,
+                        help="Requests waiting in each priority lane before new ones get a \
+                        BUSY reply, default = %d" % QUEUE_LIMIT)
+    parser.add_argument("-max_burst_seconds", "--max_burst_seconds", type=float,
+                        default=MAX_BURST_SECONDS,
+                        help="Longest COUNT * INTERVAL of a burst READ, which holds the server \
+                        while it runs, default = %s" % MAX_BURST_SECONDS)
+    parser.add_argument("-rate_limit", "--rate_limit", type=float, default=0,
+                        help="Requests per second each client may send, default = 0 (no limit)")
+    parser.add_argument("-rate_burst", "--rate_burst", type=float,
+                        help="Requests a client may send at once within --rate_limit, \
+                        default = the rate")
+    parser.add_argument("-profile_dir", "--profile_dir", default=tempfile.gettempdir(),
+                        help="Directory PROFILE requests write collapsed stacks to, \
+                        default = %s" % tempfile.gettempdir())
+    parser.add_argument("-legacy_replies", "--legacy_replies", action="store_true",
+                        help="Add the prose REPLY string to every reply for old clients, \
+                        default = only to requests that set LEGACY")
+    parser.add_argument("-log_level", "--log_level", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Lowest level logged, default = INFO")
+    parser.add_argument("-log_file", "--log_file",
+                        help="File to append the log to, default = stderr")
+    parser.add_argument("-log_format", "--log_format", choices=sorted(FORMATS), default="text",
+                        help="Log as text with key=value fields or as JSON lines, default = text")
+    parser.add_argument("-log_requests", "--log_requests", type=int, default=0,
+                        help="Log every Nth request served, default = 0 (off)")
     args = parser.parse_args()
 
+    configure_logging(args.log_level, args.log_file, args.log_format)
+
     # Initialise a server
-    server = IpcServer(args.port)
+    clock = TickClock(args.sim_period) if args.sim_clock == "ticks" else None
+    set_default_simulator(SensorSimulator(args.seed, args.sim_period, clock))
+    backend = None
+    if args.backend == "sim":
+        backend = SimulatedBackend(args.sim_latency)
+    try:
+        server = IpcServer(args.port, args.config, backend, args.endpoint)
+    except ValueError as err:
+        parser.error(str(err))
+    server.log_every = args.log_requests
+    server.legacy_replies = args.legacy_replies
+    server.profile_dir = args.profile_dir
+    server.queue_limit = args.queue_limit
+    server.max_burst_seconds = args.max_burst_seconds
+    server.limiter = RateLimiter(args.rate_limit, args.rate_burst)
+    if args.state is not None:
+        start = time.perf_counter()
+        restored = server.load_state(args.state)
+        log.info("Restored %d devices from %s in %.1f ms", restored, args.state,
+                 (time.perf_counter() - start) * 1000)
+
+    if args.rules is not None:
+        try:
+            log.info("Compiled %d rules from %s", server.load_rules(args.rules), args.rules)
+        except RuleError as err:
+            parser.error(str(err))
 
-    # configure hardware addresses and alias look up tables
-    server.assign_addresses()
+    # configure the alias look up table
     server.make_lookup()
 
     # Display the fake device address tree
-    print("Hardware device address tree:") 
-    print(server.lookup)
+    log.info("Hardware device address tree: %s", server.lookup)
 
     # bind the socket and run reply loop
     server.bind()
-    server.run_rep()
+    if args.telemetry_port is not None:
+        server.start_telemetry(args.telemetry_port, args.telemetry_period)
+    if args.metrics_port is not None:
+        server.start_metrics_endpoint(args.metrics_port)
+    if args.history_period is not None:
+        server.start_history_sampler(args.history_period)
+    if args.capture is not None:
+        server.start_capture(args.capture)
+    if args.workers > 0:
+        server.run_workers(args.workers)
+    else:
+        server.run_rep()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,257 @@
+'''
+    Telemetry stream for ipc_server
+    The server samples devices on a fixed period and publishes the
+    readings on an XPUB socket, one topic per device alias and deadband
+
+    Topics are "<ALIAS>/<DEADBAND>/", e.g. "TEMP/0/" is every TEMP sample
+    and "POWER/0.05/" is only POWER readings that moved by at least 0.05V
+    since the last one published on that topic. The closing "/" stops a
+    SUB prefix match of "POWER/0" taking in "POWER/0.05" as well.
+    Alarms of fired rules are published on "ALARM/<RULE>/" topics.
+
+'''
+
+import time
+import argparse
+import threading
+import zmq
+from odin_data.ipc_message import IpcMessage, IpcMessageException
+from zmq.utils.strtypes import unicode, cast_bytes
+
+
+#   Prefix of the topics alarms are published on
+ALARM_TOPIC = b"ALARM/"
+
+
+def make_topic(alias, deadband=0):
+    """ Returns the topic a subscriber uses for a device and deadband """
+
+    return ("%s/%s/" % (alias, deadband)).encode()
+
+
+class TelemetryPublisher:
+    """ Samples subscribed devices and publishes their readings
+
+    Only devices with at least one subscriber are sampled, and each
+    sample is published once per distinct deadband, so the cost does
+    not grow with the number of subscribers.
+
+    :param context: the zmq context to create the socket in
+    :param url: the endpoint to bind i.e tcp://*:5556
+    :param registry: the DeviceRegistry to sample devices from
+    :param period: seconds between samples
+
+    """
+
+    def __init__(self, context, url, registry, period=1.0):
+        self.url = url
+        self.registry = registry
+        self.period = float(period)
+        self.context = context
+        self.socket = context.socket(zmq.XPUB)
+        self.topics = {}
+        self._thread = None
+        # Alarms come from other threads and are passed to run over inproc
+        self.alarm_url = "inproc://telemetry-alarms-%x" % id(self)
+        self.alarms = context.socket(zmq.PULL)
+        self._alarm_senders = threading.local()
+
+    def start(self):
+        """ Binds the socket and starts publishing on a background thread """
+
+        self.socket.bind(self.url)
+        self.alarms.bind(self.alarm_url)
+        self._thread = threading.Thread(target=self.run, name="TelemetryPublisher",
+                                        daemon=True)
+        self._thread.start()
+
+    def handle_subscription(self, message):
+        """ Tracks topics as subscribers come and go
+
+        :param message: XPUB subscription frame, a 1 or 0 byte for
+                        subscribe or unsubscribe followed by the topic
+        """
+        subscribe = message[:1] == b"\x01"
+        topic = message[1:]
+        if topic.startswith(ALARM_TOPIC):
+            return
+        try:
+            alias, deadband, end = topic.decode().split("/")
+            deadband = abs(float(deadband))
+        except (UnicodeDecodeError, ValueError):
+            return
+        # Only whole topics from make_topic, a bare prefix would mix deadbands
+        if end:
+            return
+
+        if subscribe:
+            # [alias, deadband, last published value]
+            self.topics[topic] = [alias, deadband, None]
+        else:
+            self.topics.pop(topic, None)
+
+    def publish(self):
+        """ Samples each subscribed device once and publishes the reading
+        on every topic whose deadband it exceeds
+        """
+        samples = {}
+        for topic, state in self.topics.items():
+            alias, deadband, last = state
+            if alias not in samples:
+                samples[alias] = self.sample(alias)
+            sample = samples[alias]
+            if sample is None:
+                continue
+
+            value = sample.get_param("VALUE")
+            if last is not None and abs(value - last) < deadband:
+                continue
+            state[2] = value
+
+            message = sample.encode()
+            if isinstance(message, unicode):
+                message = cast_bytes(message)
+            self.socket.send_multipart([topic, message])
+
+    def sample(self, alias):
+        """ Takes a reading from a device
+
+        Returns an IPC Message with the reading, None if the device does
+        not exist or takes no numeric readings
+        """
+        if alias not in self.registry:
+            return None
+        device = self.registry.get(alias)
+        with device.lock:
+            value = device.read_value()
+            unit = device.get_unit()
+        if value is None:
+            return None
+
+        sample = IpcMessage(msg_type="CMD", msg_val="TELEMETRY")
+        sample.set_param("DEVICE", alias)
+        sample.set_param("ADDRESS", device.get_addr())
+        sample.set_param("VALUE", value)
+        sample.set_param("UNIT", unit)
+        sample.set_param("TIMESTAMP", time.time())
+        return sample
+
+    def send_alarm(self, rule, alarm):
+        """ Publishes an alarm IPC Message on the topic of its rule
+
+        May be called from any thread once the publisher has started.
+        """
+        sender = getattr(self._alarm_senders, "socket", None)
+        if sender is None:
+            sender = self._alarm_senders.socket = self.context.socket(zmq.PUSH)
+            sender.connect(self.alarm_url)
+        message = alarm.encode()
+        if isinstance(message, unicode):
+            message = cast_bytes(message)
+        sender.send_multipart([ALARM_TOPIC + rule.encode() + b"/", message])
+
+    def run(self):
+        """ Publishing loop, handles subscriptions and alarms between samples """
+
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.alarms, zmq.POLLIN)
+        next_sample = time.monotonic()
+
+        while True:
+            timeout = max(0.0, next_sample - time.monotonic())
+            events = dict(poller.poll(timeout * 1000))
+            if self.alarms in events:
+                self.socket.send_multipart(self.alarms.recv_multipart())
+            if self.socket in events:
+                self.handle_subscription(self.socket.recv())
+            if events:
+                continue
+
+            self.publish()
+            next_sample += self.period
+            # Skip missed periods rather than publishing a burst
+            if next_sample < time.monotonic():
+                next_sample = time.monotonic() + self.period
+
+
+class TelemetrySubscriber:
+    """ Receives telemetry published by an ipc_server
+
+    :param url: Remote server url i.e tcp://localhost
+    :param port: Telemetry port of the remote server
+
+    """
+
+    def __init__(self, url, port):
+        self.url = "%s:%s" % (url, port)
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.SUB)
+
+    def connect(self):
+        """ Connect the socket """
+        self.socket.connect(self.url)
+
+    def subscribe(self, alias, deadband=0):
+        """ Subscribe to a device's readings
+
+        :param alias: The device alias name
+        :param deadband: Only receive readings that moved by at least this much
+        """
+        self.socket.setsockopt(zmq.SUBSCRIBE, make_topic(alias, deadband))
+
+    def subscribe_alarms(self, rule=""):
+        """ Subscribe to the alarms of a rule, of every rule by default """
+        topic = ALARM_TOPIC + rule.encode() + b"/" if rule else ALARM_TOPIC
+        self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+
+    def unsubscribe(self, alias, deadband=0):
+        """ Stop receiving a subscription made with subscribe """
+        self.socket.setsockopt(zmq.UNSUBSCRIBE, make_topic(alias, deadband))
+
+    def recv(self):
+        """ Waits for the next reading, returns it as an IPC Message """
+
+        topic, sample = self.socket.recv_multipart()
+        return IpcMessage(from_str=sample)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-url", "--url", help="Remote server url, \
+                        default = tcp://localhost", default="tcp://localhost")
+    parser.add_argument("-port", "--port", help="Telemetry port, default = 5556",
+                        default="5556")
+    parser.add_argument("-device", "--device", nargs="+", default=["TEMP", "POWER"],
+                        help="Devices to watch, default = TEMP POWER")
+    parser.add_argument("-deadband", "--deadband", type=float, default=0,
+                        help="Only show readings that moved by at least this much, default = 0")
+    parser.add_argument("-alarms", "--alarms", action="store_true",
+                        help="Show the alarms of fired rules too")
+    args = parser.parse_args()
+
+    subscriber = TelemetrySubscriber(args.url, args.port)
+    subscriber.connect()
+    for device in args.device:
+        subscriber.subscribe(device, args.deadband)
+    if args.alarms:
+        subscriber.subscribe_alarms()
+
+    while True:
+        try:
+            sample = subscriber.recv()
+            if sample.get_msg_val() == "ALARM":
+                print("ALARM %s: %s at address %s: %s %s" % (sample.get_param("RULE"),
+                      sample.get_param("DEVICE"), sample.get_param("ADDRESS"),
+                      sample.get_param("VALUE"), sample.get_param("UNIT")))
+                continue
+            print("%s at address %s: %s %s" % (sample.get_param("DEVICE"),
+                  sample.get_param("ADDRESS"), sample.get_param("VALUE"),
+                  sample.get_param("UNIT")))
+        except IpcMessageException as err:
+            print("IPC MESSAGE Error Found %s: " % str(err))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+'''
+    Endpoints for ipc_server, ipc_broker and the clients
+    An endpoint is a zmq url, optionally followed by socket options for
+    that endpoint alone after a "?", e.g.
+
+        tcp://*:5555?sndhwm=10000&tcp_keepalive=1
+        ipc:///tmp/femii.sock
+        inproc://femii              (clients in the server's own process)
+
+    zmq takes socket options when an endpoint is bound or connected, so
+    the options are set just for that call and put back afterwards.
+
+'''
+
+import zmq
+
+
+#   Integer socket options an endpoint may set
+ENDPOINT_OPTIONS = {"SNDHWM", "RCVHWM", "SNDBUF", "RCVBUF", "BACKLOG", "MAXMSGSIZE",
+                    "IMMEDIATE", "TCP_KEEPALIVE", "TCP_KEEPALIVE_IDLE",
+                    "TCP_KEEPALIVE_INTVL", "TCP_KEEPALIVE_CNT"}
+
+
+def parse_endpoint(endpoint):
+    """ Splits an endpoint into its url and a dictionary of socket options
+
+    Raises ValueError if an option is unknown or not an integer
+    """
+    url, sep, query = endpoint.partition("?")
+    options = {}
+    for option in query.split("&") if query else []:
+        name, sep, value = option.partition("=")
+        name = name.upper()
+        if name not in ENDPOINT_OPTIONS or not sep:
+            raise ValueError("Unknown endpoint option %s, accepts: %s"
+                             % (option, sorted(ENDPOINT_OPTIONS)))
+        options[name] = int(value)
+    return url, options
+
+
+def _with_options(socket, endpoint, attach):
+    """ Binds or connects a socket with the options of an endpoint """
+
+    url, options = parse_endpoint(endpoint)
+    previous = {}
+    for name, value in options.items():
+        option = getattr(zmq, name)
+        previous[option] = socket.getsockopt(option)
+        socket.setsockopt(option, value)
+    try:
+        attach(url)
+    finally:
+        for option, value in previous.items():
+            socket.setsockopt(option, value)
+    return url
+
+
+def bind_endpoint(socket, endpoint):
+    """ Binds a socket to an endpoint, returns the url bound """
+    return _with_options(socket, endpoint, socket.bind)
+
+
+def connect_endpoint(socket, endpoint):
+    """ Connects a socket to an endpoint, returns the url connected """
+    return _with_options(socket, endpoint, socket.connect)
+
+
+def make_url(url, port):
+    """ Returns the endpoint a client connects to
+
+    tcp urls get the port added before any options, ipc and inproc urls
+    name their endpoint in full and are returned as they are, as is any
+    url when port is None.
+    """
+    if port is None or not url.startswith("tcp://"):
+        return url
+    url, sep, query = url.partition("?")
+    return "%s:%s%s%s" % (url, port, sep, query)
@@ -0,0 +1,51 @@
+'''
+    Tests of the emulated devices of HD_DEVICES
+    Run with python -m pytest
+
+'''
+
+import time
+import threading
+import pytest
+from HD_DEVICES import DeviceScheduler, HdLed, HdTemp
+from hd_backend import SimulatedBackend
+from hd_sim import SensorSimulator, TickClock
+
+
+def test_scheduler_survives_failing_callback():
+    scheduler = DeviceScheduler()
+    ran = threading.Event()
+
+    def broken():
+        raise RuntimeError("step failed")
+
+    scheduler.call_at(time.monotonic(), broken)
+    scheduler.call_at(time.monotonic() + 0.01, ran.set)
+    assert ran.wait(2)
+
+
+@pytest.mark.parametrize("timeout, rate", [(10, 0), (10, -1), (10, 0.0001), (-1, 1),
+                                           ("abc", 1), (10, None), (float("nan"), 1),
+                                           (float("inf"), 1), (1e300, 1), (10, float("inf")),
+                                           (10, 1e6)])
+def test_bad_blink_rejected(timeout, rate):
+    led = HdLed(backend=SimulatedBackend())
+    led.set_config("ON")
+    with pytest.raises(ValueError):
+        led.blink(timeout, rate)
+    assert led.get_status() == "ON"
+
+
+def test_tick_clock_repeats_readings():
+    def readings():
+        simulator = SensorSimulator(7, 0.01, TickClock(0.01))
+        temp = HdTemp(backend=SimulatedBackend(), simulator=simulator, sim={"noise": 0.5})
+        values = []
+        for x in range(20):
+            values.append(temp.read(max_age=0)[0])
+            time.sleep(0.001 * (x % 3))
+        return values
+
+    first = readings()
+    assert readings() == first
+    assert len(set(first)) > 1
@@ -0,0 +1,60 @@
+'''
+    Tests of the interlock and alarm rules of hd_rules
+    Run with python -m pytest
+
+'''
+
+import pytest
+from HD_DEVICES import HdPower, HdTemp
+from hd_backend import SimulatedBackend
+from hd_registry import DeviceRegistry
+from hd_rules import RuleEngine, RuleError
+from hd_sim import SensorSimulator
+
+
+@pytest.fixture
+def registry():
+    simulator = SensorSimulator(3)
+    backend = SimulatedBackend()
+    registry = DeviceRegistry()
+    registry.register(HdTemp(temp=35.0, backend=backend, simulator=simulator,
+                             sim={"noise": 0, "drift": 0, "step_rate": 0}))
+    registry.register(HdPower(backend=backend, simulator=simulator,
+                              sim={"noise": 0, "drift": 0, "step_rate": 0}))
+    return registry
+
+
+def test_limit_ignores_display_unit(registry):
+    engine = RuleEngine(registry)
+    engine.load_config({"rules": [{"name": "hot", "device": "TEMP", "above": 85}]})
+    temp = registry.get("TEMP")
+    temp.set_config("F")
+    temp.read(max_age=0)
+    temp.read_burst(10, 0.001)
+    # 35 C reads as 95 F, under the 85 C limit however it is shown
+    assert engine.rules[0].hits == 0
+
+
+def test_drift_follows_setpoint(registry):
+    engine = RuleEngine(registry)
+    engine.load_config({"rules": [{"name": "drift", "device": "POWER", "drift": 0.2}]})
+    power = registry.get("POWER")
+    power.read(max_age=0)
+    assert engine.rules[0].hits == 0
+    power.set_config("3.3")
+    power.read(max_age=0)
+    assert engine.rules[0].hits == 0
+
+
+@pytest.mark.parametrize("spec", [
+    {"above": 85, "samples": "three"},
+    {"above": 85, "samples": 2.5},
+    {"above": 85, "samples": [3]},
+    {"above": 85, "samples": True},
+    {"above": "hot"},
+    {"below": None},
+])
+def test_bad_settings_are_rule_errors(registry, spec):
+    with pytest.raises(RuleError):
+        RuleEngine(registry).load_config(
+            {"rules": [dict(spec, name="bad", device="TEMP")]})
@@ -0,0 +1,82 @@
+'''
+    Tests of the LaneQueue ordering of ipc_lanes
+    Run with python -m pytest
+
+'''
+
+import random
+from ipc_lanes import LaneQueue, CONTROL, STATUS, BULK
+
+
+def pop_all(lanes):
+    items = []
+    while len(lanes):
+        items.append(lanes.pop())
+    return items
+
+
+def test_control_goes_first():
+    lanes = LaneQueue()
+    lanes.push(BULK, b"a", "read", ["TEMP"])
+    lanes.push(CONTROL, b"b", "config", ["POWER"])
+    assert pop_all(lanes) == [(CONTROL, "config"), (BULK, "read")]
+
+
+def test_client_device_order_kept():
+    # CONFIG POWER 3.3 / READ POWER / CONFIG POWER 5 / READ POWER from one client
+    lanes = LaneQueue()
+    for lane, item in [(CONTROL, "config 3.3"), (BULK, "read 1"),
+                       (CONTROL, "config 5"), (BULK, "read 2"), (CONTROL, "config led")]:
+        lanes.push(lane, b"script", item, ["LED" if item == "config led" else "POWER"])
+    lanes.push(CONTROL, b"other", "other config", ["POWER"])
+
+    # The CONFIG 5 waits behind read 1, other devices and clients still go first
+    assert pop_all(lanes) == [(CONTROL, "config 3.3"), (CONTROL, "other config"),
+                              (CONTROL, "config led"), (BULK, "read 1"),
+                              (BULK, "config 5"), (BULK, "read 2")]
+
+
+def test_clients_take_turns():
+    lanes = LaneQueue()
+    for x in range(3):
+        lanes.push(BULK, b"flood", "flood %d" % x, ["TEMP"])
+    lanes.push(BULK, b"quiet", "quiet", ["TEMP"])
+    assert [item for lane, item in pop_all(lanes)][:2] == ["flood 0", "quiet"]
+
+
+def test_starvation_slot_rotates():
+    lanes = LaneQueue(starvation_limit=4)
+    for x in range(40):
+        lanes.push(CONTROL, b"c%d" % x, "control", ["LED"])
+        lanes.push(STATUS, b"s%d" % x, "status", ["LED"])
+        lanes.push(BULK, b"b%d" % x, "bulk", ["TEMP"])
+    served = [lane for lane, item in [lanes.pop() for x in range(40)]]
+    assert served.count(STATUS) == served.count(BULK) == 4
+    assert served.count(CONTROL) == 32
+
+
+def test_random_order_kept():
+    rng = random.Random(7)
+    lanes = LaneQueue(starvation_limit=2)
+    pushed = {}
+    popped = {}
+
+    def pop():
+        lane, (client, devices, number) = lanes.pop()
+        for device in devices:
+            popped.setdefault((client, device), []).append(number)
+
+    for number in range(5000):
+        client = rng.choice([b"a", b"b", b"c"])
+        devices = rng.sample(["LED", "TEMP", "POWER", "RAIL_0"], rng.choice([0, 1, 1, 2]))
+        lanes.push(rng.choice([CONTROL, STATUS, BULK]), client, (client, devices, number),
+                   devices)
+        for device in devices:
+            pushed.setdefault((client, device), []).append(number)
+        if rng.random() < 0.45:
+            pop()
+    while len(lanes):
+        pop()
+
+    assert popped == pushed
+    assert not lanes.keys
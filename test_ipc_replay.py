@@ -0,0 +1,17 @@
+'''
+    Tests of how ipc_replay readies a capture to be sent again
+    Run with python -m pytest
+
+'''
+
+from ipc_replay import prepare_requests
+
+
+def test_replay_in_arrival_order():
+    # A CONFIG served ahead of an earlier READ is written to the capture first
+    records = [(10.5, 0.1, b"a", b'{"msg_type": "CMD", "msg_val": "CONFIG", "params": {}}'),
+               (10.0, 0.7, b"b", b'{"msg_type": "CMD", "msg_val": "READ", "params": {}}'),
+               (11.0, 0.1, b"a", b'{"msg_type": "CMD", "msg_val": "READ", "params": {}}')]
+    requests = prepare_requests(records)
+    assert [(offset, client) for offset, client, request, latency in requests] == \
+        [(0.0, b"b"), (0.5, b"a"), (1.0, b"a")]
@@ -0,0 +1,229 @@
+'''
+    Tests that malformed requests get an ERROR reply from ipc_server
+    and leave it serving. Requests are handed straight to
+    IpcServer.handle_message, so no socket is bound.
+    Run with python -m pytest
+
+'''
+
+import time
+import pytest
+from odin_data.ipc_message import IpcMessage
+from hd_backend import SimulatedBackend
+from ipc_codec import JSON_CODEC, MSGPACK_MARKER, STATUS_CODES, STATUS_OK, detect_codec
+from ipc_server import IpcServer
+
+
+ERROR = STATUS_CODES["ERROR"]
+
+
+@pytest.fixture
+def server():
+    server = IpcServer(5555, backend=SimulatedBackend())
+    server.make_lookup()
+    yield server
+    server.socket.close()
+
+
+def send(server, msg_val, **params):
+    """ Runs a request through the server, returns the reply parameters """
+
+    request = IpcMessage("CMD", msg_val)
+    for name, value in params.items():
+        request.set_param(name, value)
+    return send_raw(server, JSON_CODEC.encode(request))
+
+
+def send_raw(server, data):
+    """ Runs an encoded request through the server, returns the reply parameters """
+
+    frames = server.handle_message(b"test-client", data)
+    return detect_codec(frames[0]).decode(frames[0]).attrs["params"]
+
+
+def assert_serving(server):
+    """ Checks the server still answers a good request """
+    assert send(server, "READ", DEVICE="POWER")["STATUS_CODE"] == STATUS_OK
+
+
+@pytest.mark.parametrize("msg_val, params", [
+    ("READ", {"DEVICE": "POWER", "MAX_AGE": "abc"}),
+    ("READ", {"DEVICE": "POWER", "MAX_AGE": [1]}),
+    ("READ", {"DEVICE": "POWER", "MAX_AGE": True}),
+    ("READ", {"DEVICE": "POWER", "MAX_AGE": -1}),
+    ("READ", {"DEVICE": "POWER", "DEADLINE": "soon"}),
+    ("READ", {"DEVICE": "POWER", "EXPIRES_IN": "soon"}),
+    ("READ", {"DEVICE": "POWER", "EXPIRES_IN": -1}),
+    ("CONFIG", {"DEVICE": "LED", "CONFIG": "BLINK", "RATE": 0}),
+    ("CONFIG", {"DEVICE": "LED", "CONFIG": "BLINK", "RATE": -1}),
+    ("CONFIG", {"DEVICE": "LED", "CONFIG": "BLINK", "RATE": [1]}),
+    ("CONFIG", {"DEVICE": "LED", "CONFIG": "BLINK", "TIMEOUT": "abc"}),
+    ("CONFIG", {"DEVICE": "LED", "CONFIG": "BLINK", "TIMEOUT": -1}),
+    ("CONFIG", {"DEVICE": "LED", "CONFIG": "DIM"}),
+    ("CONFIG", {"DEVICE": "TEMP", "CONFIG": "BLINK"}),
+    ("READ", {"DEVICE": "TEMP", "COUNT": 10, "INTERVAL": "x"}),
+    ("READ", {"DEVICE": "TEMP", "COUNT": True}),
+    ("READ", {"DEVICE": "TEMP", "COUNT": 2.5}),
+    ("READ", {"DEVICE": "TEMP", "COUNT": 0}),
+    ("READ", {"DEVICE": "TEMP", "COUNT": 10, "INTERVAL": -1}),
+    ("READ", {"DEVICE": "TEMP", "COUNT": 1000, "INTERVAL": 0.01}),
+    ("READ_HISTORY", {"DEVICE": "TEMP", "BUCKETS": "x"}),
+    ("READ_HISTORY", {"DEVICE": "TEMP", "BUCKETS": 2.5}),
+    ("READ_HISTORY", {"DEVICE": "TEMP", "BUCKETS": -1}),
+    ("READ_HISTORY", {"DEVICE": "TEMP", "BUCKETS": 10 ** 9}),
+    ("READ_HISTORY", {"DEVICE": "TEMP", "START": "yesterday"}),
+    ("READ_HISTORY", {"DEVICE": "TEMP", "END": [1]}),
+    ("CONFIG", {"DEVICE": "TEMP", "CONFIG": "K"}),
+    ("CONFIG", {"DEVICE": "POWER", "CONFIG": "nan"}),
+    ("CONFIG", {"DEVICE": "POWER", "CONFIG": "inf"}),
+    ("CONFIG", {"DEVICE": "POWER", "CONFIG": -1}),
+    ("CONFIG", {"DEVICE": "POWER", "CONFIG": "100"}),
+    ("CONFIG", {"DEVICE": "POWER", "CONFIG": "high"}),
+    ("PROFILE", {"ACTION": "START", "SECONDS": "x"}),
+    ("PROFILE", {"ACTION": "START", "SECONDS": [5]}),
+    ("PROFILE", {"ACTION": "START", "SECONDS": -1}),
+    ("PROFILE", {"ACTION": "START", "SECONDS": 601}),
+    ("PROFILE", {"ACTION": "START", "SECONDS": 1, "INTERVAL": "x"}),
+    ("PROFILE", {"ACTION": "START", "SECONDS": 1, "INTERVAL": 0.000001}),
+    ("PROFILE", {"ACTION": "RESULT", "TOP": "x"}),
+])
+def test_malformed_parameter(server, msg_val, params):
+    reply = send(server, msg_val, **params)
+    assert reply["STATUS_CODE"] == ERROR
+    assert "ERROR" in reply
+    assert_serving(server)
+
+
+@pytest.mark.parametrize("batch", ["str", 3, {"DEVICE": "POWER"}])
+def test_malformed_batch(server, batch):
+    assert send(server, "BATCH", BATCH=batch)["STATUS_CODE"] == ERROR
+    assert_serving(server)
+
+
+@pytest.mark.parametrize("entry", [
+    "str", 3, None, ["POWER", "READ"],
+    {"DEVICE": "POWER", "OP": "READ", "MAX_AGE": "x"},
+    {"DEVICE": "TEMP", "OP": "CONFIG", "CONFIG": "BLINK"},
+    {"DEVICE": ["POWER"], "OP": "READ"},
+    {"DEVICE": "POWER", "OP": "WRITE"},
+])
+def test_malformed_batch_entry(server, entry):
+    # One bad entry is its own ERROR, the entries around it still run
+    good = {"DEVICE": "POWER", "OP": "READ"}
+    reply = send(server, "BATCH", BATCH=[good, entry, good])
+    assert reply["STATUS_CODE"] == STATUS_OK
+    results = reply["RESULTS"]
+    assert [result["STATUS_CODE"] for result in results] == [STATUS_OK, ERROR, STATUS_OK]
+    assert "ERROR" in results[1]
+
+
+@pytest.mark.parametrize("data", [
+    b"not json", b"[1, 2]", b"{}", b'{"msg_type": "CMD", "msg_val": "READ", "params": 3}',
+    MSGPACK_MARKER, MSGPACK_MARKER + b"\x93\x01\x03\x05",
+])
+def test_malformed_message(server, data):
+    assert send_raw(server, data)["STATUS_CODE"] == ERROR
+    assert_serving(server)
+
+
+def test_unexpected_exception(server, monkeypatch):
+    # Anything a device raises becomes an ERROR reply, not a dead serve loop
+    def broken(max_age=None):
+        raise RuntimeError("bus fault")
+    monkeypatch.setattr(server.registry.get("TEMP"), "read", broken)
+
+    reply = send(server, "READ", DEVICE="TEMP")
+    assert reply["STATUS_CODE"] == ERROR
+    assert "bus fault" in reply["ERROR"]
+    assert_serving(server)
+
+
+def test_blink_strings_accepted(server):
+    # The interactive client sends TIMEOUT and RATE as typed
+    reply = send(server, "CONFIG", DEVICE="LED", CONFIG="BLINK", TIMEOUT="1", RATE="0.5")
+    assert reply["STATUS_CODE"] == STATUS_OK
+    assert reply["CONFIG"] == "BLINK"
+
+
+def test_history_follows_unit(server):
+    for x in range(3):
+        send(server, "READ", DEVICE="TEMP")
+    celcius = send(server, "READ_HISTORY", DEVICE="TEMP")["VALUES"]
+    send(server, "CONFIG", DEVICE="TEMP", CONFIG="F")
+    send(server, "READ", DEVICE="TEMP")
+
+    reply = send(server, "READ_HISTORY", DEVICE="TEMP")
+    assert reply["UNIT"] == "F"
+    assert reply["VALUES"][:3] == pytest.approx([value * 1.8 + 32 for value in celcius])
+    # The reading taken in F lies with the rest, not 1.8 times further up
+    assert abs(reply["VALUES"][3] - reply["VALUES"][2]) < 10
+
+
+def test_profile_numbers_as_text(server, tmp_path):
+    server.profile_dir = str(tmp_path)
+    reply = send(server, "PROFILE", ACTION="START", SECONDS="0.05", INTERVAL="0.01")
+    assert reply["STATUS_CODE"] == STATUS_OK
+    assert reply["PROFILING"]
+    server.profiler.stop()
+
+
+def test_numeric_power_config(server):
+    reply = send(server, "CONFIG", DEVICE="POWER", CONFIG=3.3, LEGACY=True)
+    assert reply["STATUS_CODE"] == STATUS_OK
+    assert reply["CONFIG"] == "3.3"
+    assert "3.3V" in reply["REPLY"]
+
+
+def test_unknown_names_share_metrics(server):
+    for x in range(50):
+        send(server, "READ", DEVICE='made up "%d"\n' % x)
+        send(server, "OP_%d" % x, DEVICE="POWER")
+    assert set(server.metrics.requests) == {("unknown", "READ"), ("POWER", "unknown")}
+
+    send(server, "READ", DEVICE="POWER")
+    server.metrics.rejected['bad "reason"\n'] = 1
+    text = server.metrics.prometheus()
+    assert 'femii_requests_total{device="POWER",op="READ"} 1' in text
+    assert 'femii_rejected_total{reason="bad \\"reason\\"\\n"} 1' in text
+
+
+
+@pytest.mark.parametrize("params", [
+    {"CONFIG": "DEAD", "VALUE": 1, "TIMEOUT": "soon"},
+    {"CONFIG": "DEAD", "VALUE": 1, "TIMEOUT": -1},
+    {"CONFIG": "DEAD", "VALUE": "x"},
+    {"CONFIG": "DEAD", "VALUE": [1]},
+    {"CONFIG": "OFFSET", "VALUE": float("inf")},
+    {"CONFIG": ["DEAD"], "VALUE": 1},
+])
+def test_bad_fault_changes_nothing(server, params):
+    before = send(server, "READ", DEVICE="TEMP", MAX_AGE=0)["VALUE"]
+    assert send(server, "FAULT", DEVICE="TEMP", **params)["STATUS_CODE"] == ERROR
+    after = [send(server, "READ", DEVICE="TEMP", MAX_AGE=0)["VALUE"] for x in range(5)]
+    assert 1.0 not in after and abs(after[-1] - before) < 10
+
+
+def test_fault_numbers_as_text(server):
+    reply = send(server, "FAULT", DEVICE="TEMP", CONFIG="DEAD", VALUE="1", TIMEOUT="5")
+    assert reply["STATUS_CODE"] == STATUS_OK
+    assert send(server, "READ", DEVICE="TEMP", MAX_AGE=0)["VALUE"] == 1.0
+
+
+def test_expires_in_counts_from_arrival(server):
+    assert send(server, "READ", DEVICE="POWER", EXPIRES_IN=5)["STATUS_CODE"] == STATUS_OK
+
+    request = IpcMessage("CMD", "READ")
+    request.set_param("DEVICE", "POWER")
+    request.set_param("EXPIRES_IN", 1)
+    frames = server.handle_message(b"test-client", JSON_CODEC.encode(request),
+                                   arrived=time.time() - 2)
+    assert JSON_CODEC.decode(frames[0]).get_param("STATUS_CODE") == STATUS_CODES["EXPIRED"]
+
+
+def test_unknown_aliases_not_sharded(server):
+    server.num_workers = 4
+    for x in range(100):
+        assert server.get_worker("MADE_UP_%d" % x) == 0
+    assert server.get_worker(None) == 0
+    assert {server.get_worker(alias) for alias in ("LED", "TEMP", "POWER")} == {0, 1, 2}
+    assert set(server.shards) == {"LED", "TEMP", "POWER"}